@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''external merge sort of text lines, giving the same order as the sort command in C locale
+
+the lines are sorted in the memory up to the budget, and the sorted runs exceeding it
+are spilled into gzipped (or compressed by given codec) temporary files, merged finally into the output.
+plain input files can be split into byte ranges to convert and sort in worker processes.
+the lines are sorted as bytes (encoding the text lines) and written into the binary file'''
+
+import heapq
+import itertools
+import multiprocessing
+import os
+import tempfile
+import zlib
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from exp.common import files
+
+# memory budget of the lines in the sorted runs (in bytes, shared by the workers)
+MEMORY_SIZE = 512 * 1024 * 1024
+# estimated memory overhead of each line object
+LINE_OVERHEAD = 64
+# compression level of the spilled runs (fast enough to keep up with the sorting)
+SPILL_LEVEL = 1
+BUFFER_SIZE = 1024 * 1024
+# number of lines to write at once
+WRITE_BATCH_SIZE = 10000
+# seconds to wait for the runs of the workers before checking whether they are alive
+WORKER_POLL_TIMEOUT = 1
+JOBS = 1
+
+def identity(lines):
+    return lines
+
+class RunWriter(object):
+    '''sorting the lines into runs, spilling them into temporary files when exceeding the memory budget'''
+    def __init__(self, memory = MEMORY_SIZE, tmpdir = None, prefix = 'extsort', codec = None):
+        self.memory = memory
+        self.tmpdir = tmpdir
+        self.prefix = prefix
+        self.codec = codec
+        self.lines = []
+        self.size = 0
+        self.runPaths = []
+
+    def add(self, line):
+        # lines are compared without the trailing newline as the sort command does
+        if line[-1:] == b'\n':
+            line = line[:-1]
+        self.lines.append(line)
+        self.size += len(line) + LINE_OVERHEAD
+        if self.size >= self.memory:
+            self.spill()
+
+    def addLines(self, lines):
+        if str is not bytes:
+            lines = encodeLines(lines)
+        for line in lines:
+            self.add(line)
+
+    def spill(self):
+        '''sort the lines in the memory and write them into a new temporary run'''
+        if not self.lines:
+            return
+        self.lines.sort()
+        if self.codec:
+            (fd, path) = tempfile.mkstemp(prefix = '%s.' % self.prefix, suffix = self.codec.ext, dir = self.tmpdir)
+            os.close(fd)
+            runFile = self.codec.open(path, 'wb')
+            for batch in iterBatches(self.lines, WRITE_BATCH_SIZE):
+                runFile.write( b'\n'.join(batch) + b'\n' )
+            runFile.close()
+        else:
+            (fd, path) = tempfile.mkstemp(prefix = '%s.' % self.prefix, suffix = '.gz', dir = self.tmpdir)
+            runFile = os.fdopen(fd, 'wb')
+            compressor = zlib.compressobj(SPILL_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            for batch in iterBatches(self.lines, WRITE_BATCH_SIZE):
+                runFile.write( compressor.compress(b'\n'.join(batch) + b'\n') )
+            runFile.write( compressor.flush() )
+            runFile.close()
+        self.runPaths.append(path)
+        self.lines = []
+        self.size = 0
+
+    def getRuns(self):
+        '''return the iterators of the sorted runs, including the one remaining in the memory'''
+        self.lines.sort()
+        runs = [iterRun(path, self.codec) for path in self.runPaths]
+        if self.lines:
+            runs.append( iter(self.lines) )
+        return runs
+
+    def clear(self):
+        for path in self.runPaths:
+            if os.path.exists(path):
+                os.remove(path)
+        self.runPaths = []
+        self.lines = []
+        self.size = 0
+
+
+def iterBatches(lines, size):
+    iterator = iter(lines)
+    while True:
+        batch = list( itertools.islice(iterator, size) )
+        if not batch:
+            break
+        yield batch
+
+def encodeLines(lines):
+    '''iterate the lines encoded into bytes if given as text'''
+    for line in lines:
+        if not isinstance(line, bytes):
+            line = line.encode('utf-8')
+        yield line
+
+def iterRun(path, codec = None):
+    '''iterate the lines of the spilled run (without the newlines)'''
+    if codec:
+        runFile = codec.open(path, 'rb')
+        try:
+            for line in runFile:
+                yield line[:-1]
+        finally:
+            runFile.close()
+        return
+    runFile = open(path, 'rb')
+    try:
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        rest = b''
+        while True:
+            buf = runFile.read(BUFFER_SIZE)
+            if buf:
+                data = rest + decompressor.decompress(buf)
+            else:
+                data = rest + decompressor.flush()
+            lines = data.split(b'\n')
+            rest = lines.pop()
+            for line in lines:
+                yield line
+            if not buf:
+                break
+    finally:
+        runFile.close()
+
+def iterRange(path, start, end):
+    '''iterate the lines beginning in the byte range [start, end) of the plain file'''
+    rangeFile = open(path, 'rb')
+    try:
+        rangeFile.seek(start)
+        pos = start
+        while pos < end:
+            line = rangeFile.readline()
+            if not line:
+                break
+            pos += len(line)
+            yield line
+    finally:
+        rangeFile.close()
+
+def mergeRuns(runs, saveFile):
+    '''merge the sorted runs into the opened binary file'''
+    for batch in iterBatches(heapq.merge(*runs), WRITE_BATCH_SIZE):
+        saveFile.write( b'\n'.join(batch) + b'\n' )
+
+def sortRange(path, start, end, convert, memory, tmpdir, codec, runQueue):
+    '''worker process converting and sorting the lines in the byte range, putting the paths of the runs'''
+    writer = RunWriter(memory, tmpdir, codec = codec)
+    try:
+        writer.addLines( convert(iterRange(path, start, end)) )
+        writer.spill()
+        runQueue.put(writer.runPaths)
+    except:
+        writer.clear()
+        runQueue.put(None)
+        raise
+
+def sortLines(lines, saveFile, **options):
+    '''sort the lines (after converting if given) and write them into the binary file object or path
+
+    options:
+      convert: function mapping the iterator of input lines into the iterator of lines to sort
+      memory: memory budget for the sorted runs in bytes
+      tmpdir: directory for the spilled runs (default: the system temporary directory)
+      codec: files.Codec compressing the spilled runs (default: gzip of SPILL_LEVEL)
+      jobs: number of worker processes (used if lines are given as a plain file path)'''
+    convert = options.get('convert', identity)
+    memory  = options.get('memory', MEMORY_SIZE)
+    tmpdir  = options.get('tmpdir', None)
+    jobs    = options.get('jobs', JOBS)
+    codec   = options.get('codec', None)
+    if isinstance(saveFile, str):
+        saveFile = files.open(saveFile, 'wb')
+        closing = True
+    else:
+        closing = False
+    if isinstance(lines, str) and jobs > 1 and not files.isCompressed(lines):
+        runPaths = sortParallel(lines, convert, memory, tmpdir, jobs, codec)
+        try:
+            mergeRuns([iterRun(path, codec) for path in runPaths], saveFile)
+        finally:
+            for path in runPaths:
+                os.remove(path)
+    else:
+        if isinstance(lines, str):
+            lines = files.open(lines, 'rb')
+            closingLines = True
+        else:
+            closingLines = False
+        writer = RunWriter(memory, tmpdir, codec = codec)
+        try:
+            writer.addLines( convert(lines) )
+            mergeRuns(writer.getRuns(), saveFile)
+        finally:
+            writer.clear()
+            if closingLines:
+                lines.close()
+    if closing:
+        saveFile.close()
+
+def sortParallel(path, convert, memory, tmpdir, jobs, codec = None):
+    '''sort the byte ranges of the plain file in worker processes, returning the paths of all the runs'''
+    ranges = files.getLineRanges(path, jobs)
+    runQueue = multiprocessing.Queue()
+    procs = []
+    for (start, end) in ranges:
+        args = (path, start, end, convert, memory // len(ranges), tmpdir, codec, runQueue)
+        procs.append( multiprocessing.Process(target = sortRange, args = args) )
+    for proc in procs:
+        proc.start()
+    runPaths = []
+    failed = False
+    received = 0
+    while received < len(procs):
+        try:
+            paths = runQueue.get(timeout = WORKER_POLL_TIMEOUT)
+        except queue.Empty:
+            # the worker killed (by a signal or out of memory) never puts its runs
+            if any(proc.exitcode not in (None, 0) for proc in procs):
+                failed = True
+                break
+            continue
+        received += 1
+        if paths == None:
+            failed = True
+        else:
+            runPaths += paths
+    if failed:
+        for proc in procs:
+            if proc.exitcode == None:
+                proc.terminate()
+    for proc in procs:
+        proc.join()
+    if failed:
+        # collecting the runs of the workers finished before the failure
+        while True:
+            try:
+                paths = runQueue.get(timeout = 0.1)
+            except queue.Empty:
+                break
+            runPaths += paths or []
+        for runPath in runPaths:
+            os.remove(runPath)
+        raise RuntimeError("failed to sort the lines of: %s" % path)
+    return runPaths
+
+def sortFile(srcPath, savePath, **options):
+    '''sort the lines of the file into another file, same as "LC_ALL=C sort"'''
+    sortLines(srcPath, savePath, **options)
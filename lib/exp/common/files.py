@@ -3,17 +3,47 @@
 
 '''auxiliary functions for file I/O'''
 
+import bisect
 import codecs
+import collections
+import copy
 import gzip
 import io
+import multiprocessing
+import multiprocessing.pool
 import os
 import os.path
 import re
+import struct
 import subprocess
+import threading
+import zlib
 
-from exp.common import debug
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from exp.common import cache, debug
 import exp.common.progress
 
+# optional modules of the fast compression codecs
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
 PV = None
 if subprocess.call('which pv > /dev/null', shell=True) == 0:
     PV = 'pv'
@@ -21,20 +51,594 @@ if subprocess.call('which pv > /dev/null', shell=True) == 0:
 env = os.environ
 env['LC_ALL'] = 'C'
 
+# size of the blocks compressed independently by the gzip writer
+GZIP_BLOCK_SIZE = 1024 * 1024
+# number of threads compressing the blocks
+GZIP_THREADS = multiprocessing.cpu_count()
+GZIP_LEVEL = 6
+
+# header of block index files of blocked gzip, followed by the number of blocks
+# and the (compressed, uncompressed) offsets of the blocks and the end of file
+GZIP_INDEX_MAGIC = b'EXPGZI1\n'
+GZIP_INDEX_EXT = '.gzi'
+GZIP_OFFSETS_FORMAT = '<qq'
+GZIP_OFFSETS_SIZE = struct.calcsize(GZIP_OFFSETS_FORMAT)
+# maximum uncompressed size of the members to read the gzip file as blocked one
+GZIP_MAX_BLOCK_SIZE = 16 * 1024 * 1024
+# number of decompressed blocks cached by the random access reader
+GZIP_CACHE_SIZE = 64
+
+# reading the compressed files in the background thread (by files.open)
+READ_AHEAD = True
+# size of the compressed data decompressed at once by the read-ahead thread
+READ_AHEAD_SIZE = 1024 * 1024
+# number of the decompressed blocks waiting for the consumer
+READ_AHEAD_QUEUE = 4
+# seconds of the read-ahead thread waiting for the free space of the queue before checking the stop
+READ_AHEAD_TIMEOUT = 0.1
+
+# default compression levels of the other codecs
+ZSTD_LEVEL = 3
+LZ4_LEVEL = 0
+XZ_LEVEL = 6
+# buffer size of the line reader over the decompressed stream
+CODEC_BUFFER_SIZE = 1024 * 1024
+
 _open = open
 
+class ParallelGzipWriter(object):
+    '''file-like object compressing the blocks of written data on the thread pool
+
+    each block is written as an independent gzip member in the order of writing,
+    so the output is a standard multi-member gzip stream (zlib releases GIL while compressing).
+    if indexPath is given, the offsets of the blocks are saved for BlockedGzipReader'''
+    def __init__(self, filename, mode = 'w', **options):
+        self.blockSize = options.get('blockSize', GZIP_BLOCK_SIZE)
+        self.level = options.get('level', GZIP_LEVEL)
+        self.indexPath = options.get('indexPath', None)
+        threads = options.get('threads', GZIP_THREADS)
+        self.name = filename
+        self.fileObj = _open(filename, 'wb')
+        self.pool = multiprocessing.pool.ThreadPool(threads)
+        # compressing blocks waiting to be written in order
+        self.pending = collections.deque()
+        self.maxPending = threads * 2
+        self.buf = []
+        self.bufSize = 0
+        # (compressed, uncompressed) offsets of the written blocks
+        self.blocks = []
+        self.compressedPos = 0
+        self.pos = 0
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+    def write(self, data):
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        self.buf.append(data)
+        self.bufSize += len(data)
+        if self.bufSize >= self.blockSize:
+            self.submit()
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def submit(self):
+        '''pass the buffered data to the thread pool, writing the finished blocks in order'''
+        if self.bufSize > 0:
+            block = b''.join(self.buf)
+            result = self.pool.apply_async(compressGzipMember, (block, self.level))
+            self.pending.append( (result, len(block)) )
+            self.buf = []
+            self.bufSize = 0
+        while len(self.pending) > self.maxPending:
+            self.writeBlock()
+
+    def writeBlock(self):
+        (result, size) = self.pending.popleft()
+        data = result.get()
+        self.blocks.append( (self.compressedPos, self.pos) )
+        self.fileObj.write(data)
+        self.compressedPos += len(data)
+        self.pos += size
+
+    def flush(self):
+        self.submit()
+        while self.pending:
+            self.writeBlock()
+        self.fileObj.flush()
+
+    def close(self):
+        if not self.closed:
+            self.flush()
+            self.pool.close()
+            self.pool.join()
+            self.fileObj.close()
+            if self.indexPath:
+                saveGzipIndex(self.indexPath, self.blocks + [(self.compressedPos, self.pos)])
+            self.closed = True
+
+
+class ReadAheadReader(object):
+    '''file-like object reading the uncompressed data of the compressed file in the background thread
+
+    the thread decompresses the large blocks into the bounded queue (zlib releases GIL while decompressing),
+    and the consumer splits them into lines, so the decompression overlaps with the parsing of the lines.
+    the thread doesn't refer to the reader, so it is stopped by close() or by the reader being collected'''
+    def __init__(self, filename, codec = None, **options):
+        self.bufferSize = options.get('bufferSize', READ_AHEAD_SIZE)
+        self.name = filename
+        self.codec = codec or getCodec(filename) or getCodecByExt(filename)
+        self.queue = queue.Queue( options.get('queueSize', READ_AHEAD_QUEUE) )
+        # lines of the current block, the rest of the last line continuing into the next block
+        self.lines = []
+        self.index = 0
+        self.rest = b''
+        # uncompressed offset of the first line of the current block
+        self.linesPos = 0
+        # exception raised in the thread
+        self.errors = []
+        self.closed = False
+        self.finished = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target = readAhead, args = (self.name, self.codec, self.bufferSize, self.queue, self.stopped, self.errors))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __del__(self):
+        # the constructor can fail before starting the thread
+        if hasattr(self, 'thread'):
+            self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+    def __iter__(self):
+        while True:
+            lines = self.lines
+            while self.index < len(lines):
+                line = lines[self.index]
+                self.index += 1
+                yield line
+            if not self.fill():
+                break
+
+    def fill(self):
+        '''take the lines of the next block from the queue, returning False at the end of file'''
+        while not self.finished:
+            self.linesPos += sum(map(len, self.lines))
+            data = self.queue.get()
+            if data == None:
+                self.finished = True
+                if self.errors:
+                    raise IOError("failed to read %s: %s" % (self.name, self.errors[0]))
+                lines = [self.rest] if self.rest else []
+                self.rest = b''
+            else:
+                lines = io.BytesIO(self.rest + data).readlines()
+                self.rest = b''
+                if lines and lines[-1][-1:] != b'\n':
+                    self.rest = lines.pop()
+            self.lines = lines
+            self.index = 0
+            if lines:
+                return True
+        return False
+
+    def readline(self):
+        if self.index >= len(self.lines) and not self.fill():
+            return b''
+        line = self.lines[self.index]
+        self.index += 1
+        return line
+
+    def read(self, size = -1):
+        chunks = []
+        length = 0
+        while size < 0 or length < size:
+            if self.index >= len(self.lines) and not self.fill():
+                break
+            line = self.lines[self.index]
+            if size >= 0 and length + len(line) > size:
+                # leaving the rest of the line for the next reading
+                head = line[:size - length]
+                self.lines[self.index] = line[len(head):]
+                self.linesPos += len(head)
+                chunks.append(head)
+                break
+            chunks.append(line)
+            length += len(line)
+            self.index += 1
+        return b''.join(chunks)
+
+    def tell(self):
+        return self.linesPos + sum(map(len, self.lines[:self.index]))
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            # the thread waiting for the free space of the queue stops within the timeout
+            self.stopped.set()
+            self.thread.join()
+            self.lines = []
+            self.index = 0
+
+
+def readAhead(filename, codec, bufferSize, blockQueue, stopped, errors):
+    '''thread putting the decompressed blocks into the queue, followed by None, until stopped is set'''
+    blocks = None
+    try:
+        if codec.name == 'gzip':
+            blocks = iterGzipData(filename, bufferSize)
+        else:
+            blocks = iterStreamData(codec.open(filename, 'rb'), bufferSize)
+        for data in blocks:
+            if not putUntilStopped(blockQueue, data, stopped):
+                return
+    except Exception as e:
+        errors.append(e)
+    finally:
+        if blocks != None:
+            # closing the file also when stopped in the middle
+            blocks.close()
+    putUntilStopped(blockQueue, None, stopped)
+
+def putUntilStopped(blockQueue, data, stopped):
+    '''put the data into the queue waiting for the free space, returning False if stopped before'''
+    while not stopped.is_set():
+        try:
+            blockQueue.put(data, timeout = READ_AHEAD_TIMEOUT)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _isGzipEnded(decompressor):
+    '''return True if the decompressor reached the end of the gzip member (called after the last input)'''
+    if hasattr(decompressor, 'eof'):
+        return decompressor.eof
+    # python 2 has no eof flag, but a finished decompressor leaves further input unused,
+    # while the unfinished one consumes (or rejects) the probe byte
+    try:
+        decompressor.decompress(b'\x00')
+    except zlib.error:
+        return False
+    return decompressor.unused_data == b'\x00'
+
+
+def iterGzipData(filename, bs = READ_AHEAD_SIZE):
+    '''iterate the decompressed blocks of the (multi-member) gzip file'''
+    f_in = _open(filename, 'rb')
+    try:
+        decompressor = None
+        pending = b''
+        while True:
+            buf = f_in.read(bs)
+            if not buf:
+                break
+            buf = pending + buf
+            pending = b''
+            while buf:
+                if decompressor == None:
+                    if len(buf) < 2:
+                        # the magic number of the next member may be split over the reads
+                        pending = buf
+                        break
+                    if not buf.startswith(b'\x1f\x8b'):
+                        # ignoring the trailing garbage as gzip module does
+                        return
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                data = decompressor.decompress(buf)
+                if data:
+                    yield data
+                buf = decompressor.unused_data
+                if buf:
+                    decompressor = None
+        if decompressor != None:
+            if not _isGzipEnded(decompressor):
+                raise EOFError('Compressed file ended before the end-of-stream marker was reached: %s' % filename)
+            data = decompressor.flush()
+            if data:
+                yield data
+    finally:
+        f_in.close()
+
+
+def iterStreamData(stream, bs = READ_AHEAD_SIZE):
+    '''iterate the blocks read from the stream (decompressed by the codec)'''
+    try:
+        while True:
+            data = stream.read(bs)
+            if not data:
+                break
+            yield data
+    finally:
+        stream.close()
+
+
+class BlockedGzipReader(object):
+    '''random access reader of the gzip file consisting of small independent members (blocked gzip)
+
+    the uncompressed offsets are mapped into the virtual offsets (block offset, in-block offset) by the block index,
+    and the slices of the uncompressed content are given like the memory-mapped plain file,
+    decompressing the blocks through the LRU cache'''
+    def __init__(self, filename, indexPath = None, cacheSize = GZIP_CACHE_SIZE):
+        if indexPath == None:
+            indexPath = filename + GZIP_INDEX_EXT
+        blocks = loadGzipIndex(indexPath)
+        self.compressedOffsets = [block[0] for block in blocks]
+        self.offsets = [block[1] for block in blocks]
+        self.size = self.offsets[-1]
+        self.fileObj = _open(filename, 'rb')
+        self.cache = cache.Cache(size = cacheSize)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            (start, stop, step) = index.indices(self.size)
+            return self.read(start, stop - start)
+        else:
+            return self.read(index, 1)
+
+    def __len__(self):
+        return self.size
+
+    def close(self):
+        self.fileObj.close()
+        self.cache.clear()
+
+    def getVirtualOffset(self, pos):
+        '''return the compressed offset of the block including the position, and the offset in the block'''
+        index = bisect.bisect_right(self.offsets, pos) - 1
+        return (self.compressedOffsets[index], pos - self.offsets[index])
+
+    def getBlock(self, index):
+        '''return the decompressed content of the numbered block'''
+        data = self.cache.use(index)
+        if data == None:
+            start = self.compressedOffsets[index]
+            self.fileObj.seek(start)
+            data = zlib.decompress(self.fileObj.read(self.compressedOffsets[index + 1] - start), 16 + zlib.MAX_WBITS)
+            self.cache[index] = data
+        return data
+
+    def read(self, pos, length):
+        '''return the uncompressed content of given length from the position'''
+        end = min(pos + length, self.size)
+        chunks = []
+        index = bisect.bisect_right(self.offsets, pos) - 1
+        while pos < end:
+            offset = self.offsets[index]
+            data = self.getBlock(index)
+            chunks.append( data[pos - offset:end - offset] )
+            pos = offset + len(data)
+            index += 1
+        return b''.join(chunks)
+
+
+def saveGzipIndex(indexPath, blocks):
+    '''save the (compressed, uncompressed) offsets of the blocks followed by those of the end of file'''
+    indexFile = _open(indexPath, 'wb')
+    indexFile.write(GZIP_INDEX_MAGIC)
+    indexFile.write( struct.pack('<q', len(blocks) - 1) )
+    for block in blocks:
+        indexFile.write( struct.pack(GZIP_OFFSETS_FORMAT, *block) )
+    indexFile.close()
+
+
+def loadGzipIndex(indexPath):
+    indexFile = _open(indexPath, 'rb')
+    magic = indexFile.read(len(GZIP_INDEX_MAGIC))
+    if magic != GZIP_INDEX_MAGIC:
+        raise ValueError('not a gzip block index file: %s' % indexPath)
+    count = struct.unpack('<q', indexFile.read(8))[0]
+    data = indexFile.read((count + 1) * GZIP_OFFSETS_SIZE)
+    indexFile.close()
+    return [struct.unpack_from(GZIP_OFFSETS_FORMAT, data, i * GZIP_OFFSETS_SIZE) for i in range(count + 1)]
+
+
+def scanGzipBlocks(filename, maxBlockSize = GZIP_MAX_BLOCK_SIZE, bs = 1024 * 1024):
+    '''return the (compressed, uncompressed) offsets of the gzip members and the end of file,
+    or None if any member is larger than the maximum size (e.g. compressed by gzip command)'''
+    f_in = _open(filename, 'rb')
+    blocks = [(0, 0)]
+    compressedPos = 0
+    pos = 0
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    while True:
+        buf = f_in.read(bs)
+        if not buf:
+            break
+        while buf:
+            pos += len( decompressor.decompress(buf) )
+            if pos - blocks[-1][1] > maxBlockSize:
+                f_in.close()
+                return None
+            if decompressor.unused_data:
+                # reached the end of the member, the rest of data belongs to the next one
+                rest = decompressor.unused_data
+                compressedPos += len(buf) - len(rest)
+                blocks.append( (compressedPos, pos) )
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                buf = rest
+            else:
+                compressedPos += len(buf)
+                buf = b''
+    f_in.close()
+    if blocks[-1] != (compressedPos, pos):
+        blocks.append( (compressedPos, pos) )
+    return blocks
+
+
+def makeGzipIndex(filename, indexPath = None):
+    '''save the block index of the gzip file if it is blocked one, returning whether saved or not'''
+    if indexPath == None:
+        indexPath = filename + GZIP_INDEX_EXT
+    blocks = scanGzipBlocks(filename)
+    if blocks == None:
+        return False
+    saveGzipIndex(indexPath, blocks)
+    return True
+
+
+def makeBlockedGzip(filename, target, indexPath = None):
+    '''copy the (compressed) file into the blocked gzip file and its block index'''
+    if indexPath == None:
+        indexPath = target + GZIP_INDEX_EXT
+    f_in = open(filename, 'r')
+    f_out = ParallelGzipWriter(target, indexPath = indexPath)
+    while True:
+        buf = f_in.read(GZIP_BLOCK_SIZE)
+        if not buf:
+            break
+        f_out.write(buf)
+    f_in.close()
+    f_out.close()
+
+
+def compressGzipMember(data, level = GZIP_LEVEL):
+    '''compress the data into a gzip member'''
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class Codec(object):
+    '''compression format detected by the magic bytes at the head of file or the extension
+
+    the codec is available if its optional module is importable,
+    and the files are opened as the binary streams of the uncompressed data.
+    readAhead tells whether files.open reads the file by ReadAheadReader'''
+    def __init__(self, name, ext, magic, module, opener, level, readAhead = True):
+        self.name = name
+        self.ext = ext
+        self.magic = magic
+        self.module = module
+        self.opener = opener
+        self.level = level
+        self.readAhead = readAhead
+
+    def isAvailable(self):
+        return self.module != None
+
+    def open(self, filename, mode = 'rb'):
+        if not self.isAvailable():
+            raise IOError("module of %s codec is not installed: %s" % (self.name, filename))
+        return self.opener(filename, mode, self.level)
+
+
+def openGzip(filename, mode, level):
+    if mode.find('w') >= 0:
+        return ParallelGzipWriter(filename, mode, level = level)
+    return gzip.open(filename, 'rb')
+
+
+def openZstd(filename, mode, level):
+    if mode.find('w') >= 0:
+        return zstandard.ZstdCompressor(level = level).stream_writer(_open(filename, 'wb'))
+    reader = zstandard.ZstdDecompressor().stream_reader(_open(filename, 'rb'), read_across_frames = True)
+    return io.BufferedReader(reader, CODEC_BUFFER_SIZE)
+
+
+def openLz4(filename, mode, level):
+    if mode.find('w') >= 0:
+        return lz4.frame.open(filename, 'wb', compression_level = level)
+    return lz4.frame.open(filename, 'rb')
+
+
+def openXz(filename, mode, level):
+    if mode.find('w') >= 0:
+        return lzma.open(filename, 'wb', preset = level)
+    return lzma.open(filename, 'rb')
+
+
+# registered codecs in the order of detection
+CODECS = collections.OrderedDict()
+
+def registerCodec(codec):
+    CODECS[codec.name] = codec
+
+registerCodec( Codec('gzip', '.gz',  b'\x1f\x8b',         gzip,      openGzip, GZIP_LEVEL) )
+# zstd is decompressed fast enough to split the lines in the buffered reader without the thread
+registerCodec( Codec('zstd', '.zst', b'\x28\xb5\x2f\xfd', zstandard, openZstd, ZSTD_LEVEL, readAhead = False) )
+registerCodec( Codec('lz4',  '.lz4', b'\x04\x22\x4d\x18', lz4,       openLz4,  LZ4_LEVEL) )
+registerCodec( Codec('xz',   '.xz',  b'\xfd7zXZ\x00',     lzma,      openXz,   XZ_LEVEL) )
+
+
+def getCodec(filename):
+    '''return the codec of the existing file detected by the magic bytes, or None for the plain file'''
+    try:
+        f_in = _open(filename, 'rb')
+        head = f_in.read(8)
+        f_in.close()
+    except (IOError, OSError):
+        return None
+    for codec in CODECS.values():
+        if head.startswith(codec.magic):
+            return codec
+    return None
+
+
+def getCodecByExt(filename):
+    '''return the codec given by the extension of the file name, or None'''
+    ext = getExt(filename)
+    for codec in CODECS.values():
+        if ext == codec.ext:
+            return codec
+    return None
+
+
+def getCodecByName(name):
+    '''return the codec of given "name[:level]", copied with the compression level if given
+
+    the registered codec is shared by the other files, so its level is left as it is'''
+    (name, sep, level) = name.partition(':')
+    if name not in CODECS:
+        raise ValueError("unknown codec: %s (%s)" % (name, str.join('/', CODECS.keys())))
+    codec = CODECS[name]
+    if not codec.isAvailable():
+        raise IOError("module of %s codec is not installed" % name)
+    if level:
+        codec = copy.copy(codec)
+        codec.level = int(level)
+    return codec
+
+
+def getAvailableCodecs():
+    '''return the names of the codecs having their modules installed'''
+    return [name for name, codec in CODECS.items() if codec.isAvailable()]
+
+
 def autoCat(filenames, target):
     '''concatenate and copy files into target file (expanding for compressed ones)'''
-    if PV:
+    if getCodecByExt(target) != None:
+        # compressing by the threads (or the codec module) without the pipe
+        if type(filenames) != list:
+            filenames = [filenames]
+        f_out = open(target, 'w')
+        for filename in filenames:
+            f_in = open(filename, 'r')
+            while True:
+                buf = f_in.read(GZIP_BLOCK_SIZE)
+                if not buf:
+                    break
+                f_out.write(buf)
+            f_in.close()
+        f_out.close()
+    elif PV:
         if type(filenames) != list:
             filenames = [filenames]
         f_out = _open(target, 'w')
-        if getExt(target) == '.gz':
-            cmd = '%s -WN copied | gzip' % (PV)
-            p_pv = subprocess.Popen(cmd, env=env, shell=True, stdin=subprocess.PIPE, stdout=f_out)
-        else:
-            cmd = '%s -WN copied' % (PV)
-            p_pv = subprocess.Popen(cmd, env=env, shell=True, stdin=subprocess.PIPE, stdout=f_out)
+        cmd = '%s -WN copied' % (PV)
+        p_pv = subprocess.Popen(cmd, env=env, shell=True, stdin=subprocess.PIPE, stdout=f_out)
         for filename in filenames:
             f_in = open(filename, 'r')
             for line in f_in:
@@ -74,6 +678,92 @@ def getContentSize(path):
         return -1
 
 
+def getLineRanges(filename, num, indexPath = None):
+    '''split the plain file into given number of byte ranges [start, end) beginning at the lines
+
+    blocked gzip file is split into the ranges of uncompressed offsets by the block index'''
+    if isGzipped(filename):
+        f_in = BlockedGzipReader(filename, indexPath)
+        size = len(f_in)
+    else:
+        f_in = _open(filename, 'rb')
+        size = os.path.getsize(filename)
+    starts = [0]
+    for i in range(1, num):
+        pos = size * i // num
+        if pos <= starts[-1]:
+            continue
+        # skipping the rest of the line including the position
+        pos += len( readLineFrom(f_in, pos - 1) ) - 1
+        if pos >= size:
+            break
+        if pos > starts[-1]:
+            starts.append(pos)
+    f_in.close()
+    return list(zip(starts, starts[1:] + [size]))
+
+
+def readLineFrom(fileObj, pos):
+    '''read the rest of the line from the position of the plain file or BlockedGzipReader'''
+    if not isinstance(fileObj, BlockedGzipReader):
+        fileObj.seek(pos)
+        return fileObj.readline()
+    chunks = []
+    while True:
+        data = fileObj.read(pos, GZIP_BLOCK_SIZE)
+        i = data.find(b'\n')
+        if i >= 0:
+            chunks.append(data[:i + 1])
+            break
+        elif not data:
+            break
+        chunks.append(data)
+        pos += len(data)
+    return b''.join(chunks)
+
+
+def iterLineRange(filename, start, end, indexPath = None):
+    '''iterate the lines beginning in the byte range [start, end) of the plain or blocked gzip file,
+    the range should begin at the line as given by getLineRanges'''
+    if not isGzipped(filename):
+        f_in = _open(filename, 'rb')
+        try:
+            f_in.seek(start)
+            pos = start
+            while pos < end:
+                line = f_in.readline()
+                if not line:
+                    break
+                pos += len(line)
+                yield line
+        finally:
+            f_in.close()
+        return
+    f_in = BlockedGzipReader(filename, indexPath, cacheSize = 2)
+    try:
+        readPos = start
+        pos = start
+        rest = b''
+        while pos < end:
+            data = f_in.read(readPos, GZIP_BLOCK_SIZE)
+            readPos += len(data)
+            if not data:
+                if rest:
+                    yield rest
+                break
+            lines = io.BytesIO(rest + data).readlines()
+            rest = b''
+            if lines[-1][-1:] != b'\n':
+                rest = lines.pop()
+            for line in lines:
+                if pos >= end:
+                    break
+                pos += len(line)
+                yield line
+    finally:
+        f_in.close()
+
+
 def getExt(filename):
     '''get the extension of given file'''
     (name, ext) = os.path.splitext(filename)
@@ -82,12 +772,13 @@ def getExt(filename):
 
 def isGzipped(filename):
     '''check whether the given file is compressed by gzip or not'''
-    try:
-        f = gzip.open(filename, 'r')
-        f.readline()
-        return True
-    except Exception as e:
-        return False
+    codec = getCodec(filename)
+    return codec != None and codec.name == 'gzip'
+
+
+def isCompressed(filename):
+    '''check whether the given file is compressed by any codec or not'''
+    return getCodec(filename) != None
 
 
 def load(filename, progress = True, bs = 10 * 1024 * 1024):
@@ -127,27 +818,49 @@ def mkdir(dirname, **options):
         return
     else:
         ops = {}
-        if options.has_key('mode'):
+        if 'mode' in options:
             ops['mode'] = options['mode']
         os.makedirs(dirname, **ops)
 
 
+def openBinary(filename, mode = 'rb'):
+    '''open the plain file or the stream of uncompressed data of the compressed one
+
+    the codec is detected by the magic bytes of the file to read, otherwise by the extension'''
+    if mode.find('r') >= 0:
+        codec = getCodec(filename) or getCodecByExt(filename)
+    else:
+        codec = getCodecByExt(filename) or getCodec(filename)
+    if codec:
+        return codec.open(filename, mode)
+    else:
+        return _open(filename, mode)
+
+
 def open(filename, mode = 'r'):
-    '''open the plain/compressed file transparently'''
-    if getExt(filename) == '.gz' or isGzipped(filename):
-        fileObj = gzip.open(filename, mode)
+    '''open the plain/compressed file transparently
+
+    gzipped files are written by ParallelGzipWriter,
+    and the other codecs (zstd/lz4/xz) are available if their modules are installed.
+    compressed files are read by ReadAheadReader if READ_AHEAD is set'''
+    codec = None
+    if READ_AHEAD and mode.find('r') >= 0 and mode.find('+') < 0:
+        codec = getCodec(filename)
+    if codec and codec.readAhead and codec.isAvailable():
+        fileObj = ReadAheadReader(filename, codec)
     else:
-        fileObj = _open(filename, mode)
+        fileObj = openBinary(filename, mode)
     if str is bytes:
         '''ascii-8 based strings (for python 2.X)'''
         return fileObj
     else:
         '''utf-8 based strings (for python 3.X)'''
-        if mode.find('r') >= 0:
+        if mode.find('b') >= 0 or isinstance(fileObj, (ParallelGzipWriter, io.TextIOBase)):
+            return fileObj
+        elif mode.find('r') >= 0:
             return codecs.getreader('utf-8')(fileObj)
         else:
-#            return codecs.getwriter('utf-8')(fileObj)
-            return fileObj
+            return codecs.getwriter('utf-8')(fileObj)
 
 
 def rawtell(fileobj):
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''classes mapping words and phrases to dense integer IDs'''
+
+import mmap
+import struct
+
+# header of vocabulary files, followed by the number of strings,
+# the offsets of the strings (one more than the number) and the string pool
+VOCAB_MAGIC = b'EXPVOC1\n'
+COUNT_FORMAT = '<q'
+OFFSET_FORMAT = '<q'
+COUNT_SIZE = struct.calcsize(COUNT_FORMAT)
+OFFSET_SIZE = struct.calcsize(OFFSET_FORMAT)
+
+class StringPool(object):
+    '''read-only sequence of strings memory-mapped from the vocabulary file
+
+    the vocabulary can be embedded in another file, beginning at given offset'''
+    def __init__(self, path, offset = 0):
+        self.poolFile = open(path, 'rb')
+        self.poolFile.seek(offset)
+        magic = self.poolFile.read(len(VOCAB_MAGIC))
+        if magic != VOCAB_MAGIC:
+            raise ValueError('not a vocabulary file: %s' % path)
+        self.count = struct.unpack(COUNT_FORMAT, self.poolFile.read(COUNT_SIZE))[0]
+        self.buf = mmap.mmap(self.poolFile.fileno(), 0, access = mmap.ACCESS_READ)
+        self.offsetPos = offset + len(VOCAB_MAGIC) + COUNT_SIZE
+        self.dataPos = self.offsetPos + (self.count + 1) * OFFSET_SIZE
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.count
+        if index < 0 or index >= self.count:
+            raise IndexError('index out of range')
+        (start, end) = struct.unpack_from('<2q', self.buf, self.offsetPos + index * OFFSET_SIZE)
+        string = self.buf[self.dataPos + start:self.dataPos + end]
+        if str is not bytes:
+            string = string.decode('utf-8')
+        return string
+
+    def __iter__(self):
+        for index in range(self.count):
+            yield self[index]
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        self.buf.close()
+        self.poolFile.close()
+
+
+class Vocabulary(object):
+    '''mapping between strings and dense integer IDs given in the order of addition
+
+    the strings loaded from the file stay in the memory-mapped pool,
+    and the map from strings to IDs is built on the first lookup'''
+    def __init__(self, path = None, offset = 0):
+        if path:
+            self.pool = StringPool(path, offset)
+        else:
+            self.pool = ()
+        # strings added after loading
+        self.words = []
+        self.ids = None
+
+    def __contains__(self, word):
+        return word in self.getIdMap()
+
+    def __len__(self):
+        return len(self.pool) + len(self.words)
+
+    def close(self):
+        if isinstance(self.pool, StringPool):
+            self.pool.close()
+            self.pool = ()
+
+    def getIdMap(self):
+        '''return the dictionary from strings to IDs'''
+        if self.ids == None:
+            self.ids = {}
+            for wordId, word in enumerate(self.pool):
+                self.ids[word] = wordId
+            for wordId, word in enumerate(self.words, len(self.pool)):
+                self.ids[word] = wordId
+        return self.ids
+
+    def getId(self, word, add = True):
+        '''return the ID of given string, adding it if not found and add is set, otherwise None'''
+        ids = self.getIdMap()
+        wordId = ids.get(word)
+        if wordId == None and add:
+            wordId = len(self)
+            self.words.append(word)
+            ids[word] = wordId
+        return wordId
+
+    def getIds(self, words, add = True):
+        '''return the tuple of IDs of given strings'''
+        return tuple([self.getId(word, add) for word in words])
+
+    def getWord(self, wordId):
+        '''return the string of given ID'''
+        if wordId < len(self.pool):
+            return self.pool[wordId]
+        else:
+            return self.words[wordId - len(self.pool)]
+
+    def getWords(self, wordIds):
+        '''return the list of strings of given IDs'''
+        return [self.getWord(wordId) for wordId in wordIds]
+
+    def save(self, path):
+        '''save all the strings into the vocabulary file keeping their IDs'''
+        saveFile = open(path, 'wb')
+        self.write(saveFile)
+        saveFile.close()
+
+    def write(self, saveFile):
+        '''write all the strings into the opened binary file keeping their IDs'''
+        count = len(self)
+        offsets = [0]
+        data = []
+        for wordId in range(count):
+            word = self.getWord(wordId)
+            if not isinstance(word, bytes):
+                word = word.encode('utf-8')
+            data.append(word)
+            offsets.append(offsets[-1] + len(word))
+        saveFile.write(VOCAB_MAGIC)
+        saveFile.write( struct.pack(COUNT_FORMAT, count) )
+        saveFile.write( struct.pack('<%dq' % len(offsets), *offsets) )
+        saveFile.write( b''.join(data) )
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''benchmark measuring the memory usage of loaded records'''
+
+import argparse
+import sys
+
+from exp.common import files
+from exp.phrasetable import record
+
+LIMIT = 100000
+
+def getDeepSize(obj, seen):
+    '''return the total size of the object and all the objects reachable from it, counting each once'''
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, val in obj.items():
+            size += getDeepSize(key, seen) + getDeepSize(val, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for item in obj:
+            size += getDeepSize(item, seen)
+    if hasattr(obj, '__dict__'):
+        size += getDeepSize(obj.__dict__, seen)
+    for cls in type(obj).__mro__:
+        for name in getattr(cls, '__slots__', ()):
+            if hasattr(obj, name):
+                size += getDeepSize(getattr(obj, name), seen)
+    return size
+
+def measure(tablePath, RecordClass = record.MosesRecord, limit = LIMIT):
+    '''load the records of the table, and return (number of records, average bytes per record)'''
+    tableFile = files.open(tablePath, 'r')
+    records = []
+    for line in tableFile:
+        if len(records) >= limit:
+            break
+        records.append( RecordClass(line) )
+    tableFile.close()
+    seen = set()
+    total = 0
+    for rec in records:
+        total += getDeepSize(rec, seen)
+    return (len(records), total / float(max(len(records), 1)))
+
+def main():
+    parser = argparse.ArgumentParser(description = 'measure the memory usage of records loaded from the table')
+    parser.add_argument('table', help = 'phrase/rule table to load')
+    parser.add_argument('--limit', help = 'number of records to load (default = %d)' % LIMIT, type = int, default = LIMIT)
+    parser.add_argument('--travatar', help = 'loading travatar rule table', action = 'store_true')
+    args = vars(parser.parse_args())
+
+    RecordClass = record.MosesRecord
+    if args['travatar']:
+        from exp.ruletable.record import TravatarRecord
+        RecordClass = TravatarRecord
+    (count, size) = measure(args['table'], RecordClass, args['limit'])
+    print("records: %d, bytes per record: %.1f" % (count, size))
+
+if __name__ == '__main__':
+    main()
@@ -2,11 +2,14 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+from exp.common.vocab import Vocabulary
 from exp.phrasetable import lex
 
 def combine_lex(lexfile1, lexfile2, savefile):
-    lexCounts1 = lex.loadWordPairCounts(lexfile1)
-    lexCounts2 = lex.loadWordPairCounts(lexfile2)
+    # sharing the word IDs between the two tables
+    vocab = Vocabulary()
+    lexCounts1 = lex.loadWordPairCounts(lexfile1, vocab)
+    lexCounts2 = lex.loadWordPairCounts(lexfile2, vocab)
     lexCounts = lex.combineWordPairCounts(lexCounts1, lexCounts2)
     lex.saveWordPairCounts(savefile, lexCounts)
 
@@ -0,0 +1,26 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import argparse
+from exp.phrasetable import lex
+
+def compile_lex(lexfile, binfile = None, probs = False, decompile = False):
+    if decompile:
+        lex.decompileLexicon(lexfile, binfile)
+    else:
+        lex.compileLexicon(lexfile, binfile, probs)
+
+def main():
+    parser = argparse.ArgumentParser(description = 'convert lex file into binary lexicon loaded automatically if placed as lexfile%s' % lex.BINARY_EXT)
+    parser.add_argument('lexfile', help = 'word pair counts file (or binary lexicon to decompile)')
+    parser.add_argument('binfile', nargs = '?', default = None,
+                        help = 'path for saving binary lexicon (default = lexfile%s), or text file to decompile into' % lex.BINARY_EXT)
+    parser.add_argument('--probs', action = 'store_true', help = 'converting word probs file (src trg egfl fgel)')
+    parser.add_argument('--decompile', action = 'store_true', help = 'converting binary lexicon back into text')
+    args = vars(parser.parse_args())
+    if args['decompile'] and not args['binfile']:
+        parser.error('binfile is required to decompile')
+    compile_lex(**args)
+
+if __name__ == '__main__':
+    main()
@@ -4,9 +4,12 @@
 '''phrase table filtering function'''
 
 import argparse
+import heapq
+import multiprocessing
 import os
 import pprint
 import re
+import shutil
 import sys
 import subprocess
 
@@ -23,57 +26,364 @@ if subprocess.call('which pv > /dev/null', shell = True) == 0:
 env = os.environ.copy()
 env['LC_ALL'] = 'C'
 
-def matchRules(rec, rules):
-    for rule in rules:
-        expr = re.sub('c\.c', str(rec.counts.co), rule)
-        #debug.log(expr)
-        if eval(expr):
-            #print("MATCH")
-            pass
+# variables of the rules and the python expressions giving their values from the record
+RULE_VARIABLES = {
+    'c.s': 'rec.counts.src',
+    'c.t': 'rec.counts.trg',
+    'c.c': 'rec.counts.co',
+    'l.s': 'len(rec.srcSymbols)',
+    'l.t': 'len(rec.trgSymbols)',
+}
+RULE_OPERATORS = ('<=', '>=', '==', '!=', '<', '>', '+', '-', '*', '/', '(', ')')
+RULE_COMPARISONS = ('<=', '>=', '==', '!=', '<', '>')
+RULE_TOKEN = re.compile(r'\s*(?:(?P<num>(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)|(?P<var>[A-Za-z_]\w*(?:\.\w+)?)|(?P<op><=|>=|==|!=|[<>+\-*/()]))')
+
+class RuleParser(object):
+    '''parser translating the rule into the python expression on the record
+
+    rule := or ; or := and ('or' and)* ; and := not ('and' not)* ; not := 'not' not | comparison
+    comparison := sum (cmp sum)* ; sum := product (('+'|'-') product)* ; product := unary (('*'|'/') unary)*
+    unary := ('-'|'+') unary | number | variable | '(' or ')'
+    variables are c.s, c.t, c.c (counts), l.s, l.t (numbers of symbols) and feature names (0 if missing)'''
+    def __init__(self, rule):
+        self.rule = rule
+        self.tokens = tokenizeRule(rule)
+        self.pos = 0
+
+    def error(self, message):
+        raise ValueError("invalid rule: '%s' (%s)" % (self.rule, message))
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return (None, None)
+
+    def take(self, value = None):
+        (kind, token) = self.peek()
+        if kind == None:
+            self.error("unexpected end")
+        if value != None and token != value:
+            self.error("expected '%s' but '%s'" % (value, token))
+        self.pos += 1
+        return (kind, token)
+
+    def parse(self):
+        expr = self.parseOr()
+        if self.pos < len(self.tokens):
+            self.error("unexpected '%s'" % self.peek()[1])
+        return expr
+
+    def parseOr(self):
+        exprs = [self.parseAnd()]
+        while self.peek() == ('var', 'or'):
+            self.take()
+            exprs.append( self.parseAnd() )
+        return '(%s)' % str.join(' or ', exprs)
+
+    def parseAnd(self):
+        exprs = [self.parseNot()]
+        while self.peek() == ('var', 'and'):
+            self.take()
+            exprs.append( self.parseNot() )
+        return '(%s)' % str.join(' and ', exprs)
+
+    def parseNot(self):
+        if self.peek() == ('var', 'not'):
+            self.take()
+            return '(not %s)' % self.parseNot()
+        return self.parseComparison()
+
+    def parseComparison(self):
+        exprs = [self.parseSum()]
+        while self.peek()[1] in RULE_COMPARISONS and self.peek()[0] == 'op':
+            exprs.append( self.take()[1] )
+            exprs.append( self.parseSum() )
+        return '(%s)' % str.join(' ', exprs)
+
+    def parseSum(self):
+        exprs = [self.parseProduct()]
+        while self.peek() in (('op', '+'), ('op', '-')):
+            exprs.append( self.take()[1] )
+            exprs.append( self.parseProduct() )
+        return '(%s)' % str.join(' ', exprs)
+
+    def parseProduct(self):
+        exprs = [self.parseUnary()]
+        while self.peek() in (('op', '*'), ('op', '/')):
+            op = self.take()[1]
+            # dividing as real numbers for the integer counts
+            exprs.append( '* 1.0 /' if op == '/' else op )
+            exprs.append( self.parseUnary() )
+        return '(%s)' % str.join(' ', exprs)
+
+    def parseUnary(self):
+        (kind, token) = self.take()
+        if kind == 'op' and token in ('-', '+'):
+            return '(%s%s)' % (token, self.parseUnary())
+        elif kind == 'op' and token == '(':
+            expr = self.parseOr()
+            self.take(')')
+            return expr
+        elif kind == 'num':
+            return repr( float(token) )
+        elif kind == 'var' and token in RULE_VARIABLES:
+            return RULE_VARIABLES[token]
+        elif kind == 'var' and token not in ('and', 'or', 'not') and token.find('.') < 0:
+            return 'rec.features.get(%s, 0)' % repr(token)
         else:
-            #print("MISMATCH")
-            return False
+            self.error("unexpected '%s'" % token)
+
+
+def tokenizeRule(rule):
+    '''split the rule into the list of (kind, token), kind is num/var/op'''
+    tokens = []
+    pos = 0
+    rule = rule.rstrip()
+    while pos < len(rule):
+        m = RULE_TOKEN.match(rule, pos)
+        if not m:
+            raise ValueError("invalid rule: '%s' (unknown token at %d)" % (rule, pos))
+        tokens.append( (m.lastgroup, m.group(m.lastgroup)) )
+        pos = m.end()
+    return tokens
+
+def compileRules(rules):
+    '''compile the rules into one predicate function on the record, true if all the rules match'''
+    exprs = [RuleParser(rule).parse() for rule in rules]
+    source = 'lambda rec: %s' % (str.join(' and ', exprs) or '1')
+    return eval( compile(source, '<rules>', 'eval'), {'__builtins__': {}, 'len': len} )
+
+def compileScore(by):
+    '''compile the expression of the variables (e.g. 'egfp', 'c.c' or '0.7 * egfp + 0.3 * fgep') into the score function on the record'''
+    source = 'lambda rec: %s' % RuleParser(by).parse()
+    return eval( compile(source, '<score>', 'eval'), {'__builtins__': {}, 'len': len} )
+
+def matchRules(rec, rules):
+    '''check whether the record matches all the rules (list of strings or compiled predicate)'''
+    if not callable(rules):
+        rules = compileRules(rules)
+    return rules(rec)
+
+def filterLines(lines, outputs, predicates, RecordClass = record.MosesRecord):
+    '''write the original lines of the records into the binary outputs whose predicates match,
+    parsing each record only once'''
+    targets = list( zip(predicates, outputs) )
+    pool = record.RecordPool(RecordClass)
+    for line in lines:
+        rec = pool.get(line)
+        for predicate, output in targets:
+            if predicate(rec):
+                if line[-1:] != b'\n':
+                    line += b'\n'
+                output.write(line)
+        pool.release(rec)
+
+def filterTable(srcFile, saveFile, rules, progress, RecordClass = record.MosesRecord, jobs = 1):
+    '''write the records matching all the rules as their original lines'''
+    filterTables(srcFile, [(saveFile, rules)], progress, RecordClass, jobs)
+
+def filterTables(srcFile, outputs, progress, RecordClass = record.MosesRecord, jobs = 1):
+    '''write the records matching each set of rules into its own output in a single pass over the table
+
+    outputs is the list of (saveFile, rules), and every record is checked by all the compiled rule sets.
+    with multiple jobs, the plain or blocked gzip table given by the path is split into the ranges of lines
+    filtered by the worker processes, and the outputs are concatenated in order'''
+    predicates = [compileRules(rules) for (saveFile, rules) in outputs]
+    if jobs > 1 and type(srcFile) == str and all(type(saveFile) == str for (saveFile, rules) in outputs):
+        if filterTableParallel(srcFile, outputs, RecordClass, jobs):
+            return
+    if type(srcFile) == str:
+        srcFile = files.open(srcFile, 'rb')
+    saveFiles = [openSaveFile(saveFile) for (saveFile, rules) in outputs]
+    streams = list(saveFiles)
+    pipePV = None
+    # pv shows the progress of the single output, and can write only into the real file, not into the compressing writer
+    if progress and len(saveFiles) == 1 and not isCompressedPath(outputs[0][0]):
+        pipePV = pipeProgress(saveFiles[0])
+        if pipePV:
+            streams = [pipePV.stdin]
+    filterLines(srcFile, streams, predicates, RecordClass)
+    if pipePV:
+        pipePV.stdin.close()
+        pipePV.communicate()
+    for saveFile in saveFiles:
+        saveFile.close()
+
+def openSaveFile(saveFile):
+    '''open the output path as the binary file (compressed by the codec of the extension)'''
+    if type(saveFile) != str:
+        return saveFile
+    if files.getCodecByExt(saveFile) != None:
+        return files.open(saveFile, 'wb')
+    return open(saveFile, 'wb')
+
+def isCompressedPath(saveFile):
+    return type(saveFile) == str and files.getCodecByExt(saveFile) != None
+
+def pipeProgress(saveFile):
+    '''start pv counting the lines written into the plain output file, returning None if unavailable'''
+    if not PV or not hasattr(saveFile, 'fileno'):
+        return None
+    cmd = '%s -Wl -N "filtered lines"' % (PV)
+    return subprocess.Popen(cmd, env=env, stdin=subprocess.PIPE, stdout=saveFile, close_fds=True, shell=True)
+
+def filterTableParallel(srcPath, outputs, RecordClass, jobs):
+    '''filter the ranges of the table in the worker processes, returning False if the table can not be split'''
+    indexPath = None
+    tmpIndexPath = None
+    savePaths = [saveFile for (saveFile, rules) in outputs]
+    if files.isGzipped(srcPath):
+        # splitting by the block index of the blocked gzip
+        indexPath = srcPath + files.GZIP_INDEX_EXT
+        if not os.path.exists(indexPath):
+            indexPath = tmpIndexPath = savePaths[0] + files.GZIP_INDEX_EXT
+            if not files.makeGzipIndex(srcPath, indexPath):
+                return False
+    elif files.isCompressed(srcPath):
+        return False
+    procs = []
+    rangeParts = []
+    for index, (start, end) in enumerate(files.getLineRanges(srcPath, jobs, indexPath)):
+        parts = []
+        for (savePath, rules) in outputs:
+            parts.append( ('%s.%d' % (savePath, index), rules, files.getCodecByExt(savePath)) )
+        args = (srcPath, start, end, parts, RecordClass, indexPath)
+        procs.append( multiprocessing.Process(target = filterRange, args = args) )
+        rangeParts.append( [partPath for (partPath, rules, codec) in parts] )
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
+    if tmpIndexPath:
+        os.remove(tmpIndexPath)
+    for proc, partPaths in zip(procs, rangeParts):
+        if proc.exitcode != 0:
+            raise RuntimeError("failed to filter the records into: %s" % str.join(', ', partPaths))
+    # concatenating the outputs of the workers in order,
+    # the compressed ones are joined as they are (multi-member gzip or multi-frame stream)
+    for i, savePath in enumerate(savePaths):
+        saveFile = open(savePath, 'wb')
+        for partPaths in rangeParts:
+            partFile = open(partPaths[i], 'rb')
+            shutil.copyfileobj(partFile, saveFile, files.GZIP_BLOCK_SIZE)
+            partFile.close()
+            os.remove(partPaths[i])
+        saveFile.close()
     return True
 
-def filterTable(srcFile, saveFile, rules, progress, RecordClass = record.MosesRecord):
+def filterRange(srcPath, start, end, parts, RecordClass, indexPath = None):
+    '''filter the records in the byte range [start, end) of the table,
+    writing them into the part files given as the list of (partPath, rules, codec)'''
+    partFiles = []
+    for (partPath, rules, codec) in parts:
+        if codec:
+            partFiles.append( codec.open(partPath, 'wb') )
+        else:
+            partFiles.append( open(partPath, 'wb') )
+    predicates = [compileRules(rules) for (partPath, rules, codec) in parts]
+    lines = files.iterLineRange(srcPath, start, end, indexPath)
+    filterLines(lines, partFiles, predicates, RecordClass)
+    for partFile in partFiles:
+        partFile.close()
+
+def pruneLines(lines, output, nbest, score, predicate = None, RecordClass = record.MosesRecord):
+    '''write the original lines of the n-best records of each source phrase by the score, keeping their order
+
+    the lines should be grouped by the source phrases (as the sorted table),
+    and only the n-best lines of the current source are held in the heap'''
+    pool = record.RecordPool(RecordClass)
+    src = None
+    heap = []
+    index = 0
+    for line in lines:
+        rec = pool.get(line)
+        if rec.src != src:
+            writeBestLines(output, heap)
+            heap = []
+            src = rec.src
+        if predicate == None or predicate(rec):
+            if line[-1:] != b'\n':
+                line += b'\n'
+            # the later line is dropped first among the same scores
+            item = (score(rec), -index, line)
+            if len(heap) < nbest:
+                heapq.heappush(heap, item)
+            else:
+                heapq.heappushpop(heap, item)
+        index += 1
+        pool.release(rec)
+    writeBestLines(output, heap)
+
+def writeBestLines(output, heap):
+    '''write the lines held in the heap of (score, -index, line) in their original order'''
+    for (score, index, line) in sorted(heap, reverse = True, key = lambda item: item[1]):
+        output.write(line)
+
+def pruneTable(srcFile, saveFile, nbest, by, rules, progress, RecordClass = record.MosesRecord):
+    '''write the n-best records of each source phrase scored by the expression, among the ones matching all the rules'''
+    if nbest <= 0:
+        raise ValueError("n-best size should be positive: %s" % nbest)
+    score = compileScore(by)
+    predicate = compileRules(rules) if rules else None
     if type(srcFile) == str:
-      srcFile = files.open(srcFile)
-    if type(saveFile) == str:
-      if files.getExt(saveFile) == '.gz':
-        saveFile = open(saveFile, 'w')
-        pipeGzip = subprocess.Popen(['gzip'], stdin=subprocess.PIPE, stdout=saveFile)
-        saveFile = pipeGzip.stdin
-      else:
-        saveFile = open(saveFile, 'w')
+        srcFile = files.open(srcFile, 'rb')
+    compressed = isCompressedPath(saveFile)
+    saveFile = openSaveFile(saveFile)
+    output = saveFile
     pipePV = None
-    if progress and PV:
-        cmd = '%s -Wl -N "filtered lines"' % (PV)
-        pipePV = subprocess.Popen(cmd, env=env, stdin=subprocess.PIPE, stdout=saveFile, close_fds=True, shell=True)
-        output = pipePV.stdin
-    else:
-        output = saveFile
-    for line in srcFile:
-      rec = RecordClass(line)
-      if matchRules(rec, rules):
-          output.write( rec.toStr() )
+    if progress and not compressed:
+        pipePV = pipeProgress(saveFile)
+        if pipePV:
+            output = pipePV.stdin
+    pruneLines(srcFile, output, nbest, score, predicate, RecordClass)
     if pipePV:
         pipePV.stdin.close()
         pipePV.communicate()
     saveFile.close()
 
-def filterMosesTable(srcFile, saveFile, rules, progress = True):
-    filterTable(srcFile, saveFile, rules, progress, record.MosesRecord)
+def getOutputs(saveFile, rules, output):
+    '''make the list of (saveFile, rules) from the main output and the additional ones given as [saveFile, rule, ...]'''
+    outputs = [(saveFile, rules)]
+    for args in output or []:
+        if len(args) < 2:
+            raise ValueError("no rule is given for the output: %s" % args[0])
+        outputs.append( (args[0], args[1:]) )
+    return outputs
+
+def filterMosesTable(srcFile, saveFile, rules, progress = True, jobs = 1, output = None, nbest = 0, by = 'egfp'):
+    if nbest > 0:
+        pruneTable(srcFile, saveFile, nbest, by, rules, progress, record.MosesRecord)
+    else:
+        filterTables(srcFile, getOutputs(saveFile, rules, output), progress, record.MosesRecord, jobs)
+
+def checkArgs(parser, args):
+    '''report the invalid combination of the command line arguments'''
+    if args['nbest'] > 0:
+        if args['output']:
+            parser.error('--output can not be used with --nbest')
+        if args['jobs'] > 1:
+            parser.error('--jobs can not be used with --nbest')
+    elif not args['rules']:
+        parser.error('at least one rule is required without --nbest')
 
 def main():
     epilog = '''
-each rule should be as '{varname} {<,<=,==,>=,>} {value}'
+each rule should be as '{varname} {<,<=,==,!=,>=,>} {value}',
+combined with and/or/not, parentheses and arithmetic operators (+,-,*,/)
 varnames:
     c.s : source count
     c.t : target count
     c.c : co-occurrence count
+    l.s : source phrase length
+    l.t : target phrase length
+    egfp, fgep, egfl, fgel, ... : features (0 if missing)
+all the rules should be matched to save the record
+with --nbest, the n-best records of each source by the score expression of --by are saved among them
 example:
-    %s model/phrase-table.gz model/filtered-table.gz 'c.c > 1'
-    ''' % sys.argv[0]
+    %s model/phrase-table.gz model/filtered-table.gz 'c.c > 1' 'egfp >= 0.01 or c.s < 10'
+    %s model/phrase-table.gz model/c1-table.gz 'c.c > 1' -o model/c2-table.gz 'c.c > 2' -o model/c3-table.gz 'c.c > 3'
+    %s model/phrase-table.gz model/best-table.gz 'c.c > 1' --nbest 20 --by '0.7 * egfp + 0.3 * fgep'
+    ''' % (sys.argv[0], sys.argv[0], sys.argv[0])
     parser = argparse.ArgumentParser(
         formatter_class=argparse.RawDescriptionHelpFormatter,
         description='filter moses phrase-table by supplied rules',
@@ -81,10 +391,19 @@ example:
     )
     parser.add_argument('srcFile',  help='file path to load phrase-table')
     parser.add_argument('saveFile', help='file path to save phrase-table')
-    parser.add_argument('rules', metavar='rule', nargs='+', help='filtering rule to save record')
+    parser.add_argument('rules', metavar='rule', nargs='*', help='filtering rule to save record')
     parser.add_argument('--progress', '-p', action='store_true',
                         help='show progress bar (pv command should be installed')
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+                        help='number of worker processes filtering the ranges of plain or blocked gzip table (default = 1)')
+    parser.add_argument('--output', '-o', nargs='+', action='append', metavar=('SAVEFILE', 'RULE'),
+                        help='additional file path to save the records matching its own rules, in the same pass')
+    parser.add_argument('--nbest', '-n', type=int, default=0,
+                        help='number of records to save for each source, the table should be sorted by the sources')
+    parser.add_argument('--by', default='egfp',
+                        help='score expression of the variables to choose the n-best records (default = egfp)')
     args = vars(parser.parse_args())
+    checkArgs(parser, args)
     #print(args)
     filterMosesTable(**args)
 
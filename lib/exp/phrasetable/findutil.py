@@ -1,32 +1,331 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import hashlib
+import io
+import mmap
+import os
+import struct
 import sys
 
-def saveIndices(tablePath, indexPath):
-    tableFile = open(tablePath, 'r')
-    indexFile = open(indexPath, 'w')
+from exp.common import files
+
+# header of binary index files, followed by packed little-endian int64 offsets
+INDEX_MAGIC = b'EXPIDX1\n'
+OFFSET_FORMAT = '<q'
+OFFSET_SIZE = struct.calcsize(OFFSET_FORMAT)
+
+# header of phrase index files, followed by the number of slots and entries
+PHRASE_INDEX_MAGIC = b'EXPPHX1\n'
+PHRASE_HEADER_FORMAT = '<qq'
+PHRASE_HEADER_SIZE = len(PHRASE_INDEX_MAGIC) + struct.calcsize(PHRASE_HEADER_FORMAT)
+# hash slot of (phrase hash, byte offset, byte length, record count), length 0 for empty slot
+SLOT_FORMAT = '<Qqqq'
+SLOT_SIZE = struct.calcsize(SLOT_FORMAT)
+# maximum ratio of used slots in the hash table
+LOAD_FACTOR = 0.5
+
+# size of chunks to scan for newlines
+BUFFER_SIZE = 16 * 1024 * 1024
+
+class Indices(object):
+    '''read-only sequence of line offsets memory-mapped from the binary index file'''
+    def __init__(self, indexPath):
+        self.indexFile = open(indexPath, 'rb')
+        size = os.fstat(self.indexFile.fileno()).st_size
+        self.count = (size - len(INDEX_MAGIC)) // OFFSET_SIZE
+        if self.count > 0:
+            self.buf = mmap.mmap(self.indexFile.fileno(), 0, access = mmap.ACCESS_READ)
+        else:
+            self.count = 0
+            self.buf = None
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.count
+        if index < 0 or index >= self.count:
+            raise IndexError('index out of range')
+        return struct.unpack_from(OFFSET_FORMAT, self.buf, len(INDEX_MAGIC) + index * OFFSET_SIZE)[0]
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        if self.buf:
+            self.buf.close()
+            self.buf = None
+        self.indexFile.close()
+
+
+class PhraseIndex(object):
+    '''on-disk open-addressing hash table mapping source phrases to the blocks of their records'''
+    def __init__(self, indexPath):
+        self.indexFile = open(indexPath, 'rb')
+        magic = self.indexFile.read(len(PHRASE_INDEX_MAGIC))
+        if magic != PHRASE_INDEX_MAGIC:
+            raise ValueError('not a phrase index file: %s' % indexPath)
+        header = self.indexFile.read(struct.calcsize(PHRASE_HEADER_FORMAT))
+        (self.numSlots, self.count) = struct.unpack(PHRASE_HEADER_FORMAT, header)
+        self.buf = mmap.mmap(self.indexFile.fileno(), 0, access = mmap.ACCESS_READ)
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        self.buf.close()
+        self.indexFile.close()
+
+    def lookup(self, phrase):
+        '''return (offset, length, count) of the records for given phrase, or None if not found'''
+        h = getPhraseHash(phrase)
+        mask = self.numSlots - 1
+        slot = h & mask
+        while True:
+            entry = struct.unpack_from(SLOT_FORMAT, self.buf, PHRASE_HEADER_SIZE + slot * SLOT_SIZE)
+            if entry[2] == 0:
+                return None
+            elif entry[0] == h:
+                return entry[1:]
+            slot = (slot + 1) & mask
+
+
+class MappedTable(object):
+    '''searcher over the memory-mapped table sorted by source phrases
+
+    with the phrase index, one hash probe finds the records,
+    otherwise the raw keys are compared in place, slicing only as many bytes as the key has.
+    blocked gzip table is sliced through files.BlockedGzipReader with given block index (default: tablePath.gzi).
+    if binary is set, the lines are given as bytes without decoding (for python 3.X)'''
+    def __init__(self, tablePath, indices = None, phrases = None, blockIndex = None, binary = False):
+        self.binary = binary
+        if isinstance(indices, (bytes, str, type(u''))):
+            # given the path of index file
+            indices = loadIndices(indices)
+        if isinstance(phrases, (bytes, str, type(u''))):
+            phrases = PhraseIndex(phrases)
+        self.indices = indices
+        self.phrases = phrases
+        codec = files.getCodec(tablePath)
+        if codec and codec.name != 'gzip':
+            raise IOError("random access needs plain or blocked gzip table: %s" % tablePath)
+        elif codec:
+            self.tableFile = None
+            self.buf = files.BlockedGzipReader(tablePath, blockIndex)
+            self.size = len(self.buf)
+            return
+        self.tableFile = open(tablePath, 'rb')
+        self.size = os.fstat(self.tableFile.fileno()).st_size
+        if self.size > 0:
+            self.buf = mmap.mmap(self.tableFile.fileno(), 0, access = mmap.ACCESS_READ)
+        else:
+            self.buf = b''
+
+    def close(self):
+        if self.size > 0 or not self.tableFile:
+            self.buf.close()
+        if self.tableFile:
+            self.tableFile.close()
+        if hasattr(self.indices, 'close'):
+            self.indices.close()
+        if self.phrases:
+            self.phrases.close()
+
+    def getKey(self, phrase):
+        if not isinstance(phrase, bytes):
+            phrase = phrase.encode('utf-8')
+        return phrase + b' |||'
+
+    def lowerBound(self, key, start = 0):
+        '''return the index of the first line not less than the key'''
+        buf = self.buf
+        indices = self.indices
+        size = len(key)
+        end = len(indices)
+        while start < end:
+            mid = (start + end) // 2
+            pos = indices[mid]
+            if buf[pos:pos+size] < key:
+                start = mid + 1
+            else:
+                end = mid
+        return start
+
+    def upperBound(self, key, start = 0):
+        '''return the index of the first line greater than the key'''
+        buf = self.buf
+        indices = self.indices
+        size = len(key)
+        end = len(indices)
+        while start < end:
+            mid = (start + end) // 2
+            pos = indices[mid]
+            if buf[pos:pos+size] <= key:
+                start = mid + 1
+            else:
+                end = mid
+        return start
+
+    def getPos(self, index):
+        if index < len(self.indices):
+            return self.indices[index]
+        else:
+            return self.size
+
+    def locate(self, phrase):
+        '''return the (start, end) offsets of the block of all the lines having given source phrase,
+        or None if not found (the start offset identifies the phrase in the table)'''
+        key = self.getKey(phrase)
+        if self.phrases:
+            entry = self.phrases.lookup(key[:-4])
+            if not entry:
+                return None
+            (start, length, count) = entry
+            if self.buf[start:start+len(key)] != key:
+                # colliding hash of another phrase
+                return None
+            return (start, start + length)
+        first = self.lowerBound(key)
+        start = self.getPos(first)
+        if self.buf[start:start+len(key)] != key:
+            return None
+        last = self.upperBound(key, first)
+        return (start, self.getPos(last))
+
+    def search(self, phrase):
+        '''return the block of all the lines having given source phrase as one contiguous slice'''
+        span = self.locate(phrase)
+        if not span:
+            return b''
+        return self.buf[span[0]:span[1]]
+
+    def getLines(self, start, end):
+        '''return the list of lines in the block of given offsets'''
+        block = self.buf[start:end]
+        if str is not bytes and not self.binary:
+            block = block.decode('utf-8')
+        return block.splitlines()
+
+    def searchLines(self, phrase):
+        '''return the list of lines having given source phrase'''
+        span = self.locate(phrase)
+        if not span:
+            return []
+        return self.getLines(span[0], span[1])
+
+
+def iterOffsets(tableFile, bs = BUFFER_SIZE):
+    '''yield the lists of line offsets, scanning the table in large chunks for newlines'''
+    pos = 0
+    # start position of the line following the last newline
+    nextStart = 0
     while True:
-        pos = tableFile.tell()
-        if tableFile.readline() == '':
+        buf = tableFile.read(bs)
+        if not buf:
             break
-        indexFile.write("%s\n" % pos)
+        offsets = []
+        if nextStart == pos:
+            offsets.append(pos)
+        last = len(buf) - 1
+        i = buf.find(b'\n')
+        while i >= 0:
+            if i < last:
+                offsets.append(pos + i + 1)
+            else:
+                # the line begins in the next chunk, if any data follows
+                nextStart = pos + len(buf)
+            i = buf.find(b'\n', i + 1)
+        pos += len(buf)
+        if offsets:
+            yield offsets
+
+def openTable(tablePath):
+    '''open the table as binary stream, expanding compressed one (giving the uncompressed offsets)'''
+    return files.openBinary(tablePath, 'rb')
+
+def saveIndices(tablePath, indexPath):
+    '''save the byte offsets of all the lines in the table as the binary index file'''
+    tableFile = openTable(tablePath)
+    indexFile = open(indexPath, 'wb')
+    indexFile.write(INDEX_MAGIC)
+    for offsets in iterOffsets(tableFile):
+        indexFile.write( struct.pack('<%dq' % len(offsets), *offsets) )
+    indexFile.close()
+    tableFile.close()
 
 def makeIndices(tablePath):
-    tableFile = open(tablePath, 'r')
+    tableFile = openTable(tablePath)
     indices = []
-    while True:
-        pos = fobj.tell()
-        if tableFile.readline() == '':
-            break
-        indices.append( pos )
+    for offsets in iterOffsets(tableFile):
+        indices.extend(offsets)
+    tableFile.close()
     return indices
 
+def getPhraseHash(phrase):
+    '''return the stable 64-bit hash of given phrase'''
+    if not isinstance(phrase, bytes):
+        phrase = phrase.encode('utf-8')
+    return struct.unpack('<Q', hashlib.md5(phrase).digest()[:8])[0]
+
+def iterPhraseBlocks(tableFile):
+    '''yield (phrase, offset, length, count) for each group of records having the common source phrase'''
+    phrase = None
+    start = 0
+    pos = 0
+    count = 0
+    for line in tableFile:
+        key = line[:line.find(b' |||')]
+        if key != phrase:
+            if count > 0:
+                yield (phrase, start, pos - start, count)
+            phrase = key
+            start = pos
+            count = 0
+        count += 1
+        pos += len(line)
+    if count > 0:
+        yield (phrase, start, pos - start, count)
+
+def savePhraseIndex(tablePath, indexPath):
+    '''save the hash table of source phrases giving the offset, length and number of their records'''
+    tableFile = openTable(tablePath)
+    entries = io.BytesIO()
+    for (phrase, offset, length, count) in iterPhraseBlocks(tableFile):
+        entries.write( struct.pack(SLOT_FORMAT, getPhraseHash(phrase), offset, length, count) )
+    tableFile.close()
+    entries = entries.getvalue()
+    numEntries = len(entries) // SLOT_SIZE
+    numSlots = 1
+    while numSlots * LOAD_FACTOR < numEntries + 1:
+        numSlots *= 2
+    mask = numSlots - 1
+    indexFile = open(indexPath, 'w+b')
+    indexFile.write(PHRASE_INDEX_MAGIC)
+    indexFile.write( struct.pack(PHRASE_HEADER_FORMAT, numSlots, numEntries) )
+    indexFile.truncate(PHRASE_HEADER_SIZE + numSlots * SLOT_SIZE)
+    buf = mmap.mmap(indexFile.fileno(), 0)
+    pos = 0
+    while pos < len(entries):
+        entry = struct.unpack_from(SLOT_FORMAT, entries, pos)
+        slot = entry[0] & mask
+        while struct.unpack_from(SLOT_FORMAT, buf, PHRASE_HEADER_SIZE + slot * SLOT_SIZE)[2] != 0:
+            slot = (slot + 1) & mask
+        struct.pack_into(SLOT_FORMAT, buf, PHRASE_HEADER_SIZE + slot * SLOT_SIZE, *entry)
+        pos += SLOT_SIZE
+    buf.close()
+    indexFile.close()
+
 def loadIndices(indexPath):
-    indexFile = open(indexPath, 'r')
+    '''load the binary index file as memory-mapped sequence, or the text index file as list'''
+    indexFile = open(indexPath, 'rb')
+    magic = indexFile.read(len(INDEX_MAGIC))
+    if magic == INDEX_MAGIC:
+        indexFile.close()
+        return Indices(indexPath)
+    indexFile.seek(0)
     indices = []
     for line in indexFile:
         indices.append( int(line.strip()) )
+    indexFile.close()
     return indices
 
 def getRecLine(tableFile, indices, index):
@@ -35,68 +334,39 @@ def getRecLine(tableFile, indices, index):
     return tableFile.readline().strip()
 
 def getKey(recLine):
-    fields = recLine.split('|||')
-    return fields[0].strip() + ' |||'
-
-def getCommon(tableFile, indices, index):
-    '''return the list of records having the common phrase with given index'''
-    recLine = getRecLine(tableFile, indices, index)
-    src = getKey(recLine)
-    recLines = [ recLine ]
-    i = 1
-    while True:
-        if index - i < 0:
-            break
-        recLine = getRecLine(tableFile, indices, index - i)
-        if getKey(recLine) == src:
-            recLines.insert(0, recLine)
-            i += 1
-        else:
-            break
-    i = 1
-    while True:
-        if index + i >= len(indices):
-            break
-        recLine = getRecLine(tableFile, indices, index + i)
-        if getKey(recLine) == src:
-            recLines.append(recLine)
-            i += 1
-        else:
-            break
-    return recLines
+    fields = recLine.split(b'|||')
+    return fields[0].strip() + b' |||'
 
 def searchIndexed(tableFile, indices, srcPhrase):
+    '''return the lines having given source phrase in the table file opened as binary,
+    comparing the keys as bytes in the same order as "LC_ALL=C sort"'''
+    if not isinstance(srcPhrase, bytes):
+        srcPhrase = srcPhrase.encode('utf-8')
     # search key should be "srcPhrase |||"
-    key = srcPhrase + ' |||'
-    def binsearch(start, end):
-        #print(start, end, src_phrase, len(indices) )
-        if start > end or start < 0 or end >= len(indices):
-            return []
-        if start == end:
-            recLine = getRecLine(tableFile, indices, start)
-            if getKey(recLine) == key:
-                return getCommon(tableFile, indices, start)
-            else:
-                return []
-        mid = (start + end) / 2
-        midRec = getRecLine(tableFile, indices, mid)
-        midKey = getKey(midRec)
-        #print("MID = %d: %s" % (mid, mid_key))
-        if midKey == key:
-            return getCommon(tableFile, indices, mid)
-        elif midKey < key:
-            return binsearch(mid + 1, end)
+    key = srcPhrase + b' |||'
+    # finding the first record not less than the key
+    start = 0
+    end = len(indices)
+    while start < end:
+        mid = (start + end) // 2
+        if getKey(getRecLine(tableFile, indices, mid)) < key:
+            start = mid + 1
         else:
-            return binsearch(start, mid - 1)
-    return binsearch(0, len(indices) - 1)
+            end = mid
+    recLines = []
+    while start < len(indices):
+        recLine = getRecLine(tableFile, indices, start)
+        if getKey(recLine) != key:
+            break
+        recLines.append(recLine)
+        start += 1
+    return recLines
 
 
 def main():
-    indexFile = open(sys.argv[2])
-    indices = loadIndices(indexFile)
-    found = searchIndexed(open(sys.argv[1]), indices, sys.argv[3])
+    indices = loadIndices(sys.argv[2])
+    found = searchIndexed(open(sys.argv[1], 'rb'), indices, sys.argv[3])
     print(found)
 
 if __name__ == '__main__':
     main()
-
@@ -15,13 +15,12 @@ import time
 from collections import defaultdict
 
 # my exp libs
-from exp.common import cache, debug, files, progress
+from exp.common import cache, debug, extsort, files, progress
 from exp.phrasetable import findutil
 from exp.phrasetable import lex
 from exp.phrasetable import triangulate
 from exp.phrasetable.record import MosesRecord
 from exp.phrasetable.record import RecordReader
-from exp.phrasetable.reverse import reverseTable
 
 # limit number of records for the same source phrase
 NBEST = 20
@@ -39,12 +38,18 @@ pp = pprint.PrettyPrinter()
 
 
 def integrateTablePair(tablePath1, tablePath2, savePath, **options):
+    '''merge the records of the tables, writing into the path or the file-like object
+
+    the tables are read as binary, so the source phrases are compared in the same order as "LC_ALL=C sort"'''
     RecordClass = options.get('RecordClass', MosesRecord)
 #    method = options.get('method', 'count')
 
     recReader1 = RecordReader(tablePath1, **options)
     recReader2 = RecordReader(tablePath2, **options)
-    saveFile = files.open(savePath, 'w')
+    if type(savePath) == str:
+        saveFile = files.open(savePath, 'wb')
+    else:
+        saveFile = savePath
 
     records1 = recReader1.getRecords()
     records2 = recReader2.getRecords()
@@ -60,8 +65,8 @@ def integrateTablePair(tablePath1, tablePath2, savePath, **options):
             records1 = recReader1.getRecords()
             continue
 
-        key1 = records1[0].src + ' |||'
-        key2 = records2[0].src + ' |||'
+        key1 = records1[0].src + b' |||'
+        key2 = records2[0].src + b' |||'
         if key1 < key2:
             triangulate.writeRecords(saveFile, records1)
             records1 = recReader1.getRecords()
@@ -73,7 +78,8 @@ def integrateTablePair(tablePath1, tablePath2, savePath, **options):
             triangulate.writeRecords(saveFile, merged)
             records1 = recReader1.getRecords()
             records2 = recReader2.getRecords()
-    saveFile.close()
+    if type(savePath) == str:
+        saveFile.close()
 
 
 def mergeRecords(*recListList, **options):
@@ -84,7 +90,7 @@ def mergeRecords(*recListList, **options):
     merged = {}
     for records in recListList:
         for recNew in records:
-            trgKey = recNew.trg + ' |||'
+            trgKey = recNew.trg + b' |||'
             if not trgKey in merged:
                 recMerge = RecordClass()
                 recMerge.src = recNew.src
@@ -132,6 +138,10 @@ def integrate(table1, table2, savefile, **options):
     lexPath   = options.get('lexfile', None)
     method    = options.get('method', METHOD)
     lexMethod = options.get('lexmethod', LEX_METHOD)
+    codec     = options.get('intermediate_codec', None)
+    if codec:
+        codec = files.getCodecByName(codec)
+    ext = codec.ext if codec else ''
 
     if lexMethod not in ('interpolate'):
         if lexPath == None:
@@ -141,45 +151,47 @@ def integrate(table1, table2, savefile, **options):
     # making work directory
     workdir = workdir + '/integrate'
     files.mkdir(workdir)
-    mergePath = "%s/%s_merged" % (workdir, prefix)
-    revPath   = "%s/%s_reversed" % (workdir, prefix)
-    trgCountPath = "%s/%s_trg" % (workdir, prefix)
-    revTrgCountPath = "%s/%s_trgrev" % (workdir, prefix)
-    countPath = "%s/%s_pprob" % (workdir, prefix)
-    # merging by summing co-occurrence counts
-    progress.log("merging records into: %s\n" % mergePath)
-    integrateTablePair(table1, table2, mergePath, **options)
-    progress.log("merged table\n")
+    mergePath = "%s/%s_merged%s" % (workdir, prefix, ext)
+    revPath   = "%s/%s_reversed%s" % (workdir, prefix, ext)
+    sortedPath = "%s/%s_sorted%s" % (workdir, prefix, ext)
+    countPath = "%s/%s_pprob%s" % (workdir, prefix, ext)
 #    # load word translation probabilities
 #    progress.log("loading word trans probabilities\n")
 #    lexCounts = lex.loadWordPairCounts(lexfile)
-    # reversing the table
     if method == 'count':
-        progress.log("reversing %s table into: %s\n" % (prefix, revPath) )
-        reverseTable(mergePath, revPath, RecordClass)
-        progress.log("reversed table\n")
-        # estimate backward trans probs for reversed table
-        progress.log("calculating reversed phrase trans probs into: %s\n" % (trgCountPath))
-        triangulate.calcPhraseTransProbsOnTable(revPath, trgCountPath, RecordClass = RecordClass)
-        progress.log("calculated reversed phrase trans probs\n")
-        # reversing the table again
-        progress.log("reversing %s table into: %s\n" % (prefix,revTrgCountPath))
-        reverseTable(trgCountPath, revTrgCountPath, RecordClass)
-        progress.log("reversed table\n")
-        # estimate forward trans probs
-        progress.log("calculating phrase trans probs into: %s\n" % (countPath))
-        triangulate.calcPhraseTransProbsOnTable(revTrgCountPath, countPath, RecordClass = RecordClass)
-      #  triangulate.calcPhraseTransProbsOnTable(revTrgCountPath, savefile, nbest = 0, RecordClass = RecordClass)
-        progress.log("calculated phrase trans probs\n")
+        # merging by summing co-occurrence counts, writing the reversed records and totaling the target counts
+        progress.log("merging reversed records into: %s\n" % revPath)
+        revWriter = triangulate.ReversedTableWriter(revPath, RecordClass, tmpdir = workdir)
+        integrateTablePair(table1, table2, revWriter, **options)
+        revWriter.close()
+        progress.log("merged table\n")
+        # estimate backward trans probs reversing back the records
+        lines = triangulate.iterBackwardRecords(revPath, revWriter.getTotals(), RecordClass)
+        if not revWriter.sorted:
+            # the merged records are out of the order if the tables are not sorted
+            progress.log("sorting records into: %s\n" % sortedPath)
+            extsort.sortLines(lines, sortedPath, tmpdir = workdir, codec = codec)
+            lines = files.open(sortedPath, 'rb')
         if lexMethod == 'interpolate':
-            progress.log("gzipping into: %s\n" % savefile)
-            files.autoCat(countPath, savefile)
+            tablePath = savefile
         else:
+            tablePath = countPath
+        # estimate forward trans probs, source counts are totaled by the groups of records
+        progress.log("calculating phrase trans probs into: %s\n" % (tablePath))
+        saveFile = files.open(tablePath, 'wb')
+        triangulate.calcPhraseTransProbsOnLines(lines, saveFile, RecordClass)
+        saveFile.close()
+        progress.log("calculated phrase trans probs\n")
+        if lexMethod != 'interpolate':
             # estimate lexicalized trans probs
             progress.log("calculating lex weights into: %s\n" % workset.savePath)
             calcLexWeights(countPath, lexCounts, savefile, RecordClass)
             progress.log("calculated lex weights\n")
     elif method == 'interpolate':
+        # merging by summing co-occurrence counts
+        progress.log("merging records into: %s\n" % mergePath)
+        integrateTablePair(table1, table2, mergePath, **options)
+        progress.log("merged table\n")
         if lexMethod == 'interpolate':
             progress.log("gzipping into: %s\n" % savefile)
             files.autoCat(mergePath, savefile)
@@ -201,6 +213,7 @@ def main():
     parser.add_argument('--lexfile', help = 'word pair counts file', default=None)
     parser.add_argument('--method', help = 'triangulation method', choices=methods, default=METHOD)
     parser.add_argument('--lexmethod', help = 'lexical triangulation method', choices=lexMethods, default=LEX_METHOD)
+    parser.add_argument('--intermediate-codec', help = 'codec[:level] compressing the intermediate files in workdir (%s, default: plain)' % str.join('/', files.CODECS.keys()), default=None)
     args = vars(parser.parse_args())
 
     integrate(**args)
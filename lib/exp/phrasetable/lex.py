@@ -4,8 +4,13 @@
 '''functions for controlling the word translation table'''
 
 import codecs
+import itertools
 import math
+import mmap
+import operator
+import os
 import pprint
+import struct
 import sys
 from collections import defaultdict
 
@@ -13,7 +18,9 @@ from exp.common import cache
 from exp.common import files
 from exp.common import number
 from exp.common import progress
+from exp.common.vocab import StringPool, Vocabulary
 from exp.phrasetable import record
+from exp.phrasetable.record import intern
 
 stdout = codecs.getwriter('utf-8')(sys.stdout)
 pp = pprint.PrettyPrinter()
@@ -25,17 +32,55 @@ NBEST = 100
 # for integer approximation
 MARGIN = 0.0001
 
+# word standing for unaligned words
+NULL = "NULL"
+
+# header of binary lexicon files, followed by the numbers of pairs, words,
+# value columns and marginal arrays, and the offset of the embedded vocabulary
+LEXICON_MAGIC = b'EXPLEX1\n'
+LEXICON_HEADER_FORMAT = '<5q'
+LEXICON_HEADER_SIZE = len(LEXICON_MAGIC) + struct.calcsize(LEXICON_HEADER_FORMAT)
+# extension of the binary lexicon compiled from the text lexicon
+BINARY_EXT = '.bin'
+# whether the arrays of binary lexicon can be cast in place from the buffer
+CAST_ARRAYS = hasattr(memoryview, 'cast') and sys.byteorder == 'little'
+# number of values unpacked at once when the arrays cannot be cast
+ARRAY_CHUNK = 4096
+
 # countmin/prodprob/bidirmin/bidirgmean/bidirmax/bidiravr
 methods = ['countmin', 'prodprob', 'bidirmin', 'bidirgmean', 'bidirmax', 'bidiravr']
 METHOD = 'countmin'
 
 class PairCounter(object):
-    def __init__(self):
+    '''counter of word pairs, keyed by the words, or by their IDs if the vocabulary is given'''
+    def __init__(self, vocab = None):
         self.srcCounts  = defaultdict(int)
         self.trgCounts  = defaultdict(int)
         self.pairCounts  = defaultdict(int)
         self.srcAligned  = defaultdict(set)
         self.trgAligned  = defaultdict(set)
+        self.vocab = vocab
+        if vocab != None:
+            self.null = vocab.getId(NULL)
+        else:
+            self.null = intern(NULL)
+
+    def getKey(self, word, add = False):
+        '''return the key of given word in this counter (None for unknown word ID)'''
+        if self.vocab != None:
+            return self.vocab.getId(word, add)
+        return word
+
+    def getKeys(self, words):
+        '''return the list of keys of given words in this counter'''
+        if self.vocab != None:
+            return list(self.vocab.getIds(words, False))
+        return words
+
+    def getWord(self, key):
+        if self.vocab != None:
+            return self.vocab.getWord(key)
+        return key
 
     def addSrc(self, word, count = 1):
         self.srcCounts[word] += count
@@ -55,8 +100,21 @@ class PairCounter(object):
         self.addTrg(trgWord, count)
 
     def addNull(self, count = 1):
-        self.addSrc(intern("NULL"),count)
-        self.addTrg(intern("NULL"),count)
+        self.addSrc(self.null,count)
+        self.addTrg(self.null,count)
+
+    def merge(self, other):
+        '''add all the counts of other counter (sharing the same vocabulary) into this counter'''
+        for pair, count in other.pairCounts.items():
+            self.pairCounts[pair] += count
+        for word, count in other.srcCounts.items():
+            self.srcCounts[word] += count
+        for word, count in other.trgCounts.items():
+            self.trgCounts[word] += count
+        for word, aligned in other.srcAligned.items():
+            self.srcAligned[word].update(aligned)
+        for word, aligned in other.trgAligned.items():
+            self.trgAligned[word].update(aligned)
 
     def calcLexProb(self, srcWord, trgWord):
         coCount = self.pairCounts[(srcWord,trgWord)]
@@ -93,29 +151,30 @@ class PairCounter(object):
     def filterNBestBySrc(self, nbest = NBEST, srcWord = None):
         if nbest > 0:
             scores = []
-            if srcWord:
+            if srcWord != None:
                 for trgWord in self.trgAligned[srcWord]:
-                    scores.append( (self.pairCounts[srcWord, trgWord], trgWord) )
+                    # ties are broken by the words, not by their IDs
+                    scores.append( (self.pairCounts[srcWord, trgWord], self.getWord(trgWord), trgWord) )
                 scores.sort(reverse = True)
-                for _, trgWord in scores[nbest:None]:
+                for _, _, trgWord in scores[nbest:None]:
                     self.delPair(srcWord, trgWord)
             else:
                 for srcWord in self.srcCounts.keys():
-                    if srcWord != "NULL":
+                    if srcWord != self.null:
                         self.filterNBestBySrc(nbest, srcWord)
 
     def filterNBestByTrg(self, nbest = NBEST, trgWord = None):
         if nbest > 0:
             scores = []
-            if trgWord:
+            if trgWord != None:
                 for srcWord in self.srcAligned[trgWord]:
-                    scores.append( (self.pairCounts[srcWord, trgWord], srcWord) )
+                    scores.append( (self.pairCounts[srcWord, trgWord], self.getWord(srcWord), srcWord) )
                 scores.sort(reverse = True)
-                for _, srcWord in scores[nbest:None]:
+                for _, _, srcWord in scores[nbest:None]:
                     self.delPair(srcWord, trgWord)
             else:
                 for trgWord in self.trgCounts.keys():
-                    if trgWord != "NULL":
+                    if trgWord != self.null:
                         self.filterNBestByTrg(nbest, trgWord)
 
 
@@ -158,11 +217,13 @@ def calcWordPairCountsByAligns(srcTextPath, trgTextPath, alignPath):
 
 def saveWordPairCounts(savePath, pairCounter):
     saveFile = files.open(savePath, 'w')
-    for pair in sorted(pairCounter.pairCounts.keys()):
-        srcWord = pair[0]
-        trgWord = pair[1]
-        srcCount = number.toNumber(pairCounter.srcCounts[srcWord], MARGIN)
-        trgCount = number.toNumber(pairCounter.trgCounts[trgWord], MARGIN)
+    getWord = pairCounter.getWord
+    # sorting by the words even if the counter is keyed by the IDs
+    pairs = [((getWord(pair[0]), getWord(pair[1])), pair) for pair in pairCounter.pairCounts.keys()]
+    pairs.sort()
+    for (srcWord, trgWord), pair in pairs:
+        srcCount = number.toNumber(pairCounter.srcCounts[pair[0]], MARGIN)
+        trgCount = number.toNumber(pairCounter.trgCounts[pair[1]], MARGIN)
         pairCount = number.toNumber(pairCounter.pairCounts[pair], MARGIN)
         if pairCount > 0:
             buf = "%s %s %s %s %s\n" % (srcWord, trgWord, pairCount, srcCount, trgCount)
@@ -170,13 +231,352 @@ def saveWordPairCounts(savePath, pairCounter):
     saveFile.close()
 
 
-def loadWordPairCounts(lexPath):
+class MappedArray(object):
+    '''read-only sequence of little-endian 8-byte numbers decoded in place from the memory-mapped buffer
+
+    the values are read through the buffer cast into the typecode if possible,
+    otherwise unpacked by chunks on iteration'''
+    def __init__(self, buf, pos, count, typecode):
+        self.buf = buf
+        self.pos = pos
+        self.count = count
+        self.typecode = typecode
+        self.view = None
+        if CAST_ARRAYS:
+            self.view = memoryview(buf)[pos:pos + count * 8].cast(typecode)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.count
+        if index < 0 or index >= self.count:
+            raise IndexError('index out of range')
+        if self.view != None:
+            return self.view[index]
+        return struct.unpack_from('<' + self.typecode, self.buf, self.pos + index * 8)[0]
+
+    def __iter__(self):
+        if self.view != None:
+            return iter(self.view)
+        return self.iterChunks()
+
+    def __len__(self):
+        return self.count
+
+    def iterChunks(self):
+        for start in range(0, self.count, ARRAY_CHUNK):
+            size = min(ARRAY_CHUNK, self.count - start)
+            for value in struct.unpack_from('<%d%s' % (size, self.typecode), self.buf, self.pos + start * 8):
+                yield value
+
+    def release(self):
+        '''release the view on the buffer, which should be done before closing the buffer'''
+        if self.view != None:
+            self.view.release()
+            self.view = None
+
+
+class BinaryLexicon(object):
+    '''memory-mapped binary lexicon of the word pairs sorted by (source ID, target ID)
+
+    the word IDs follow the sorted order of the words in the embedded vocabulary,
+    the value columns (counts or probabilities) are parallel to the pairs,
+    and the marginal arrays (source and target counts) are indexed by the word IDs,
+    all of them read in place as MappedArray'''
+    def __init__(self, path):
+        self.lexFile = open(path, 'rb')
+        magic = self.lexFile.read(len(LEXICON_MAGIC))
+        if magic != LEXICON_MAGIC:
+            raise ValueError('not a binary lexicon file: %s' % path)
+        header = self.lexFile.read(struct.calcsize(LEXICON_HEADER_FORMAT))
+        (numPairs, numWords, numColumns, numMarginals, vocabOffset) = struct.unpack(LEXICON_HEADER_FORMAT, header)
+        self.buf = mmap.mmap(self.lexFile.fileno(), 0, access = mmap.ACCESS_READ)
+        self.vocab = Vocabulary(path, vocabOffset)
+        pos = LEXICON_HEADER_SIZE
+        self.srcIds = MappedArray(self.buf, pos, numPairs, 'q')
+        pos += numPairs * 8
+        self.trgIds = MappedArray(self.buf, pos, numPairs, 'q')
+        pos += numPairs * 8
+        self.columns = []
+        for _ in range(numColumns):
+            self.columns.append( MappedArray(self.buf, pos, numPairs, 'd') )
+            pos += numPairs * 8
+        self.marginals = []
+        for _ in range(numMarginals):
+            self.marginals.append( MappedArray(self.buf, pos, numWords, 'd') )
+            pos += numWords * 8
+
+    def __len__(self):
+        return len(self.srcIds)
+
+    def close(self):
+        for array in [self.srcIds, self.trgIds] + self.columns + self.marginals:
+            array.release()
+        self.vocab.close()
+        self.buf.close()
+        self.lexFile.close()
+
+    def getWords(self):
+        return self.vocab.getWords(range(len(self.vocab)))
+
+
+class MappedLexicon(object):
+    '''word pair counts looked up in place on the memory-mapped binary lexicon
+
+    the pages are shared by the processes reading the same file,
+    and calcLexProb and calcLexProbRev take the words as PairCounter without vocabulary'''
+    def __init__(self, path):
+        self.lexFile = open(path, 'rb')
+        magic = self.lexFile.read(len(LEXICON_MAGIC))
+        if magic != LEXICON_MAGIC:
+            raise ValueError('not a binary lexicon file: %s' % path)
+        header = self.lexFile.read(struct.calcsize(LEXICON_HEADER_FORMAT))
+        (numPairs, numWords, numColumns, numMarginals, vocabOffset) = struct.unpack(LEXICON_HEADER_FORMAT, header)
+        if numColumns < 1 or numMarginals < 2:
+            raise ValueError('not a word pair counts file: %s' % path)
+        self.buf = mmap.mmap(self.lexFile.fileno(), 0, access = mmap.ACCESS_READ)
+        self.words = StringPool(path, vocabOffset)
+        self.numPairs = numPairs
+        self.srcIdPos = LEXICON_HEADER_SIZE
+        self.trgIdPos = self.srcIdPos + numPairs * 8
+        self.countPos = self.trgIdPos + numPairs * 8
+        self.srcCountPos = self.countPos + numPairs * 8 * numColumns
+        self.trgCountPos = self.srcCountPos + numWords * 8
+        self.null = NULL
+
+    def close(self):
+        self.words.close()
+        self.buf.close()
+        self.lexFile.close()
+
+    def getKey(self, word, add = False):
+        return word
+
+    def getWord(self, key):
+        return key
+
+    def getId(self, word):
+        '''return the ID of the word by binary search on the sorted words, or None if not found'''
+        words = self.words
+        start = 0
+        end = len(words)
+        while start < end:
+            mid = (start + end) // 2
+            if words[mid] < word:
+                start = mid + 1
+            else:
+                end = mid
+        if start < len(words) and words[start] == word:
+            return start
+        return None
+
+    def getPairCount(self, srcWord, trgWord):
+        srcId = self.getId(srcWord)
+        trgId = self.getId(trgWord)
+        if srcId == None or trgId == None:
+            return 0
+        key = (srcId, trgId)
+        buf = self.buf
+        start = 0
+        end = self.numPairs
+        while start < end:
+            mid = (start + end) // 2
+            pair = (struct.unpack_from('<q', buf, self.srcIdPos + mid * 8)[0], struct.unpack_from('<q', buf, self.trgIdPos + mid * 8)[0])
+            if pair < key:
+                start = mid + 1
+            elif pair > key:
+                end = mid
+            else:
+                return struct.unpack_from('<d', buf, self.countPos + mid * 8)[0]
+        return 0
+
+    def getSrcCount(self, word):
+        '''return the source count of the word, or 0 if not counted'''
+        wordId = self.getId(word)
+        if wordId == None:
+            return 0
+        return struct.unpack_from('<d', self.buf, self.srcCountPos + wordId * 8)[0]
+
+    def getTrgCount(self, word):
+        wordId = self.getId(word)
+        if wordId == None:
+            return 0
+        return struct.unpack_from('<d', self.buf, self.trgCountPos + wordId * 8)[0]
+
+    def calcLexProb(self, srcWord, trgWord):
+        coCount = self.getPairCount(srcWord, trgWord)
+        srcCount = self.getSrcCount(srcWord)
+        if coCount == 0:
+            if srcCount:
+                return 1 / float(srcCount)
+            else:
+                return 0
+        else:
+            return coCount / float(srcCount)
+
+    def calcLexProbRev(self, srcWord, trgWord):
+        coCount = self.getPairCount(srcWord, trgWord)
+        trgCount = self.getTrgCount(trgWord)
+        if coCount == 0:
+            if trgCount:
+                return 1 / float(trgCount)
+            else:
+                return 0
+        else:
+            return coCount / float(trgCount)
+
+
+def saveBinaryLexicon(savePath, vocab, pairs, columns, marginals = []):
+    '''save the sorted ID pairs with the value columns and the marginal arrays as binary lexicon'''
+    numPairs = len(pairs)
+    numWords = len(vocab)
+    saveFile = open(savePath, 'wb')
+    vocabOffset = LEXICON_HEADER_SIZE + 8 * (numPairs * (2 + len(columns)) + numWords * len(marginals))
+    saveFile.write(LEXICON_MAGIC)
+    saveFile.write( struct.pack(LEXICON_HEADER_FORMAT, numPairs, numWords, len(columns), len(marginals), vocabOffset) )
+    saveFile.write( struct.pack('<%dq' % numPairs, *[pair[0] for pair in pairs]) )
+    saveFile.write( struct.pack('<%dq' % numPairs, *[pair[1] for pair in pairs]) )
+    for column in columns:
+        saveFile.write( struct.pack('<%dd' % numPairs, *column) )
+    for marginal in marginals:
+        saveFile.write( struct.pack('<%dd' % numWords, *marginal) )
+    vocab.write(saveFile)
+    saveFile.close()
+
+def compileLexicon(lexPath, binPath = None, probs = False):
+    '''convert the text lexicon (word pair counts, or word probs if probs is set) into binary lexicon'''
+    if not binPath:
+        binPath = lexPath + BINARY_EXT
     lexFile = files.open(lexPath, 'r')
-    pairCounter = PairCounter()
+    values = {}
+    srcCounts = defaultdict(int)
+    trgCounts = defaultdict(int)
+    for line in lexFile:
+        fields = line.split()
+        pair = (fields[0], fields[1])
+        if probs:
+            values[pair] = (float(fields[2]), float(fields[3]))
+        else:
+            # summing in the order of the lines as loadWordPairCounts
+            count = number.toNumber(fields[2])
+            values[pair] = values.get(pair, 0) + count
+            srcCounts[pair[0]] += count
+            trgCounts[pair[1]] += count
+    lexFile.close()
+    words = set()
+    for pair in values.keys():
+        words.update(pair)
+    vocab = Vocabulary()
+    for word in sorted(words):
+        vocab.getId(word)
+    pairs = sorted(values.keys())
+    idPairs = [(vocab.getId(src), vocab.getId(trg)) for (src, trg) in pairs]
+    if probs:
+        columns = [[values[pair][0] for pair in pairs], [values[pair][1] for pair in pairs]]
+        marginals = []
+    else:
+        columns = [[values[pair] for pair in pairs]]
+        marginals = [[srcCounts.get(word, 0) for word in sorted(words)],
+                     [trgCounts.get(word, 0) for word in sorted(words)]]
+    saveBinaryLexicon(binPath, vocab, idPairs, columns, marginals)
+
+def saveBinaryWordPairCounts(savePath, pairCounter):
+    '''save the word pair counts (including the counts set without pairs such as NULL) as binary lexicon'''
+    getWord = pairCounter.getWord
+    counts = {}
+    for (src, trg), count in pairCounter.pairCounts.items():
+        if src != None and trg != None:
+            counts[(getWord(src), getWord(trg))] = count
+    srcCounts = {}
+    for word, count in pairCounter.srcCounts.items():
+        if word != None:
+            srcCounts[getWord(word)] = count
+    trgCounts = {}
+    for word, count in pairCounter.trgCounts.items():
+        if word != None:
+            trgCounts[getWord(word)] = count
+    words = sorted( set(srcCounts.keys()) | set(trgCounts.keys()) | set(word for pair in counts.keys() for word in pair) )
+    vocab = Vocabulary()
+    for word in words:
+        vocab.getId(word)
+    pairs = sorted(counts.keys())
+    idPairs = [(vocab.getId(src), vocab.getId(trg)) for (src, trg) in pairs]
+    columns = [[counts[pair] for pair in pairs]]
+    marginals = [[srcCounts.get(word, 0) for word in words], [trgCounts.get(word, 0) for word in words]]
+    saveBinaryLexicon(savePath, vocab, idPairs, columns, marginals)
+
+def decompileLexicon(binPath, savePath):
+    '''convert the binary lexicon back into the text lexicon'''
+    lexicon = BinaryLexicon(binPath)
+    if lexicon.marginals:
+        lexicon.close()
+        saveWordPairCounts(savePath, loadBinaryWordPairCounts(binPath))
+    else:
+        words = lexicon.getWords()
+        saveFile = files.open(savePath, 'w')
+        for srcId, trgId, egfl, fgel in zip(lexicon.srcIds, lexicon.trgIds, lexicon.columns[0], lexicon.columns[1]):
+            saveFile.write( "%s %s %s %s\n" % (words[srcId], words[trgId], egfl, fgel) )
+        saveFile.close()
+        lexicon.close()
+
+def getBinaryPath(lexPath):
+    '''return the path of the binary lexicon for given lexicon if available, otherwise None'''
+    if os.path.isfile(lexPath):
+        lexFile = open(lexPath, 'rb')
+        magic = lexFile.read(len(LEXICON_MAGIC))
+        lexFile.close()
+        if magic == LEXICON_MAGIC:
+            return lexPath
+    binPath = lexPath + BINARY_EXT
+    if os.path.isfile(binPath):
+        # ignoring the binary lexicon older than the text one
+        if not os.path.exists(lexPath) or os.path.getmtime(binPath) >= os.path.getmtime(lexPath):
+            return binPath
+    return None
+
+def loadBinaryWordPairCounts(binPath, vocab = None):
+    '''load the word pair counts from the binary lexicon, keyed by the word IDs of the vocabulary if given'''
+    lexicon = BinaryLexicon(binPath)
+    if vocab != None:
+        keys = [vocab.getId(word) for word in lexicon.getWords()]
+    else:
+        keys = [intern(word) for word in lexicon.getWords()]
+    pairCounter = PairCounter(vocab)
+    pairs = list(zip([keys[srcId] for srcId in lexicon.srcIds], [keys[trgId] for trgId in lexicon.trgIds]))
+    # same as number.toNumber for the integral counts
+    counts = [int(count) if count.is_integer() else count for count in lexicon.columns[0]]
+    pairCounter.pairCounts.update( zip(pairs, counts) )
+    # the pairs are sorted by the sources, so the aligned targets are given by groups
+    trgAligned = pairCounter.trgAligned
+    for srcWord, group in itertools.groupby(pairs, operator.itemgetter(0)):
+        trgAligned[srcWord] = set(pair[1] for pair in group)
+    srcAligned = pairCounter.srcAligned
+    for srcWord, trgWord in pairs:
+        srcAligned[trgWord].add(srcWord)
+    (srcMarginals, trgMarginals) = lexicon.marginals
+    for srcId in set(lexicon.srcIds):
+        pairCounter.srcCounts[keys[srcId]] = number.toNumber(srcMarginals[srcId])
+    for trgId in set(lexicon.trgIds):
+        pairCounter.trgCounts[keys[trgId]] = number.toNumber(trgMarginals[trgId])
+    lexicon.close()
+    return pairCounter
+
+def loadWordPairCounts(lexPath, vocab = None):
+    '''load the word pair counts, keyed by the word IDs of the vocabulary if given
+
+    the compiled binary lexicon is loaded instead if available'''
+    binPath = getBinaryPath(lexPath)
+    if binPath:
+        return loadBinaryWordPairCounts(binPath, vocab)
+    lexFile = files.open(lexPath, 'r')
+    pairCounter = PairCounter(vocab)
     for line in lexFile:
       fields = line.split()
-      srcWord = intern( fields[0] )
-      trgWord = intern( fields[1] )
+      if vocab != None:
+        srcWord = vocab.getId( fields[0] )
+        trgWord = vocab.getId( fields[1] )
+      else:
+        srcWord = intern( fields[0] )
+        trgWord = intern( fields[1] )
 #      pairCounter.addPair(srcWord, trgWord, int(fields[2]))
       pairCounter.addPair(srcWord, trgWord, number.toNumber(fields[2]))
 #      pairCounter.setSrc(srcWord, number.toNumber(fields[3]))
@@ -187,7 +587,15 @@ def loadWordPairCounts(lexPath):
 def pivotWordPairCounts(cntSrcPvt, cntPvtTrg, **options):
     nbest  = options.get('nbest', 0)
     method = options.get('method', METHOD)
-    cntSrcTrg = PairCounter()
+    if options.get('matrix', False):
+        from exp.phrasetable import lex_matrix
+        if lex_matrix.available():
+            # the n-best are pruned once after pivoting, see lex_matrix.pivotPairMatrices
+            return lex_matrix.pivotWordPairCounts(cntSrcPvt, cntPvtTrg, **options)
+        else:
+            progress.log("numpy/scipy not found, pivoting without sparse matrices\n")
+    cntSrcTrg = PairCounter(cntSrcPvt.vocab)
+    null = cntSrcTrg.null
     for srcWord in cntSrcPvt.srcCounts.keys():
         for pvtWord in cntSrcPvt.trgAligned[srcWord]:
 #            if False and pvtWord == "NULL":
@@ -202,7 +610,7 @@ def pivotWordPairCounts(cntSrcPvt, cntPvtTrg, **options):
 #                    count = cntPvtTrg.pairCounts[("NULL",trgWord)]
 #                    cntSrcTrg.addPair("NULL", trgWord, count)
 #                    continue
-                if srcWord == "NULL" and trgWord == "NULL":
+                if srcWord == null and trgWord == null:
                     # NULL-NULL are not aligned.
                     pass
                 else:
@@ -243,7 +651,7 @@ def pivotWordPairCounts(cntSrcPvt, cntPvtTrg, **options):
                         assert False, "Invalid method: %s" % method
             # filtering n-best records by source-side
             if nbest > 0:
-                if srcWord != "NULL":
+                if srcWord != null:
                     cntSrcTrg.filterNBestBySrc(nbest, srcWord)
     # filtering n-best records by target-side
     if nbest > 0:
@@ -253,7 +661,7 @@ def pivotWordPairCounts(cntSrcPvt, cntPvtTrg, **options):
 
 def combineWordPairCounts(lexCounts1, lexCounts2, **options):
     nbest = options.get('nbest', NBEST)
-    lexCounts = PairCounter()
+    lexCounts = PairCounter(lexCounts1.vocab)
     for pair, count in lexCounts1.pairCounts.items():
         lexCounts.addPair(pair[0], pair[1], count)
 #        lexCounts.addSrc(pair[0], count)
@@ -297,6 +705,9 @@ def extractLexRec(srcFile, saveFile, RecordClass = record.MosesRecord):
 
 def loadWordProbs(srcFile, reverse = False):
     if type(srcFile) == str:
+        binPath = getBinaryPath(srcFile)
+        if binPath:
+            return loadBinaryWordProbs(binPath, reverse)
         srcFile = files.open(srcFile)
     probs = {}
     for line in srcFile:
@@ -309,3 +720,15 @@ def loadWordProbs(srcFile, reverse = False):
             probs[(trg, src)] = float(fields[3])
     return probs
 
+def loadBinaryWordProbs(binPath, reverse = False):
+    lexicon = BinaryLexicon(binPath)
+    words = lexicon.getWords()
+    probs = {}
+    if not reverse:
+        for srcId, trgId, prob in zip(lexicon.srcIds, lexicon.trgIds, lexicon.columns[0]):
+            probs[(words[srcId], words[trgId])] = prob
+    else:
+        for srcId, trgId, prob in zip(lexicon.srcIds, lexicon.trgIds, lexicon.columns[1]):
+            probs[(words[trgId], words[srcId])] = prob
+    lexicon.close()
+    return probs
@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''sparse matrix engine for the word pair counts, available if numpy and scipy are installed'''
+
+import argparse
+import sys
+
+try:
+    import numpy
+    from scipy import sparse
+except ImportError:
+    numpy = None
+    sparse = None
+
+from exp.common.vocab import Vocabulary
+from exp.phrasetable import lex
+
+# maximum number of (source, pivot, target) paths to expand at once for countmin
+BLOCK_SIZE = 10 ** 7
+
+# relative difference of the counts allowed by checkParity for the float rounding
+PARITY_TOLERANCE = 1e-9
+# small word pair counts of source-pivot and pivot-target checked by default
+FIXTURE_SRC_PVT = [
+    ('a', 'x', 3), ('a', 'y', 1), ('b', 'x', 2), ('b', 'z', 4),
+    ('c', 'y', 2), ('NULL', 'z', 1), ('c', 'NULL', 1),
+]
+FIXTURE_PVT_TRG = [
+    ('x', 'p', 2), ('x', 'q', 3), ('y', 'q', 1), ('z', 'r', 5),
+    ('z', 'p', 1), ('NULL', 'q', 2), ('z', 'NULL', 1), ('NULL', 'NULL', 1),
+]
+
+def available():
+    return sparse != None
+
+class PairMatrix(object):
+    '''word pair counts as CSR matrix of source words (rows) and target words (columns),
+    with the marginal counts of source and target words as dense arrays'''
+    def __init__(self, srcVocab, trgVocab, counts, srcCounts = None, trgCounts = None):
+        self.srcVocab = srcVocab
+        self.trgVocab = trgVocab
+        self.counts = counts.tocsr()
+        if srcCounts is None:
+            srcCounts = numpy.asarray(self.counts.sum(axis = 1)).ravel()
+        if trgCounts is None:
+            trgCounts = numpy.asarray(self.counts.sum(axis = 0)).ravel()
+        self.srcCounts = srcCounts
+        self.trgCounts = trgCounts
+        # rows and columns having been counted, even if all their pairs are filtered out
+        self.srcUsed = numpy.diff(self.counts.indptr) > 0
+        self.trgUsed = numpy.bincount(self.counts.indices, minlength = self.counts.shape[1]) > 0
+
+    def getCoo(self):
+        coo = self.counts.tocoo()
+        return (coo.row, coo.col, coo.data)
+
+    def filterNBestBySrc(self, nbest = lex.NBEST):
+        '''keep the n-best target words of each source word except NULL'''
+        if nbest > 0:
+            (rows, cols, vals) = self.getCoo()
+            keep = selectNBest(rows, cols, vals, getRanks(self.trgVocab), nbest, self.srcVocab.getId(lex.NULL, False))
+            self.deletePairs(rows, cols, vals, keep)
+
+    def filterNBestByTrg(self, nbest = lex.NBEST):
+        '''keep the n-best source words of each target word except NULL'''
+        if nbest > 0:
+            (rows, cols, vals) = self.getCoo()
+            keep = selectNBest(cols, rows, vals, getRanks(self.srcVocab), nbest, self.trgVocab.getId(lex.NULL, False))
+            self.deletePairs(rows, cols, vals, keep)
+
+    def deletePairs(self, rows, cols, vals, keep):
+        '''leave the pairs to keep, discounting the source counts as lex.PairCounter.delPair'''
+        dropped = ~keep
+        self.srcCounts = self.srcCounts - numpy.bincount(rows[dropped], weights = vals[dropped], minlength = len(self.srcCounts))
+        shape = self.counts.shape
+        self.counts = sparse.csr_matrix((vals[keep], (rows[keep], cols[keep])), shape = shape)
+
+    def toCounter(self, vocab = None):
+        '''convert into lex.PairCounter (keyed by the IDs of given vocabulary if any)'''
+        counter = lex.PairCounter(vocab)
+        srcKeys = [counter.getKey(word, True) for word in iterWords(self.srcVocab)]
+        trgKeys = [counter.getKey(word, True) for word in iterWords(self.trgVocab)]
+        for index in numpy.flatnonzero(self.srcUsed).tolist():
+            if self.srcCounts[index] > 0:
+                counter.srcCounts[srcKeys[index]] = self.srcCounts[index].item()
+        for index in numpy.flatnonzero(self.trgUsed).tolist():
+            counter.trgCounts[trgKeys[index]] = self.trgCounts[index].item()
+        (rows, cols, vals) = self.getCoo()
+        for row, col, val in zip(rows.tolist(), cols.tolist(), vals.tolist()):
+            src = srcKeys[row]
+            trg = trgKeys[col]
+            counter.pairCounts[(src, trg)] = val
+            counter.srcAligned[trg].add(src)
+            counter.trgAligned[src].add(trg)
+        return counter
+
+
+def fromCounter(counter, srcVocab = None, trgVocab = None):
+    '''convert lex.PairCounter into PairMatrix, adding the words into given vocabularies'''
+    if srcVocab is None:
+        srcVocab = Vocabulary()
+    if trgVocab is None:
+        trgVocab = Vocabulary()
+    getWord = counter.getWord
+    for word in counter.srcCounts.keys():
+        srcVocab.getId( getWord(word) )
+    for word in counter.trgCounts.keys():
+        trgVocab.getId( getWord(word) )
+    rows = []
+    cols = []
+    vals = []
+    for (src, trg), count in counter.pairCounts.items():
+        rows.append( srcVocab.getId(getWord(src)) )
+        cols.append( trgVocab.getId(getWord(trg)) )
+        vals.append( count )
+    shape = (len(srcVocab), len(trgVocab))
+    counts = sparse.csr_matrix((numpy.array(vals, dtype = float), (rows, cols)), shape = shape)
+    srcCounts = getMarginals(counter.srcCounts, srcVocab, getWord)
+    trgCounts = getMarginals(counter.trgCounts, trgVocab, getWord)
+    return PairMatrix(srcVocab, trgVocab, counts, srcCounts, trgCounts)
+
+def getMarginals(wordCounts, vocab, getWord):
+    marginals = numpy.zeros(len(vocab))
+    for word, count in wordCounts.items():
+        wordId = vocab.getId(getWord(word), False)
+        if wordId is not None:
+            marginals[wordId] = count
+    return marginals
+
+def iterWords(vocab):
+    for wordId in range(len(vocab)):
+        yield vocab.getWord(wordId)
+
+def getRanks(vocab):
+    '''return the array of the rank of each word in the sorted order'''
+    order = sorted(range(len(vocab)), key = vocab.getWord)
+    ranks = numpy.empty(len(vocab), dtype = numpy.int64)
+    ranks[order] = numpy.arange(len(vocab))
+    return ranks
+
+def selectNBest(groups, others, vals, otherRanks, nbest, skipGroup = None):
+    '''return the mask of the entries in the n-best of their groups,
+    ordered by the value and then the word of the other side in descending order'''
+    order = numpy.lexsort((-otherRanks[others], -vals, groups))
+    sortedGroups = groups[order]
+    starts = numpy.searchsorted(sortedGroups, sortedGroups, side = 'left')
+    keep = numpy.empty(len(order), dtype = bool)
+    keep[order] = (numpy.arange(len(order)) - starts) < nbest
+    if skipGroup is not None:
+        keep |= (groups == skipGroup)
+    return keep
+
+def getPivotWeights(matSrcPvt, matPvtTrg, method):
+    '''return the weights of pivot words to multiply with the product of co-occurrence counts'''
+    srcCount2 = matPvtTrg.srcCounts
+    trgCount1 = matSrcPvt.trgCounts
+    if method == 'prodprob':
+        denom = srcCount2
+    elif method == 'bidirmin':
+        denom = numpy.maximum(srcCount2, trgCount1)
+    elif method == 'bidirgmean':
+        denom = numpy.sqrt(srcCount2 * trgCount1)
+    elif method == 'bidirmax':
+        denom = numpy.minimum(srcCount2, trgCount1)
+    elif method == 'bidiravr':
+        with numpy.errstate(divide = 'ignore'):
+            weights = (1 / srcCount2 + 1 / trgCount1) * 0.5
+        weights[~numpy.isfinite(weights)] = 0
+        return weights
+    else:
+        assert False, "Invalid method: %s" % method
+    weights = numpy.zeros(len(denom))
+    nonzero = denom > 0
+    weights[nonzero] = 1 / denom[nonzero]
+    return weights
+
+def pivotCountMin(matSrcPvt, matPvtTrg):
+    '''sum of the minimum co-occurrence counts over the pivot words'''
+    colsSrcPvt = matSrcPvt.counts.tocsc()
+    rowsPvtTrg = matPvtTrg.counts
+    shape = (colsSrcPvt.shape[0], rowsPvtTrg.shape[1])
+    total = sparse.csr_matrix(shape)
+    blockRows = []
+    blockCols = []
+    blockVals = []
+    blockSize = 0
+    for pvt in range(colsSrcPvt.shape[1]):
+        (start1, end1) = colsSrcPvt.indptr[pvt:pvt+2]
+        (start2, end2) = rowsPvtTrg.indptr[pvt:pvt+2]
+        if start1 == end1 or start2 == end2:
+            continue
+        srcs = colsSrcPvt.indices[start1:end1]
+        trgs = rowsPvtTrg.indices[start2:end2]
+        vals = numpy.minimum.outer(colsSrcPvt.data[start1:end1], rowsPvtTrg.data[start2:end2])
+        blockRows.append( numpy.repeat(srcs, len(trgs)) )
+        blockCols.append( numpy.tile(trgs, len(srcs)) )
+        blockVals.append( vals.ravel() )
+        blockSize += vals.size
+        if blockSize >= BLOCK_SIZE:
+            total = total + makeBlock(blockRows, blockCols, blockVals, shape)
+            blockRows = []
+            blockCols = []
+            blockVals = []
+            blockSize = 0
+    if blockSize > 0:
+        total = total + makeBlock(blockRows, blockCols, blockVals, shape)
+    return total
+
+def makeBlock(rows, cols, vals, shape):
+    return sparse.csr_matrix((numpy.concatenate(vals), (numpy.concatenate(rows), numpy.concatenate(cols))), shape = shape)
+
+def pivotPairMatrices(matSrcPvt, matPvtTrg, **options):
+    '''triangulate the matrices of source-pivot and pivot-target sharing the pivot vocabulary
+
+    the n-best target words of each source word (the rows) and then the n-best source words of
+    each target word (the columns) are pruned once after all the pivot words. the loops of
+    lex.pivotWordPairCounts instead prune each source word after each of its pivot words, visited
+    in the hash order, so a target word pruned early is counted again only by the later pivots.
+    the matrices keep the top n by the whole counts, which doesn't depend on the order'''
+    nbest  = options.get('nbest', 0)
+    method = options.get('method', lex.METHOD)
+    if method == 'countmin':
+        counts = pivotCountMin(matSrcPvt, matPvtTrg)
+    else:
+        # the products of counts are divided by the per-pivot denominators, so it is a weighted product
+        weights = sparse.diags(getPivotWeights(matSrcPvt, matPvtTrg, method))
+        counts = (matSrcPvt.counts * weights * matPvtTrg.counts).tocsr()
+    # NULL-NULL are not aligned
+    srcNull = matSrcPvt.srcVocab.getId(lex.NULL, False)
+    trgNull = matPvtTrg.trgVocab.getId(lex.NULL, False)
+    if srcNull is not None and trgNull is not None and counts[srcNull, trgNull] != 0:
+        counts = counts.tolil()
+        counts[srcNull, trgNull] = 0
+        counts = counts.tocsr()
+        counts.eliminate_zeros()
+    matSrcTrg = PairMatrix(matSrcPvt.srcVocab, matPvtTrg.trgVocab, counts)
+    matSrcTrg.filterNBestBySrc(nbest)
+    matSrcTrg.filterNBestByTrg(nbest)
+    return matSrcTrg
+
+def pivotWordPairCounts(cntSrcPvt, cntPvtTrg, **options):
+    '''lex.pivotWordPairCounts computed by the sparse matrix products,
+    the same if nbest is 0 (see pivotPairMatrices for the n-best pruning)'''
+    pvtVocab = Vocabulary()
+    matSrcPvt = fromCounter(cntSrcPvt, trgVocab = pvtVocab)
+    matPvtTrg = fromCounter(cntPvtTrg, srcVocab = pvtVocab)
+    # aligning the pivot dimension of both matrices
+    matSrcPvt = resizeTrg(matSrcPvt, len(pvtVocab))
+    return pivotPairMatrices(matSrcPvt, matPvtTrg, **options).toCounter(cntSrcPvt.vocab)
+
+def resizeTrg(matrix, size):
+    '''extend the target dimension of the matrix for the words added later into the vocabulary'''
+    extra = size - len(matrix.trgCounts)
+    if extra > 0:
+        counts = matrix.counts.tocsr()
+        counts = sparse.csr_matrix((counts.data, counts.indices, counts.indptr), shape = (counts.shape[0], size))
+        trgCounts = numpy.concatenate([matrix.trgCounts, numpy.zeros(extra)])
+        matrix = PairMatrix(matrix.srcVocab, matrix.trgVocab, counts, matrix.srcCounts, trgCounts)
+    return matrix
+
+def makeCounter(pairCounts):
+    '''return lex.PairCounter keyed by the words of given (source, target, count) list'''
+    counter = lex.PairCounter()
+    for srcWord, trgWord, count in pairCounts:
+        counter.addPair(srcWord, trgWord, count)
+    return counter
+
+def checkParity(cntSrcPvt, cntPvtTrg, **options):
+    '''return the counts pivoted by the matrices differing from lex.pivotWordPairCounts without them,
+    as the sorted list of (kind, key, count by the loops, count by the matrices)'''
+    options = dict(options, matrix = False)
+    expected = lex.pivotWordPairCounts(cntSrcPvt, cntPvtTrg, **options)
+    actual = pivotWordPairCounts(cntSrcPvt, cntPvtTrg, **options)
+    diffs = []
+    for kind, counts1, counts2 in [('pair', expected.pairCounts, actual.pairCounts),
+                                   ('src', expected.srcCounts, actual.srcCounts),
+                                   ('trg', expected.trgCounts, actual.trgCounts)]:
+        for key in set(counts1.keys()) | set(counts2.keys()):
+            count1 = counts1.get(key, 0)
+            count2 = counts2.get(key, 0)
+            if abs(count1 - count2) > PARITY_TOLERANCE * max(abs(count1), abs(count2)):
+                diffs.append( (kind, key, count1, count2) )
+    diffs.sort()
+    return diffs
+
+def main():
+    parser = argparse.ArgumentParser(description = 'check the sparse matrix engine against the loops of pivoting word pair counts')
+    parser.add_argument('lexfile1', nargs = '?', help = 'word pair counts file src->pvt (default: small fixture)')
+    parser.add_argument('lexfile2', nargs = '?', help = 'word pair counts file pvt->trg (default: small fixture)')
+    parser.add_argument('--method', choices = lex.methods, action = 'append',
+                        help = 'pivoting method to check (default: all)')
+    parser.add_argument('--nbest', type = int, default = 0,
+                        help = 'n-best pruning to compare, differing from the loops if > 0 (default: 0)')
+    args = parser.parse_args()
+    if not available():
+        sys.exit("numpy/scipy not found")
+    if args.lexfile1 and args.lexfile2:
+        cntSrcPvt = lex.loadWordPairCounts(args.lexfile1)
+        cntPvtTrg = lex.loadWordPairCounts(args.lexfile2)
+    elif args.lexfile1 or args.lexfile2:
+        parser.error('both lexfile1 and lexfile2 should be given')
+    else:
+        cntSrcPvt = makeCounter(FIXTURE_SRC_PVT)
+        cntPvtTrg = makeCounter(FIXTURE_PVT_TRG)
+    failed = False
+    for method in args.method or lex.methods:
+        diffs = checkParity(cntSrcPvt, cntPvtTrg, method = method, nbest = args.nbest)
+        for kind, key, count1, count2 in diffs:
+            print("%s %s %s: %r != %r" % (method, kind, key, count1, count2))
+        print("%s: %s" % (method, "NG (%d differences)" % len(diffs) if diffs else "OK"))
+        failed = failed or bool(diffs)
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
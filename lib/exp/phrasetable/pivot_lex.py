@@ -11,6 +11,7 @@ methods = ['countmin', 'prodprob', 'bidirmin', 'bidirgmean', 'bidirmax', 'bidira
 METHOD = 'countmin'
 
 import argparse
+from exp.common.vocab import Vocabulary
 from exp.phrasetable import lex
 
 #def pivot_lex(lexfile1, lexfile2, savefile, nbest = NBEST):
@@ -20,8 +21,10 @@ def pivot_lex(lexfile1, lexfile2, savefile, **options):
         nbest = options.get('nbest', NBEST_COUNT)
     else:
         nbest = options.get('nbest', NBEST)
-    cntSrcPvt = lex.loadWordPairCounts(lexfile1)
-    cntPvtTrg = lex.loadWordPairCounts(lexfile2)
+    # sharing the word IDs between the two tables
+    vocab = Vocabulary()
+    cntSrcPvt = lex.loadWordPairCounts(lexfile1, vocab)
+    cntPvtTrg = lex.loadWordPairCounts(lexfile2, vocab)
 #    cntSrcTrg = lex.pivotWordPairCounts(cntSrcPvt, cntPvtTrg, nbest = nbest)
     cntSrcTrg = lex.pivotWordPairCounts(cntSrcPvt, cntPvtTrg, **options)
     lex.saveWordPairCounts(savefile, cntSrcTrg)
@@ -33,6 +36,8 @@ def main():
     parser.add_argument('savefile', help = 'path for saving word pair counts')
     parser.add_argument('--nbest', type = int, default=NBEST)
     parser.add_argument('--method', choices = methods, default=METHOD)
+    parser.add_argument('--matrix', action = 'store_true',
+                        help = 'pivoting by sparse matrix products (requiring numpy and scipy, pruning the n-best once after pivoting)')
     args = vars(parser.parse_args())
     pivot_lex(**args)
 
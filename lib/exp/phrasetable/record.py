@@ -1,14 +1,70 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-'''classes handling phrase table records'''
+'''classes handling phrase table records
+
+the phrases are kept in the same type (bytes or text) as the parsed lines,
+and the records read from the binary files are written back into them without decoding the phrases'''
+
+import sys
 
 from exp.common import cache
 from exp.common import debug
 from exp.common import files
 from exp.common import number
 
+# number of released records to keep for reuse
+POOL_SIZE = 100
+
+# keys of moses scores in the order of the table
+MOSES_SCORE_KEYS = ('fgep', 'fgel', 'egfp', 'egfl')
+# features carried over into the reversed records, with their keys in the reversed direction
+REV_FEATURE_KEYS = (('egfp', 'fgep'), ('egfl', 'fgel'), ('fgep', 'egfp'), ('fgel', 'egfl'), ('p', 'p'))
+
+if str is bytes:
+    '''ascii-8 based strings (for python 2.X)'''
+    # the builtin one, exported for the modules sharing these helpers
+    intern = intern
+
+    def toText(string):
+        return string
+
+    def joinFields(fields, s = ' ||| '):
+        return str.join(s, fields) + "\n"
+else:
+    '''utf-8 based strings (for python 3.X)'''
+    def intern(string):
+        # only the text can be interned
+        if isinstance(string, str):
+            return sys.intern(string)
+        return string
+
+    def toText(string):
+        '''decode the bytes field into the text'''
+        if isinstance(string, bytes):
+            return string.decode('utf-8')
+        return string
+
+    def joinFields(fields, s = ' ||| '):
+        '''join the fields into the line, encoding the decoded fields if the phrases are bytes'''
+        if isinstance(fields[0], bytes):
+            fields = [field if isinstance(field, bytes) else field.encode('utf-8') for field in fields]
+            return s.encode('utf-8').join(fields) + b"\n"
+        return str.join(s, fields) + "\n"
+
+# types of the raw fields kept undecoded in the records
+RAW_TYPES = (bytes, type(u''))
+
+def matchType(string, like):
+    '''convert the string into the same type (bytes or text) as the other one'''
+    if isinstance(like, bytes):
+        return string.encode('utf-8')
+    else:
+        return string.decode('utf-8')
+
 class CoOccurrence(object):
+    __slots__ = ('src', 'trg', 'co')
+
     def __init__(self, src = 0, trg = 0, co = 0):
         self.src = src
         self.trg = trg
@@ -49,14 +105,151 @@ class CoOccurrence(object):
         mod  = self.__class__.__module__
         return "%s.%s(src = %s, trg = %s, co = %s)" % (mod, name, src, trg, co)
 
+class MosesFeatures(object):
+    '''fixed-schema features of moses records behaving like a dictionary
+
+    the four scores are held in the slots (None if not set), and other features in the extra dictionary'''
+    __slots__ = MOSES_SCORE_KEYS + ('extra',)
+
+    def __init__(self, scores = None):
+        if scores:
+            (self.fgep, self.fgel, self.egfp, self.egfl) = scores
+        else:
+            self.fgep = self.fgel = self.egfp = self.egfl = None
+        self.extra = None
+
+    def __contains__(self, key):
+        if key in MOSES_SCORE_KEYS:
+            return getattr(self, key) != None
+        else:
+            return bool(self.extra) and key in self.extra
+
+    def __delitem__(self, key):
+        if key in MOSES_SCORE_KEYS and getattr(self, key) != None:
+            setattr(self, key, None)
+        elif self.extra and key in self.extra:
+            del self.extra[key]
+        else:
+            raise KeyError(key)
+
+    def __getitem__(self, key):
+        if key in MOSES_SCORE_KEYS:
+            val = getattr(self, key)
+            if val != None:
+                return val
+        elif self.extra and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def __setitem__(self, key, val):
+        if key in MOSES_SCORE_KEYS:
+            setattr(self, key, val)
+        else:
+            if self.extra == None:
+                self.extra = {}
+            self.extra[key] = val
+
+    def get(self, key, default = None):
+        if key in MOSES_SCORE_KEYS:
+            val = getattr(self, key)
+        elif self.extra:
+            val = self.extra.get(key)
+        else:
+            val = None
+        if val != None:
+            return val
+        else:
+            return default
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def keys(self):
+        keys = [key for key in MOSES_SCORE_KEYS if getattr(self, key) != None]
+        if self.extra:
+            keys.extend(self.extra.keys())
+        return keys
+
+    def setdefault(self, key, default = None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def values(self):
+        return [self[key] for key in self.keys()]
+
+
 class Record(object):
+    '''base class of table records
+
+    features, counts and aligns are kept as the raw field strings until the first access,
+    and the fields never decoded are written back as they are.
+    each field has a single slot holding either the raw string or the decoded object (made on access)'''
+    __slots__ = ('src', 'trg', 'split', '_features', '_counts', '_aligns')
+
     def __init__(self):
       self.src = ""
       self.trg = ""
-      self.features = {}
-      self.counts = CoOccurrence()
-#      self.aligns = []
-      self.aligns = set()
+      self._features = None
+      self._counts = None
+#      self._aligns = []
+      self._aligns = None
+
+    def clear(self):
+        '''reset the fields to reuse the instance, without making the empty objects until accessed'''
+        self.src = ""
+        self.trg = ""
+        self._features = None
+        self._counts = None
+        self._aligns = None
+
+    def getFeatures(self):
+        features = self._features
+        if isinstance(features, RAW_TYPES):
+            features = self._features = self.decodeFeatures( toText(features) )
+        elif features == None:
+            features = self._features = {}
+        return features
+    def setFeatures(self, features):
+        self._features = features
+    features = property(getFeatures, setFeatures)
+
+    def getCounts(self):
+        counts = self._counts
+        if isinstance(counts, RAW_TYPES):
+            counts = self._counts = self.decodeCounts( toText(counts) )
+        elif counts == None:
+            counts = self._counts = CoOccurrence()
+        return counts
+    def setCounts(self, counts):
+        self._counts = counts
+    counts = property(getCounts, setCounts)
+
+    def getAligns(self):
+        aligns = self._aligns
+        if isinstance(aligns, RAW_TYPES):
+            aligns = self._aligns = getAlignSet( toText(aligns) )
+        elif aligns == None:
+            aligns = self._aligns = set()
+        return aligns
+    def setAligns(self, aligns):
+        self._aligns = aligns
+    aligns = property(getAligns, setAligns)
+
+    def getRawAligns(self):
+        '''return the alignment field as read from the line, or None if it has been decoded'''
+        if isinstance(self._aligns, RAW_TYPES):
+            return self._aligns
+        return None
 
     def getAlignMap(self):
         return getAlignMap(self.aligns, reverse = False)
@@ -74,24 +267,29 @@ class Record(object):
 #        debug.log(self.toStr())
 #        debug.log(self.aligns)
 #        recRev.aligns = getRevAligns(self.aligns)
-        recRev.aligns = getRevAlignSet(self.aligns)
+        if isinstance(self._aligns, RAW_TYPES):
+            # reversing the raw alignments without building the set of them
+            recRev.aligns = getRevAlignSet( toText(self._aligns).split() )
+        else:
+            recRev.aligns = getRevAlignSet(self.aligns)
+        recRev.features = self.getReversedFeatures()
+        return recRev
+
+    def getReversedFeatures(self):
+        '''return the feature dictionary for the reversed record'''
+        features = self.features
         revFeatures = {}
-        if 'egfp' in self.features:
-            revFeatures[intern('fgep')] = self.features['egfp']
-        if 'egfl' in self.features:
-            revFeatures[intern('fgel')] = self.features['egfl']
-        if 'fgep' in self.features:
-            revFeatures[intern('egfp')] = self.features['fgep']
-        if 'fgel' in self.features:
-            revFeatures[intern('egfl')] = self.features['fgel']
-        if 'p' in self.features:
-            revFeatures[intern('p')] = self.features['p']
+        for key, revKey in REV_FEATURE_KEYS:
+            val = features.get(key)
+            if val != None:
+                revFeatures[revKey] = val
         revFeatures[intern('w')] = len(self.srcTerms)
-        recRev.features = revFeatures
-        return recRev
+        return revFeatures
 
 
 class MosesRecord(Record):
+    __slots__ = ()
+
     def __init__(self, line = "", split = '|||'):
         Record.__init__(self)
         self.split = split
@@ -99,51 +297,110 @@ class MosesRecord(Record):
 
     def loadLine(self, line, split = '|||'):
         if line:
-            fields = line.strip().split(split)
+            try:
+                fields = line.strip().split(split)
+            except TypeError:
+                # given the bytes line with the text separator or vice versa
+                fields = line.strip().split( matchType(split, line) )
             self.src = intern( fields[0].strip() )
             self.trg = intern( fields[1].strip() )
-            self.features = getMosesFeatures(fields[2])
+            # raw fields decoded on demand
+            self._features = fields[2]
 #            self.aligns = fields[3].strip().split()
-            self.aligns = getAlignSet( fields[3] )
-            listCounts = getCounts(fields[4])
-            self.counts.setCounts(trg = listCounts[0], src = listCounts[1], co = listCounts[2])
+            self._aligns = fields[3]
+            self._counts = fields[4]
+
+    def decodeFeatures(self, field):
+        return getMosesFeatures(field)
+
+    def decodeCounts(self, field):
+        listCounts = getCounts(field)
+        counts = CoOccurrence()
+        counts.setCounts(trg = listCounts[0], src = listCounts[1], co = listCounts[2])
+        return counts
+
+    def getReversedFeatures(self):
+        if not isinstance(self._features, RAW_TYPES):
+            return Record.getReversedFeatures(self)
+        # swapping the raw scores directly
+        (fgep, fgel, egfp, egfl) = list(map(getNumber, self._features.split()))[0:4]
+        return {'fgep': egfp, 'fgel': egfl, 'egfp': fgep, 'egfl': fgel, 'w': len(self.srcTerms)}
 
     def getSrcSymbols(self):
-        return self.src.split(' ')
+        return toText(self.src).split(' ')
     srcSymbols = property(getSrcSymbols)
 
     def getSrcTerms(self):
-        return self.src.split(' ')
+        return toText(self.src).split(' ')
     srcTerms = property(getSrcTerms)
 
     def getTrgSymbols(self):
-        return self.trg.split(' ')
+        return toText(self.trg).split(' ')
     trgSymbols = property(getTrgSymbols)
 
     def getTrgTerms(self):
-        return self.trg.split(' ')
+        return toText(self.trg).split(' ')
     trgTerms = property(getTrgTerms)
 
     def toStr(self, s = ' ||| '):
-        strFeatures = getStrMosesFeatures(self.features)
+        if isinstance(self._features, RAW_TYPES):
+            strFeatures = self._features.strip()
+        else:
+            strFeatures = getStrMosesFeatures(self.features)
 #        strAligns = str.join(' ', self.aligns)
-        strAligns = str.join(' ', sorted(self.aligns) )
-        self.counts.simplify(0.0001)
-        strCounts   = "%s %s %s" % (self.counts.trg, self.counts.src, self.counts.co)
-        buf = str.join(s, [self.src, self.trg, strFeatures, strAligns, strCounts]) + "\n"
+        if isinstance(self._aligns, RAW_TYPES):
+            strAligns = self._aligns.strip()
+        else:
+            strAligns = str.join(' ', sorted(self.aligns) )
+        if isinstance(self._counts, RAW_TYPES):
+            strCounts = self._counts.strip()
+        else:
+            counts = self.counts
+            counts.simplify(0.0001)
+            strCounts   = "%s %s %s" % (counts.trg, counts.src, counts.co)
+        buf = joinFields([self.src, self.trg, strFeatures, strAligns, strCounts], s)
 #        buf = str.join(s, [str(self.src), str(self.trg), strFeatures, strAligns, strCounts]) + "\n"
         return buf
 
 
+class RecordPool(object):
+    '''pool of record instances reused by the parsing loops releasing them immediately'''
+    def __init__(self, RecordClass = MosesRecord, size = POOL_SIZE):
+        self.RecordClass = RecordClass
+        self.size = size
+        self.released = []
+
+    def get(self, line):
+        '''return the record parsed from given line, reusing the released instance if any'''
+        if self.released:
+            rec = self.released.pop()
+            rec.clear()
+            rec.loadLine(line, rec.split)
+            return rec
+        return self.RecordClass(line)
+
+    def release(self, rec):
+        '''put back the record no longer referred, to be reused'''
+        if len(self.released) < self.size:
+            self.released.append(rec)
+
+
 class RecordReader(object):
+    '''reader of the groups of records having the common source phrase
+
+    the table is read as binary file unless binary option is False,
+    so the phrases are compared in the same byte order as "LC_ALL=C sort"'''
     def __init__(self, tablePath, **options):
         self.RecordClass = options.get('RecordClass', MosesRecord)
-        self.tableFile = files.open(tablePath, 'r')
+        if options.get('binary', True):
+            self.tableFile = files.open(tablePath, 'rb')
+        else:
+            self.tableFile = files.open(tablePath, 'r')
         self.records = []
 
     def getRecords(self):
         line = self.tableFile.readline()
-        if line == "":
+        if not line:
             records = self.records
             self.records = []
             return records
@@ -178,7 +435,7 @@ def getAlignSet(strField):
 
 def getCounts(field):
 #    return map(getNumber, field.split())
-    return map(number.toNumber, field.split())
+    return list(map(number.toNumber, field.split()))
 
 def getNumber(anyNum, margin = 0):
     numFloat = float(anyNum)
@@ -207,16 +464,14 @@ def getRevAlignSet(aligns):
 
 
 def getMosesFeatures(field):
-    features = {}
-    scores = map(getNumber, field.split())
-    features[intern('fgep')] = scores[0]
-    features[intern('fgel')] = scores[1]
-    features[intern('egfp')] = scores[2]
-    features[intern('egfl')] = scores[3]
-    return features
+    scores = list(map(getNumber, field.split()))
+    return MosesFeatures(scores[0:4])
 
 def getStrMosesFeatures(dicFeatures):
     '''convert back the feature dictionary to score string separated by space'''
+    if isinstance(dicFeatures, MosesFeatures):
+        scores = [dicFeatures.fgep, dicFeatures.fgel, dicFeatures.egfp, dicFeatures.egfl]
+        return str.join(' ', [str(score) if score != None else '0' for score in scores])
     scores = []
     scores.append( dicFeatures.get('fgep', 0) )
     scores.append( dicFeatures.get('fgel', 0) )
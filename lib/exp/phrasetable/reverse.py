@@ -4,45 +4,36 @@
 '''function reversing phrase table'''
 
 import codecs
+import functools
 import gc
-import os
 import pprint
-import subprocess
 
-from exp.common import files
+from exp.common import extsort, files
 from exp.phrasetable import record
 
 pp = pprint.PrettyPrinter()
 
-PV = None
-if subprocess.call('which pv > /dev/null', shell = True) == 0:
-    PV = 'pv'
+def reverseLines(lines, RecordClass = record.MosesRecord):
+    '''iterate the reversed records of given lines'''
+    pool = record.RecordPool(RecordClass)
+    for line in lines:
+        rec = pool.get(line)
+        yield rec.getReversed().toStr()
+        pool.release(rec)
 
-def reverseTable(srcFile, saveFile, RecordClass = record.MosesRecord):
-    if type(srcFile) == str:
-        srcFile = files.open(srcFile)
+def reverseTable(srcFile, saveFile, RecordClass = record.MosesRecord, **options):
+    '''reverse the records and sort them in the same order as "LC_ALL=C sort"
+
+    options are passed to extsort.sortLines (jobs, memory, tmpdir, codec),
+    the records are reversed in the worker processes if the source table is a plain file'''
     if type(saveFile) == str:
-        if files.getExt(saveFile) == '.gz':
-            saveFile = open(saveFile, 'w')
-            pipeGzip = subprocess.Popen(['gzip'], stdin=subprocess.PIPE, stdout=saveFile)
-            saveFile = pipeGzip.stdin
+        if files.getCodecByExt(saveFile) != None:
+            saveFile = files.open(saveFile, 'wb')
         else:
-            saveFile = open(saveFile, 'w')
+            saveFile = open(saveFile, 'wb')
     gc.collect()
-    env = os.environ.copy()
-    env['LC_ALL'] = 'C'
-    if PV:
-        cmd = '%s -Wl -N "loaded lines" | sort | %s -Wl -N "sorted lines"' % (PV, PV)
-        pipeSort = subprocess.Popen(cmd, env=env, stdin=subprocess.PIPE, stdout=saveFile, close_fds=True, shell=True)
-    else:
-        pipeSort = subprocess.Popen(['sort'], env=env, stdin=subprocess.PIPE, stdout=saveFile, close_fds=True)
-    #inputSort = codecs.getwriter('utf-8')(pipeSort.stdin)
-    inputSort = pipeSort.stdin
-    for line in srcFile:
-        rec = RecordClass(line)
-        inputSort.write( rec.getReversed().toStr() )
-    pipeSort.stdin.close()
-    pipeSort.communicate()
+    options['convert'] = functools.partial(reverseLines, RecordClass = RecordClass)
+    extsort.sortLines(srcFile, saveFile, **options)
     saveFile.close()
 
 def reverseMosesTable(srcFile, saveFile):
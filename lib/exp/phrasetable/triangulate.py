@@ -6,20 +6,29 @@ by combining source-pivot and pivot-target for common pivot phrase'''
 
 import argparse
 import codecs
+import itertools
+import marshal
 import math
 import multiprocessing
 import os
+import pickle
 import pprint
 import sys
 import time
 
 from collections import defaultdict
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
 # my exp libs
-from exp.common import cache, debug, files, progress
+from exp.common import cache, debug, extsort, files, progress
+from exp.common.vocab import Vocabulary
 from exp.phrasetable import findutil
 from exp.phrasetable import lex, combine_lex
-from exp.phrasetable.record import MosesRecord
+from exp.phrasetable.record import MosesRecord, intern
 from exp.phrasetable.reverse import reverseTable
 
 # lower threshold of trans probs to abort
@@ -33,7 +42,15 @@ MINPROB = 10 ** -10
 NBEST = 20
 
 #PIVOT_QUEUE_SIZE = 2000
-PIVOT_QUEUE_SIZE = 1000
+#PIVOT_QUEUE_SIZE = 1000
+# limit number of batches waiting in the queues
+PIVOT_QUEUE_SIZE = 100
+
+# number of line pairs to put in the queue at once
+PIVOT_BATCH_SIZE = 1000
+
+# seconds to wait for the queue or the worker processes before checking whether they are alive
+WORKER_POLL_TIMEOUT = 1
 
 # methods to estimate trans probs (countmin/prodprob/bidirmin/bidirgmean/bidirmax/bidiravr)
 methods = ['countmin', 'prodprob', 'bidirmin', 'bidirgmean', 'bidirmax', 'bidiravr']
@@ -49,12 +66,36 @@ NULLS = 10**4
 
 NOPREFILTER = False
 
+# number of worker processes to pivot the records
+JOBS = 1
+
+# strategies to join the source-pivot and pivot-target records (search/merge)
+joins = ['search', 'merge']
+JOIN = 'search'
+
+# strategies to calculate backward trans probs for the count based methods
+# (stream: totaling the counts by target phrases in 2 passes, sort: reversing and sorting the table twice)
+backwards = ['stream', 'sort']
+BACKWARD = 'stream'
+
+# memory budget for the counts grouped by target phrases (in bytes)
+TRG_COUNTS_MEMORY = 512 * 1024 * 1024
+# estimated memory overhead of each count entry
+TRG_COUNT_OVERHEAD = 128
+# number of files to partition the spilled counts by the hash of target phrases
+TRG_COUNTS_PARTITIONS = 64
+
 # cache size for search history of target records
 #CACHESIZE = 1000
 CACHESIZE = 3000
 #CACHESIZE = 5000
 #CACHESIZE = 10000
 
+# number of records to calculate the lexical weights at once
+LEX_BATCH_SIZE = 10000
+# maximum number of the distinct alignment fields cached by LexWeightCalculator
+ALIGN_CACHE_SIZE = 100000
+
 pp = pprint.PrettyPrinter()
 
 class WorkSet:
@@ -63,14 +104,18 @@ class WorkSet:
         prefix = options.get('prefix', 'phrase')
         self.multiTarget = options.get('multiTarget', False)
         self.Record = options.get('RecordClass', MosesRecord)
+        self.jobs = options.get('jobs', JOBS)
+        # intermediate files are compressed by the codec if given
+        codec = options.get('codec', None)
+        ext = codec.ext if codec else ''
         self.method = method
 #        if method.find('multi') >= 0:
 #            self.multiTarget = True
 #            self.method = method.replace('multi','').replace('+','')
         self.nbest = NBEST
-        self.outQueue = multiprocessing.Queue()
+        self.outQueue = multiprocessing.Queue(PIVOT_QUEUE_SIZE)
         self.pivotCount = progress.Counter(scaleup = 1000)
-        self.pivotQueue = multiprocessing.Queue()
+        self.pivotQueue = multiprocessing.Queue(PIVOT_QUEUE_SIZE)
         self.savePath = savefile
         self.threshold = THRESHOLD
         self.workdir = workdir
@@ -78,26 +123,29 @@ class WorkSet:
 #            self.pivotPath = savefile
 #        if method in ('counts', 'hybrid'):
 #        else:
-        self.pivotPath = "%s/%s_pivot" % (workdir, prefix)
-        self.revPath = "%s/%s_reversed" % (workdir, prefix)
-        self.trgCountPath = "%s/%s_trg" % (workdir, prefix)
-        self.revTrgCountPath = "%s/%s_revtrg" % (workdir, prefix)
-        self.countPath = "%s/%s_pprobs" % (workdir, prefix)
+        self.pivotPath = "%s/%s_pivot%s" % (workdir, prefix, ext)
+        self.revPath = "%s/%s_reversed%s" % (workdir, prefix, ext)
+        self.trgCountPath = "%s/%s_trg%s" % (workdir, prefix, ext)
+        self.revTrgCountPath = "%s/%s_revtrg%s" % (workdir, prefix, ext)
+        self.countPath = "%s/%s_pprobs%s" % (workdir, prefix, ext)
         self.tableLexPath = '%s/table.lex' % (workdir)
         self.combinedLexPath = '%s/combined.lex' % (workdir)
 #        else:
 #          assert False, "Invalid method"
-        self.pivotProc = multiprocessing.Process( target = pivotRecPairs, args = (self,) )
+        self.pivotProcs = []
+        for index in range(self.jobs):
+            self.pivotProcs.append( multiprocessing.Process( target = pivotRecPairs, args = (self, index) ) )
         self.recordProc = multiprocessing.Process( target = writeRecordQueue, args = (self,) )
 
     def __del__(self):
         self.close()
 
     def close(self):
-        if self.pivotProc.pid:
-            if self.pivotProc.exitcode == None:
-                self.pivotProc.terminate()
-            self.pivotProc.join()
+        for pivotProc in self.pivotProcs:
+            if pivotProc.pid:
+                if pivotProc.exitcode == None:
+                    pivotProc.terminate()
+                pivotProc.join()
         if self.recordProc.pid:
             if self.recordProc.exitcode == None:
                 self.recordProc.terminate()
@@ -105,17 +153,62 @@ class WorkSet:
         self.pivotQueue.close()
         self.outQueue.close()
 
+    def getPartLexPath(self, index):
+        return '%s.%d' % (self.tableLexPath, index)
+
+    def checkWorkers(self):
+        '''terminate all the workers and raise RuntimeError if any of them has died'''
+        for proc in self.pivotProcs + [self.recordProc]:
+            if proc.exitcode not in (None, 0):
+                self.terminate()
+                raise RuntimeError("worker process %s exited with code %d" % (proc.name, proc.exitcode))
+
     def join(self):
-        self.pivotProc.join()
-        self.recordProc.join()
+        '''wait for all the workers to finish, checking that none of them has died'''
+        for proc in self.pivotProcs + [self.recordProc]:
+            while proc.exitcode == None:
+                proc.join(WORKER_POLL_TIMEOUT)
+                self.checkWorkers()
+        self.checkWorkers()
+
+    def put(self, item):
+        '''put the item into pivotQueue, checking the workers while the queue is full'''
+        while True:
+            try:
+                self.pivotQueue.put(item, timeout = WORKER_POLL_TIMEOUT)
+                return
+            except queue.Full:
+                self.checkWorkers()
+
+    def reduceLexCounts(self):
+        '''merge the word pair counts of all the workers and save them as table lex'''
+        lexCounts = lex.PairCounter()
+        for index in range(self.jobs):
+            partPath = self.getPartLexPath(index)
+            partFile = open(partPath, 'rb')
+            lexCounts.merge( pickle.load(partFile) )
+            partFile.close()
+            os.remove(partPath)
+        lexCounts.filterNBestByTrg()
+        lex.saveWordPairCounts(self.tableLexPath, lexCounts)
 
     def start(self):
-        self.pivotProc.start()
+        for pivotProc in self.pivotProcs:
+            pivotProc.start()
         self.recordProc.start()
 
+    def stop(self):
+        '''send the termination signals to all the workers'''
+        for index in range(self.jobs):
+            self.put(None)
+
     def terminate(self):
-        self.pivotProc.terminate()
-        self.recordProc.terminate()
+        for proc in self.pivotProcs + [self.recordProc]:
+            if proc.pid and proc.exitcode == None:
+                proc.terminate()
+        # nobody reads the queues any more, so the feeder threads must not be waited for at exit
+        self.pivotQueue.cancel_join_thread()
+        self.outQueue.cancel_join_thread()
 
 
 def updateFeatures(recPivot, recPair, method, multiTarget = False):
@@ -259,13 +352,21 @@ def calcPhraseTransProbsOnTable(tablePath, savePath, **options):
     method = options.get('method', METHOD)
     RecordClass = options.get('RecordClass', MosesRecord)
 
-    tableFile = files.open(tablePath, "r")
-    saveFile  = files.open(savePath, "w")
+    tableFile = files.open(tablePath, "rb")
+    saveFile  = files.open(savePath, "wb")
+    calcPhraseTransProbsOnLines(tableFile, saveFile, RecordClass)
+    saveFile.close()
+    tableFile.close()
+
+def calcPhraseTransProbsOnLines(lines, saveFile, RecordClass = MosesRecord):
+    '''calculate phrase trans probs on the lines grouped by source phrases, writing the records into the opened file
+
+    the lines are given as bytes, and written into the binary file'''
     records = {}
-    lastSrc = ''
-    for line in tableFile:
+    lastSrc = b''
+    for line in lines:
         rec = RecordClass(line)
-        key = "%s ||| %s |||" % (rec.src, rec.trg)
+        key = b"%s ||| %s |||" % (rec.src, rec.trg)
         if rec.src != lastSrc and records:
             calcPhraseTransProbsByCounts(records)
             writeRecords(saveFile, records)
@@ -276,9 +377,169 @@ def calcPhraseTransProbsOnTable(tablePath, savePath, **options):
     if records:
         calcPhraseTransProbsByCounts(records)
         writeRecords(saveFile, records)
-    saveFile.close()
+
+
+class TargetCounter(object):
+    '''co-occurrence counts of the phrase pairs grouped by target phrases
+
+    if exceeding the memory budget, the counts are spilled into the partition files by the hash of target phrases'''
+    def __init__(self, tmpdir, memory = TRG_COUNTS_MEMORY, partitions = TRG_COUNTS_PARTITIONS):
+        self.tmpdir = tmpdir
+        self.memory = memory
+        self.partitions = partitions
+        self.counts = defaultdict(list)
+        self.size = 0
+        self.partPaths = None
+
+    def add(self, trg, key, co):
+        self.counts[trg].append( (key, co) )
+        self.size += len(key) + TRG_COUNT_OVERHEAD
+        if self.size >= self.memory:
+            self.spill()
+
+    def spill(self):
+        if self.partPaths == None:
+            self.partPaths = ['%s/trgcounts.%d' % (self.tmpdir, index) for index in range(self.partitions)]
+            for path in self.partPaths:
+                open(path, 'wb').close()
+        partFiles = [open(path, 'ab') for path in self.partPaths]
+        for trg, pairs in self.counts.items():
+            marshal.dump( (trg, pairs), partFiles[hash(trg) % self.partitions] )
+        for partFile in partFiles:
+            partFile.close()
+        self.counts = defaultdict(list)
+        self.size = 0
+
+    def getTotals(self):
+        '''return the dictionary from target phrases to the totals of their co-occurrence counts'''
+        totals = {}
+        if self.partPaths == None:
+            for trg, pairs in self.counts.items():
+                totals[trg] = sumTrgCounts(pairs)
+        else:
+            self.spill()
+            for path in self.partPaths:
+                counts = defaultdict(list)
+                partFile = open(path, 'rb')
+                while True:
+                    try:
+                        (trg, pairs) = marshal.load(partFile)
+                    except EOFError:
+                        break
+                    counts[trg].extend(pairs)
+                partFile.close()
+                for trg, pairs in counts.items():
+                    totals[trg] = sumTrgCounts(pairs)
+        self.clear()
+        return totals
+
+    def clear(self):
+        if self.partPaths != None:
+            for path in self.partPaths:
+                if os.path.exists(path):
+                    os.remove(path)
+            self.partPaths = None
+        self.counts = defaultdict(list)
+        self.size = 0
+
+
+def sumTrgCounts(pairs):
+    '''total of the counts summed in the same order as calcSrcCount on the records of the reversed table'''
+    # the records are stored into the dictionary in the sorted order
+    records = {}
+    for key, co in sorted(pairs):
+        records[key] = co
+    total = 0
+    for co in records.values():
+        total += co
+    return total
+
+class ReversedTableWriter(object):
+    '''file-like object writing the reversed records of given lines keeping the order,
+    and totaling the co-occurrence counts by target phrases
+
+    sorted flag is cleared if the lines (given as bytes) are not in the sorted order of the phrase pairs'''
+    def __init__(self, revPath, RecordClass = MosesRecord, **options):
+        memory = options.get('memory', TRG_COUNTS_MEMORY)
+        tmpdir = options.get('tmpdir', os.path.dirname(revPath) or '.')
+        self.RecordClass = RecordClass
+        self.revFile = files.open(revPath, 'wb')
+        self.counter = TargetCounter(tmpdir, memory)
+        self.lastKey = None
+        self.sorted = True
+
+    def write(self, line):
+        '''write the reversed record of the line (given one by one)'''
+        rec = self.RecordClass(line)
+        key = b"%s ||| %s |||" % (rec.src, rec.trg)
+        if self.lastKey != None and key <= self.lastKey:
+            self.sorted = False
+        self.lastKey = key
+        revLine = rec.getReversed().toStr()
+        self.revFile.write(revLine)
+        revRec = self.RecordClass(revLine)
+        if revRec.counts.co > 0:
+            self.counter.add(revRec.src, b"%s ||| %s |||" % (revRec.src, revRec.trg), revRec.counts.co)
+
+    def close(self):
+        self.revFile.close()
+
+    def getTotals(self):
+        return self.counter.getTotals()
+
+    def clear(self):
+        self.counter.clear()
+
+
+def iterBackwardRecords(revPath, totals, RecordClass = MosesRecord):
+    '''iterate the records of the reversed table reversing back, with backward trans probs calculated by the totals'''
+    revFile = files.open(revPath, 'rb')
+    try:
+        for revLine in revFile:
+            revRec = RecordClass(revLine)
+            counts = revRec.counts
+            if counts.co > 0:
+                # same as calcPhraseTransProbsByCounts
+                srcCount = totals[revRec.src]
+                counts.src = srcCount
+                if srcCount > 0:
+                    revRec.features['egfp'] = counts.co / float(srcCount)
+                rec = RecordClass( revRec.toStr() )
+                yield rec.getReversed().toStr()
+    finally:
+        # stopping the read-ahead thread also when the consumer stops in the middle
+        revFile.close()
+
+def calcBackwardProbsOnTable(tablePath, revPath, savePath, **options):
+    '''calculate backward phrase trans probs and target counts without sorting the table
+
+    the first pass writes the reversed records into revPath keeping the order and totals the counts by target phrases,
+    and the second pass calculates the probs and reverses the records back, giving the same table as
+    reversing, calcPhraseTransProbsOnTable and reversing again.
+    return False without saving if the records are not in the sorted order of the phrase pairs'''
+    RecordClass = options.get('RecordClass', MosesRecord)
+    memory = options.get('memory', TRG_COUNTS_MEMORY)
+    tmpdir = options.get('tmpdir', os.path.dirname(revPath) or '.')
+
+    writer = ReversedTableWriter(revPath, RecordClass, memory = memory, tmpdir = tmpdir)
+    tableFile = files.open(tablePath, 'rb')
+    for line in tableFile:
+        writer.write(line)
+        if not writer.sorted:
+            # the order of the output would differ from the sorted one
+            break
+    writer.close()
     tableFile.close()
+    if not writer.sorted:
+        writer.clear()
+        return False
 
+    totals = writer.getTotals()
+    saveFile = files.open(savePath, 'wb')
+    for line in iterBackwardRecords(revPath, totals, RecordClass):
+        saveFile.write(line)
+    saveFile.close()
+    return True
 
 def calcSrcCount(records):
     '''calculate source phrase occurrence counts by co-occurrence counts'''
@@ -290,7 +551,7 @@ def calcSrcCount(records):
 def updateWordPairCounts(lexCounts, records):
     '''find word pairs in phrase pairs, and update the counts of word pairs'''
     if len(records) > 0:
-        srcSymbols = records.values()[0].srcSymbols
+        srcSymbols = next(iter(records.values())).srcSymbols
         if len(srcSymbols) == 1:
            for rec in records.values():
                trgSymbols = rec.trgSymbols
@@ -302,160 +563,186 @@ def flattenRecords(records, sort = False):
     '''if records are type of dict, return them as a list'''
     if type(records) == dict:
         if sort:
-            recordList = []
-            for key in sorted(records.keys()):
-              recordList.append(records[key])
-            return recordList
+            # in the order of the target phrases whatever the keys are
+            return sorted(records.values(), key = getTrgKey)
         else:
             return records.values()
     elif type(records) == list:
         if sort:
-            return sorted(records)
+            return sorted(records, key = getTrgKey)
         else:
             return records
     else:
         assert False, "Invalid records"
 
-def pivotRecPairs(workset):
-    '''combine the source-pivot and pivot-target records for common pivot phrases
-
-    get the list of record pairs in pivotQueue and put the processed data in outQueue
+def pivotRecords(workset, rows, lexCounts):
+    '''combine the pairs of source-pivot and pivot-target records having the common source phrase
 
     if workset.method == "prodprob", estimate trans probs by marginalization
     otherwise, calculate them by estimating co-occurrence counts
     '''
-    lexCounts = lex.PairCounter()
-
-    while True:
-        # get the list of record pairs to pivot
-        rows = workset.pivotQueue.get()
-        if rows == None:
-            # when getting None, finish the process
-            break
-        records = {}
+    # records are keyed by the IDs of their target phrases given for this source phrase,
+    # and sorted by the phrases (getTrgKey) only where the order matters
+    trgVocab = Vocabulary()
+    records = {}
+    if workset.multiTarget:
+        multiVocab = Vocabulary()
+        multiRecords = {}
+    for recPair in rows:
+        trgId = trgVocab.getId(recPair[1].trg)
         if workset.multiTarget:
-            multiRecords = {}
-        for recPair in rows:
-            trgKey = recPair[1].trg + ' |||'
-            if workset.multiTarget:
-                strMultiTrg = intern(recPair[1].trg + ' |COL| ' + recPair[0].trg)
-                multiKey = strMultiTrg + ' |||'
-            if not trgKey in records:
-                # source-target record not yet exists, so making new record
-                recPivot = workset.Record()
-                recPivot.src = recPair[0].src
-                recPivot.trg = recPair[1].trg
-                records[trgKey] = recPivot
-            recPivot = records[trgKey]
-            if workset.multiTarget:
-                recMulti = workset.Record()
-                recMulti.src = recPair[0].src
-                recMulti.trg = strMultiTrg
-                multiRecords[multiKey] = recMulti
-            # estimating updated features
-            updateFeatures(recPivot, recPair, workset.method)
-            # updating the count of phrase pair
-            updateCounts(recPivot, recPair, workset.method)
-            # merging the word alignments
-            mergeAligns(recPivot, recPair)
-            if workset.multiTarget:
-                updateFeatures(recMulti, recPair, workset.method, multiTarget = True)
-                updateCounts(recMulti, recPair, workset.method)
-                mergeAligns(recMulti, recPair)
-        # at this time, all the source-target records are determined for given source
+            strMultiTrg = intern(recPair[1].trg + ' |COL| ' + recPair[0].trg)
+            multiId = multiVocab.getId(strMultiTrg)
+        if not trgId in records:
+            # source-target record not yet exists, so making new record
+            recPivot = workset.Record()
+            recPivot.src = recPair[0].src
+            recPivot.trg = recPair[1].trg
+            records[trgId] = recPivot
+        recPivot = records[trgId]
         if workset.multiTarget:
-            # copying the estimated features of source-target records to source-target-pivot records
-            for multiKey, recMulti in multiRecords.items():
-                trgPair = recMulti.trg.split(' |COL| ')
-                recPivot = records[trgPair[0]+' |||']
-                for featureKey in ['egfl', 'egfp', 'fgel', 'fgep']:
-                    recMulti.features['0'+featureKey] = recPivot.features[featureKey]
-        if workset.method != 'prodprob':
-            # find word pairs in phrase pairs and update the counts of word pairs
-            updateWordPairCounts(lexCounts, records)
-            # filtering n-best records by co-occurrence counts
-            if not NOPREFILTER:
-                if workset.nbest > 0:
-                    if len(records) > workset.nbest:
-                        scores = []
-                        for key, rec in records.items():
-                            scores.append( (rec.counts.co, key) )
-                        scores.sort(reverse = True)
-                        bestRecords = {}
-                        for _, key in scores[:workset.nbest]:
-                            bestRecords[key] = records[key]
-                        records = bestRecords
-            # calculate forward phrase trans probs
-            calcPhraseTransProbsByCounts(records)
-        # if threshold is set (non-zero), aborting the records having trans probs under it
-        if workset.threshold < 0:
-            # aborting records for extremely small trans probs
-            ignoring = []
+            recMulti = workset.Record()
+            recMulti.src = recPair[0].src
+            recMulti.trg = strMultiTrg
+            multiRecords[multiId] = recMulti
+        # estimating updated features
+        updateFeatures(recPivot, recPair, workset.method)
+        # updating the count of phrase pair
+        updateCounts(recPivot, recPair, workset.method)
+        # merging the word alignments
+        mergeAligns(recPivot, recPair)
+        if workset.multiTarget:
+            updateFeatures(recMulti, recPair, workset.method, multiTarget = True)
+            updateCounts(recMulti, recPair, workset.method)
+            mergeAligns(recMulti, recPair)
+    # at this time, all the source-target records are determined for given source
+    if workset.multiTarget:
+        # copying the estimated features of source-target records to source-target-pivot records
+        for recMulti in multiRecords.values():
+            trgPair = recMulti.trg.split(' |COL| ')
+            recPivot = records[trgVocab.getId(trgPair[0], False)]
+            for featureKey in ['egfl', 'egfp', 'fgel', 'fgep']:
+                recMulti.features['0'+featureKey] = recPivot.features[featureKey]
+    if workset.method != 'prodprob':
+        # find word pairs in phrase pairs and update the counts of word pairs
+        updateWordPairCounts(lexCounts, records)
+        # filtering n-best records by co-occurrence counts
+        if not NOPREFILTER:
+            if workset.nbest > 0:
+                if len(records) > workset.nbest:
+                    scores = []
+                    for key, rec in records.items():
+                        scores.append( (rec.counts.co, getTrgKey(rec), key) )
+                    scores.sort(reverse = True)
+                    bestRecords = {}
+                    for _, _, key in scores[:workset.nbest]:
+                        bestRecords[key] = records[key]
+                    records = bestRecords
+        # calculate forward phrase trans probs
+        calcPhraseTransProbsByCounts(records)
+    # if threshold is set (non-zero), aborting the records having trans probs under it
+    if workset.threshold < 0:
+        # aborting records for extremely small trans probs
+        ignoring = []
+        for key, rec in records.items():
+            if rec[0]['fgep'] < workset.threshold and rec[0]['egfp'] < workset.threshold:
+                ignoring.append(pair)
+        for key in ignoring:
+            del records[key]
+    # if limit number of records is set (non-zero), filter the n-best records by forward trans probs
+    if workset.nbest > 0:
+        if len(records) > workset.nbest:
+            scores = []
             for key, rec in records.items():
-                if rec[0]['fgep'] < workset.threshold and rec[0]['egfp'] < workset.threshold:
-                    ignoring.append(pair)
-            for key in ignoring:
-                del records[key]
-        # if limit number of records is set (non-zero), filter the n-best records by forward trans probs
-        if workset.nbest > 0:
-            if len(records) > workset.nbest:
+                scores.append( (rec.features['egfp'], getTrgKey(rec), key) )
+            scores.sort(reverse = True)
+            bestRecords = {}
+            for _, _, key in scores[:workset.nbest]:
+                bestRecords[key] = records[key]
+            records = bestRecords
+        if workset.multiTarget:
+            if len(multiRecords) > workset.nbest:
+                # T1-filtering method
+                bestTrgRecords = {}
+                # first, filtering src-pvt-trg records including n-best src-trg records
+                for multiId, recMulti in multiRecords.items():
+                    for trgId, rec in records.items():
+                        if recMulti.trg.find(rec.trg + ' |COL|') == 0:
+                            bestTrgRecords.setdefault(trgId, [])
+                            bestTrgRecords[trgId].append( (multiId, recMulti) )
+                bestMultiRecords = {}
+                # second, filtering n-best by forward joint trans probs
+                # (the ties are won by the first pivot in the order of the table, as the IDs are given)
+                for trgId, multiList in bestTrgRecords.items():
+                    bestMultiId = None
+                    bestForwardJointTransProb = 0
+                    for multiId, multiRec in multiList:
+                        if multiRec.features['egfp'] > bestForwardJointTransProb:
+                            bestMultiId = multiId
+                            bestForwardJointTransProb = multiRec.features['egfp']
+                    if bestMultiId != None:
+                        bestMultiRecords[bestMultiId] = multiRecords[bestMultiId]
+                # filling n-best records by (s->t,s->t,p)
                 scores = []
-                for key, rec in records.items():
-                    scores.append( (rec.features['egfp'],key) )
+                for multiId, recMulti in multiRecords.items():
+                    scores.append( (recMulti.features['0egfp'], recMulti.features['egfp'], getTrgKey(recMulti), multiId) )
                 scores.sort(reverse = True)
-                bestRecords = {}
-                for _, key in scores[:workset.nbest]:
-                    bestRecords[key] = records[key]
-                records = bestRecords
-            if workset.multiTarget:
-                if len(multiRecords) > workset.nbest:
-                    # T1-filtering method
-                    bestTrgRecords = {}
-                    # first, filtering src-pvt-trg records including n-best src-trg records
-                    for multiKey, recMulti in multiRecords.items():
-                        for rec in records.values():
-                            if multiKey.find(rec.trg + ' |COL|') == 0:
-                                bestTrgRecords.setdefault(rec.trg, [])
-                                bestTrgRecords[rec.trg].append(recMulti)
-                    bestMultiRecords = {}
-                    # second, filtering n-best by forward joint trans probs
-                    for trgKey, multiList in bestTrgRecords.items():
-                        bestMultiRec = None
-                        bestForwardJointTransProb = 0
-                        for multiRec in multiList:
-                            if multiRec.features['egfp'] > bestForwardJointTransProb:
-                                bestMultiRec = multiRec
-                                bestForwardJointTransProb = multiRec.features['egfp']
-                        if bestMultiRec:
-                            bestMultiRecords[bestMultiRec.trg] = bestMultiRec
-                    # filling n-best records by (s->t,s->t,p)
-                    scores = []
-                    for multiKey, recMulti in multiRecords.items():
-                        scores.append( (recMulti.features['0egfp'],recMulti.features['egfp'],multiKey) )
-                    scores.sort(reverse = True)
-                    for _, _, multiKey in scores:
-                        if len(bestMultiRecords) >= workset.nbest:
-                            break
+                for _, _, _, multiId in scores:
+                    if len(bestMultiRecords) >= workset.nbest:
+                        break
+                    else:
+                        if multiId in bestMultiRecords:
+                            pass
                         else:
-                            if multiKey in bestMultiRecords:
-                                pass
-                            else:
-                                bestMultiRecords[multiKey] = multiRecords[multiKey]
-                    multiRecords = bestMultiRecords
-        if workset.multiTarget:
-            records = multiRecords
-        # putting the records into outQueue, and other process will write them in table file
-        if records:
+                            bestMultiRecords[multiId] = multiRecords[multiId]
+                multiRecords = bestMultiRecords
+    if workset.multiTarget:
+        records = multiRecords
+    return records
+
+
+def pivotRecPairs(workset, index = 0):
+    '''combine the source-pivot and pivot-target records for common pivot phrases
+
+    get the numbered batch of source-pivot and pivot-target line pairs in pivotQueue,
+    and put the formatted lines of processed records in outQueue with the same number,
+    so the writer can restore the order of outputs from multiple workers
+    '''
+    lexCounts = lex.PairCounter()
+    Record = workset.Record
+
+    while True:
+        # get the batch of line pairs to pivot
+        item = workset.pivotQueue.get()
+        if item == None:
+            # when getting None, finish the process
+            break
+        (seq, groups) = item
+        buf = []
+        recSrc = None
+        for lines in groups:
+            # parsing the lines into the record pairs, sharing the source record
+            rows = []
+            for (srcLine, trgLine) in lines:
+                if recSrc == None or srcLine != lastLine:
+                    recSrc = Record(srcLine)
+                    lastLine = srcLine
+                rows.append( [recSrc, Record(trgLine)] )
+            records = pivotRecords(workset, rows, lexCounts)
             workset.pivotCount.add( len(records) )
-            for trgKey in sorted(records.keys()):
-                rec = records[trgKey]
-                workset.outQueue.put( rec )
+            for rec in flattenRecords(records, sort = True):
+                if rec.counts.co > 0:
+                    buf.append( rec.toStr() )
+        # putting the formatted records into outQueue, and other process will write them in table file
+        workset.outQueue.put( (seq, str.join('', buf)) )
     # exiting from while loop
-    # terminate also writeRecords process
+    # notify writeRecords process the termination of this worker
     workset.outQueue.put(None)
     if workset.method != 'prodprob':
-        lexCounts.filterNBestByTrg()
-        lex.saveWordPairCounts(workset.tableLexPath, lexCounts)
+        # saving the partial word pair counts to be reduced
+        partFile = open(workset.getPartLexPath(index), 'wb')
+        pickle.dump(lexCounts, partFile, pickle.HIGHEST_PROTOCOL)
+        partFile.close()
 
 
 def writeRecords(fileObj, records):
@@ -466,30 +753,39 @@ def writeRecords(fileObj, records):
 
 
 def writeRecordQueue(workset):
-    '''write the pivoted records in the queue into the table file'''
+    '''write the formatted records in the queue into the table file'''
     pivotFile = files.open(workset.pivotPath, 'w')
-    while True:
-        rec = workset.outQueue.get()
-        if rec == None:
-            # if getting None, finish the loop
-            break
-        if rec.counts.co > 0:
-            pivotFile.write( rec.toStr() )
+    # formatted records waiting for the preceding ones, by the sequence number
+    pending = {}
+    nextSeq = 0
+    running = workset.jobs
+    while running > 0:
+        item = workset.outQueue.get()
+        if item == None:
+            # if getting None from all the workers, finish the loop
+            running -= 1
+            continue
+        (seq, buf) = item
+        pending[seq] = buf
+        while nextSeq in pending:
+            pivotFile.write( pending.pop(nextSeq) )
+            nextSeq += 1
     pivotFile.close()
 
 
 class PivotFinder:
-    def __init__(self, table1, table2, index1, index2, RecordClass = MosesRecord):
+    def __init__(self, table1, table2, index1, index2, RecordClass = MosesRecord, blockIndex2 = None):
         self.srcFile = files.open(table1, 'r')
-        self.trgFile = files.open(table2, 'r')
         self.srcIndices = findutil.loadIndices(index1)
-        self.trgIndices = findutil.loadIndices(index2)
+        self.trgTable = findutil.MappedTable(table2, phrases = index2, blockIndex = blockIndex2)
         self.srcCount = progress.Counter(scaleup = 1000)
+        self.total = len(self.srcIndices)
         self.rows = []
         self.rowsCache = cache.Cache(size = CACHESIZE)
         self.Record = RecordClass
 
     def getRow(self):
+        '''return the pair of source-pivot and pivot-target lines having the common pivot phrase'''
         if self.rows == None:
             return None
         while len(self.rows) == 0:
@@ -502,38 +798,155 @@ class PivotFinder:
         return self.rows.pop(0)
 
     def makePivot(self, srcLine):
-        recSrc = self.Record(srcLine)
-        pivotPhrase = recSrc.trg
-        if pivotPhrase in self.rowsCache:
-            trgLines = self.rowsCache[pivotPhrase]
-            self.rowsCache.use(pivotPhrase)
+        pivotPhrase = srcLine.split('|||', 2)[1].strip()
+        # the lines are cached by the offset of their block, identifying the pivot phrase
+        span = self.trgTable.locate(pivotPhrase)
+        if not span:
+            return
+        if span[0] in self.rowsCache:
+            trgLines = self.rowsCache.use(span[0])
         else:
-            trgLines = findutil.searchIndexed(self.trgFile, self.trgIndices, pivotPhrase)
-            self.rowsCache[pivotPhrase] = trgLines
+            trgLines = self.trgTable.getLines(span[0], span[1])
+            self.rowsCache[span[0]] = trgLines
         for trgLine in trgLines:
-            recTrg = self.Record(trgLine)
-            self.rows.append( [recSrc, recTrg] )
+            self.rows.append( (srcLine, trgLine) )
 
     def close(self):
         self.srcFile.close()
-        self.trgFile.close()
+        if hasattr(self.srcIndices, 'close'):
+            # the text index is loaded as list
+            self.srcIndices.close()
+        self.trgTable.close()
         self.rowsCache = None
 
+
+class MergeJoinFinder:
+    '''alternative of PivotFinder joining the tables by sequential scans instead of random access
+
+    the source-pivot table is externally sorted by pivot phrases, merged with the pivot-target table,
+    and the joined pairs of lines are sorted again by source-pivot lines (both sorted by extsort in C order)'''
+    def __init__(self, table1, table2, workdir, prefix = 'phrase', RecordClass = MosesRecord, codec = None):
+        # intermediate files and spilled runs are compressed by the codec if given
+        ext = codec.ext if codec else ''
+        self.srcByPvtPath = "%s/%s_src-pvt_bypvt%s" % (workdir, prefix, ext)
+        self.joinedPath = "%s/%s_joined%s" % (workdir, prefix, ext)
+        self.workdir = workdir
+        self.codec = codec
+        self.srcCount = progress.Counter(scaleup = 1000)
+        self.lastLine = None
+        progress.log("sorting %s table by pivot into: %s\n" % (prefix, self.srcByPvtPath))
+        self.sortByPivot(table1)
+        progress.log("joining %s tables into: %s\n" % (prefix, self.joinedPath))
+        self.total = self.join(table2)
+        self.joinedFile = files.open(self.joinedPath, 'r')
+
+    def sortByPivot(self, table1):
+        '''sort the source-pivot lines prefixed with the pivot phrase key'''
+        srcFile = files.open(table1, 'r')
+        extsort.sortLines(srcFile, self.srcByPvtPath, convert = prefixPivotKeys, tmpdir = self.workdir, codec = self.codec)
+        srcFile.close()
+
+    def join(self, table2):
+        '''merge the sorted tables on pivot phrases and sort the joined line pairs, returning the number of pairs'''
+        self.numPairs = 0
+        extsort.sortLines(self.iterJoinedLines(table2), self.joinedPath, tmpdir = self.workdir, codec = self.codec)
+        return self.numPairs
+
+    def iterJoinedLines(self, table2):
+        '''iterate the source-pivot and pivot-target lines having the common pivot phrase, joined by the tab'''
+        srcGroups = iterGroups(files.open(self.srcByPvtPath, 'r'), getSortKey)
+        trgGroups = iterGroups(files.open(table2, 'r'), getPhraseKey)
+        try:
+            srcGroup = next(srcGroups, None)
+            trgGroup = next(trgGroups, None)
+            while srcGroup and trgGroup:
+                if srcGroup[0] < trgGroup[0]:
+                    srcGroup = next(srcGroups, None)
+                elif srcGroup[0] > trgGroup[0]:
+                    trgGroup = next(trgGroups, None)
+                else:
+                    for srcLine in srcGroup[1]:
+                        srcLine = srcLine[srcLine.find("\t")+1:].rstrip("\n")
+                        for trgLine in trgGroup[1]:
+                            yield srcLine + "\t" + trgLine
+                            self.numPairs += 1
+                    srcGroup = next(srcGroups, None)
+                    trgGroup = next(trgGroups, None)
+        finally:
+            # closing the files of the remaining groups
+            srcGroups.close()
+            trgGroups.close()
+
+    def getRow(self):
+        '''return the pair of source-pivot and pivot-target lines having the common pivot phrase'''
+        line = self.joinedFile.readline()
+        if not line:
+            return None
+        self.srcCount.add()
+        (srcLine, trgLine) = line.split("\t", 1)
+        if srcLine == self.lastLine:
+            # sharing the same object to be pickled once
+            srcLine = self.lastLine
+        self.lastLine = srcLine
+        return (srcLine, trgLine)
+
+    def close(self):
+        self.joinedFile.close()
+
+
+def getPhraseKey(line):
+    '''return the source phrase key "phrase |||" of the line'''
+    return line[:line.find(' |||')+4]
+
+def getTrgKey(rec):
+    '''return the target phrase key "phrase |||" of the record, in the same type (bytes or text) as the phrase'''
+    if isinstance(rec.trg, bytes):
+        return rec.trg + b' |||'
+    return rec.trg + ' |||'
+
+def prefixPivotKeys(lines):
+    '''iterate the source-pivot lines prefixed with their pivot phrase keys to sort by them'''
+    for line in lines:
+        yield line.split('|||', 2)[1].strip() + ' |||' + "\t" + line
+
+def getSortKey(line):
+    '''return the key prefixed to the line for sorting'''
+    return line[:line.find("\t")]
+
+def iterGroups(fileObj, getKey):
+    '''yield (key, lines) for each group of consecutive lines having the common key'''
+    lastKey = None
+    lines = []
+    try:
+        for line in fileObj:
+            key = getKey(line)
+            if key != lastKey and lines:
+                yield (lastKey, lines)
+                lines = []
+            lastKey = key
+            lines.append(line)
+        if lines:
+            yield (lastKey, lines)
+    finally:
+        # closing also when the consumer stops in the middle
+        fileObj.close()
+
 def calcLexWeight(rec, lexCounts, reverse = False):
 #    minProb = 10 ** -2
     lexWeight = 1
 #    alignMapRev = rec.alignMapRev
+    null = lexCounts.null
     if not reverse:
-        minProb  = 1 / float(lexCounts.trgCounts["NULL"])
+        minProb  = 1 / float(lexCounts.trgCounts[null])
         # for forward probs, using reversed alignment map
         alignMap = rec.alignMapRev
-        srcTerms = rec.srcTerms
-        trgTerms = rec.trgTerms
+        srcTerms = lexCounts.getKeys(rec.srcTerms)
+        trgTerms = lexCounts.getKeys(rec.trgTerms)
     else:
-        minProb = 1 / float(lexCounts.srcCounts["NULL"])
+        minProb = 1 / float(lexCounts.srcCounts[null])
         alignMap = rec.alignMap
-        srcTerms = rec.trgTerms
-        trgTerms = rec.srcTerms
+        srcTerms = lexCounts.getKeys(rec.trgTerms)
+        trgTerms = lexCounts.getKeys(rec.srcTerms)
     minProb = MINPROB
     for trgIndex in range(len(trgTerms)):
         trgTerm = trgTerms[trgIndex]
@@ -555,29 +968,235 @@ def calcLexWeight(rec, lexCounts, reverse = False):
         else:
           if not reverse:
 #              lexWeight *= lexCounts.calcLexProb("NULL", trgTerm)
-              trgProb = lexCounts.calcLexProb("NULL", trgTerm)
+              trgProb = lexCounts.calcLexProb(null, trgTerm)
           else:
 #              lexWeight *= lexCounts.calcLexProb(trgTerm, "NULL")
-              trgProb = lexCounts.calcLexProb(trgTerm, "NULL")
+              trgProb = lexCounts.calcLexProb(trgTerm, null)
         lexWeight *= max(trgProb, minProb)
     return lexWeight
 
-def calcLexWeights(tablePath, lexCounts, savePath, RecordClass = MosesRecord):
+class LexWeightCalculator(object):
+    '''calculator of the lexical weights in both directions at once, giving the same weights as calcLexWeight
+
+    the words are numbered by the vocabulary, and the word trans probs are cached in the lists indexed by the IDs:
+    the probs with NULL by the words, and the probs of both directions by the target IDs in the rows of the source IDs,
+    so the lex counts are looked up only once for each pair'''
+    def __init__(self, lexCounts):
+        self.lexCounts = lexCounts
+        self.null = lexCounts.getWord(lexCounts.null)
+        self.vocab = Vocabulary()
+        # lexCounts.calcLexProb(null, word) and lexCounts.calcLexProb(word, null) by the word IDs (None until used)
+        self.nullProbs = []
+        self.probsNull = []
+        # (calcLexProb, calcLexProbRev) of the word pairs, by the target IDs in the rows of the source IDs
+        self.pairRows = []
+        # (alignMap, alignMapRev, sorted alignments) by the alignment field
+        self.alignMaps = {}
+        # word IDs of the last source phrase, shared by the records grouped by the source phrases
+        self.lastSrc = None
+        self.lastSrcIds = None
+
+    def getIds(self, words):
+        '''return the list of the IDs of given words, adding the new words'''
+        ids = self.vocab.getIdMap()
+        wordIds = []
+        for word in words:
+            wordId = ids.get(word)
+            if wordId == None:
+                wordId = self.vocab.getId(word)
+                self.nullProbs.append(None)
+                self.probsNull.append(None)
+                self.pairRows.append({})
+            wordIds.append(wordId)
+        return wordIds
+
+    def getProb(self, srcWord, trgWord):
+        lexCounts = self.lexCounts
+        return lexCounts.calcLexProb(lexCounts.getKey(srcWord), lexCounts.getKey(trgWord))
+
+    def getNullProb(self, trgId):
+        prob = self.nullProbs[trgId] = self.getProb(self.null, self.vocab.getWord(trgId))
+        return prob
+
+    def getProbNull(self, srcId):
+        prob = self.probsNull[srcId] = self.getProb(self.vocab.getWord(srcId), self.null)
+        return prob
+
+    def getPairProbs(self, srcId, trgId):
+        lexCounts = self.lexCounts
+        srcKey = lexCounts.getKey( self.vocab.getWord(srcId) )
+        trgKey = lexCounts.getKey( self.vocab.getWord(trgId) )
+        probs = (lexCounts.calcLexProb(srcKey, trgKey), lexCounts.calcLexProbRev(srcKey, trgKey))
+        self.pairRows[srcId][trgId] = probs
+        return probs
+
+    def getAlignMaps(self, rec):
+        '''return (alignMap, alignMapRev) of the record, in the same order as rec.alignMap and rec.alignMapRev'''
+        field = rec.getRawAligns()
+        maps = self.alignMaps.get(field) if field != None else None
+        if maps == None:
+            aligns = rec.aligns
+            alignMap = {}
+            alignMapRev = {}
+            for align in aligns:
+                (srcIndex, trgIndex) = map(int, align.split('-'))
+                alignMap.setdefault(srcIndex, []).append(trgIndex)
+                alignMapRev.setdefault(trgIndex, []).append(srcIndex)
+            maps = (alignMap, alignMapRev, str.join(' ', sorted(aligns)))
+            if field != None:
+                if len(self.alignMaps) >= ALIGN_CACHE_SIZE:
+                    self.alignMaps.clear()
+                self.alignMaps[field] = maps
+        else:
+            # written as the decoded alignments would be
+            rec.aligns = maps[2]
+        return maps[0:2]
+
+    def calcWeights(self, rec):
+        '''return (egfl, fgel) of the record'''
+        if rec.src != self.lastSrc:
+            self.lastSrcIds = self.getIds(rec.srcTerms)
+            self.lastSrc = rec.src
+        srcIds = self.lastSrcIds
+        trgIds = self.getIds(rec.trgTerms)
+        (alignMap, alignMapRev) = self.getAlignMaps(rec)
+        pairRows = self.pairRows
+        if type(rec) == MosesRecord:
+            extra = 0
+        else:
+            extra = 1
+        egfl = 1
+        nullProbs = self.nullProbs
+        for trgIndex, trgId in enumerate(trgIds):
+            srcIndices = alignMapRev.get(trgIndex)
+            if srcIndices:
+                trgSumProb = 0
+                for srcIndex in srcIndices:
+                    srcId = srcIds[srcIndex]
+                    probs = pairRows[srcId].get(trgId)
+                    if probs is None:
+                        probs = self.getPairProbs(srcId, trgId)
+                    trgSumProb += probs[0]
+                trgProb = trgSumProb / (len(srcIndices) + extra)
+            else:
+                trgProb = nullProbs[trgId]
+                if trgProb is None:
+                    trgProb = self.getNullProb(trgId)
+            if trgProb < MINPROB:
+                trgProb = MINPROB
+            egfl *= trgProb
+        fgel = 1
+        probsNull = self.probsNull
+        for srcIndex, srcId in enumerate(srcIds):
+            trgIndices = alignMap.get(srcIndex)
+            if trgIndices:
+                srcSumProb = 0
+                row = pairRows[srcId]
+                for trgIndex in trgIndices:
+                    trgId = trgIds[trgIndex]
+                    probs = row.get(trgId)
+                    if probs is None:
+                        probs = self.getPairProbs(srcId, trgId)
+                    srcSumProb += probs[1]
+                srcProb = srcSumProb / (len(trgIndices) + extra)
+            else:
+                srcProb = probsNull[srcId]
+                if srcProb is None:
+                    srcProb = self.getProbNull(srcId)
+            if srcProb < MINPROB:
+                srcProb = MINPROB
+            fgel *= srcProb
+        return (egfl, fgel)
+
+    def calcRecords(self, lines, RecordClass = MosesRecord):
+        '''return the lines of the records updated with the lexical weights'''
+        buf = []
+        for line in lines:
+            rec = RecordClass(line)
+            (egfl, fgel) = self.calcWeights(rec)
+            if rec.trg.find('|COL|') < 0:
+                rec.features['egfl'] = egfl
+                rec.features['fgel'] = fgel
+            else:
+                rec.features['0egfl'] = egfl
+                rec.features['0fgel'] = fgel
+            buf.append( rec.toStr() )
+        return buf
+
+
+def calcLexWeights(tablePath, lexCounts, savePath, RecordClass = MosesRecord, jobs = 1):
+    '''calculate the lexical weights of the table records
+
+    with multiple jobs, the plain table is split into byte ranges calculated by the worker processes
+    sharing the lex counts saved as memory-mapped binary lexicon'''
+    if jobs > 1 and not files.isCompressed(tablePath):
+        calcLexWeightsParallel(tablePath, lexCounts, savePath, RecordClass, jobs)
+        return
     tableFile = files.open(tablePath, 'r')
     saveFile  = files.open(savePath, 'w')
-    for line in tableFile:
-        rec = RecordClass(line)
-        if rec.trg.find('|COL|') < 0:
-            rec.features['egfl'] = calcLexWeight(rec, lexCounts, reverse = False)
-            rec.features['fgel'] = calcLexWeight(rec, lexCounts, reverse = True)
-            saveFile.write( rec.toStr() )
-        else:
-            rec.features['0egfl'] = calcLexWeight(rec, lexCounts, reverse = False)
-            rec.features['0fgel'] = calcLexWeight(rec, lexCounts, reverse = True)
-            saveFile.write( rec.toStr() )
+    calculator = LexWeightCalculator(lexCounts)
+    while True:
+        lines = list( itertools.islice(tableFile, LEX_BATCH_SIZE) )
+        if not lines:
+            break
+        saveFile.write( str.join('', calculator.calcRecords(lines, RecordClass)) )
     saveFile.close()
     tableFile.close()
 
+def calcLexWeightsParallel(tablePath, lexCounts, savePath, RecordClass, jobs):
+    lexPath = '%s.lex%s' % (tablePath, lex.BINARY_EXT)
+    lex.saveBinaryWordPairCounts(lexPath, lexCounts)
+    procs = []
+    partPaths = []
+    for index, (start, end) in enumerate(files.getLineRanges(tablePath, jobs)):
+        partPath = '%s.%d' % (savePath, index)
+        args = (tablePath, lexPath, partPath, start, end, RecordClass)
+        procs.append( multiprocessing.Process(target = calcLexWeightsRange, args = args) )
+        partPaths.append(partPath)
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
+    os.remove(lexPath)
+    for proc, partPath in zip(procs, partPaths):
+        if proc.exitcode != 0:
+            raise RuntimeError("failed to calculate lex weights into: %s" % partPath)
+    # concatenating the outputs of the workers in order
+    saveFile = files.open(savePath, 'w')
+    for partPath in partPaths:
+        partFile = open(partPath, 'r')
+        for line in partFile:
+            saveFile.write(line)
+        partFile.close()
+        os.remove(partPath)
+    saveFile.close()
+
+def calcLexWeightsRange(tablePath, lexPath, partPath, start, end, RecordClass = MosesRecord):
+    '''calculate the lexical weights of the records in the byte range [start, end) of the plain table'''
+    lexicon = lex.MappedLexicon(lexPath)
+    calculator = LexWeightCalculator(lexicon)
+    tableFile = open(tablePath, 'rb')
+    tableFile.seek(start)
+    partFile = open(partPath, 'w')
+    pos = start
+    lines = []
+    while pos < end:
+        line = tableFile.readline()
+        if not line:
+            break
+        pos += len(line)
+        if str is not bytes:
+            line = line.decode('utf-8')
+        lines.append(line)
+        if len(lines) >= LEX_BATCH_SIZE or pos >= end:
+            partFile.write( str.join('', calculator.calcRecords(lines, RecordClass)) )
+            lines = []
+    if lines:
+        partFile.write( str.join('', calculator.calcRecords(lines, RecordClass)) )
+    partFile.close()
+    tableFile.close()
+    lexicon.close()
+
 
 def pivot(table1, table2, savefile="phrase-table.gz", workdir=".", **options):
     '''find pair of source-pivot and pivot-target records for common pivot phrase'''
@@ -592,6 +1211,12 @@ def pivot(table1, table2, savefile="phrase-table.gz", workdir=".", **options):
         lexMethod = options.get('lexmethod', LEX_METHOD)
         numNulls  = options.get('nulls', NULLS)
         multiTarget = options.get('multitarget', False)
+        join      = options.get('join', JOIN)
+        jobs      = options.get('jobs', JOBS)
+        backward  = options.get('backward', BACKWARD)
+        codec     = options.get('intermediate_codec', None)
+        if codec:
+            codec = files.getCodecByName(codec)
 
         if lexMethod not in ('prodweight', 'table'):
             if alignLexPath == None:
@@ -601,33 +1226,41 @@ def pivot(table1, table2, savefile="phrase-table.gz", workdir=".", **options):
         # making work directory
         workdir = workdir + '/pivot'
         files.mkdir(workdir)
-        # expanding table1
-        if files.isGzipped(table1):
-            srcWorkTable = "%s/%s_src-pvt" % (workdir, prefix)
-            progress.log("table copying into: %s\n" % srcWorkTable)
-            files.autoCat(table1, srcWorkTable)
-        else:
-            srcWorkTable = table1
-        # expanding table2
-        if files.isGzipped(table2):
-            trgWorkTable = "%s/%s_pvt-trg" % (workdir, prefix)
-            progress.log("table copying into: %s\n" % trgWorkTable)
-            files.autoCat(table2, trgWorkTable)
-        else:
-            trgWorkTable = table2
-        # making index1
-        srcIndex = srcWorkTable + '.index'
-        progress.log("making index: %s\n" % srcIndex)
-        findutil.saveIndices(srcWorkTable, srcIndex)
-        # making index2
-        trgIndex = trgWorkTable + '.index'
-        progress.log("making index: %s\n" % trgIndex)
-        findutil.saveIndices(trgWorkTable, trgIndex)
+        # table1 is read sequentially, and table2 is sliced by the phrase index,
+        # compressed tables are not expanded but indexed by the uncompressed offsets
+        srcWorkTable = table1
+        trgWorkTable = table2
+        trgBlockIndex = None
+        if join == 'search' and files.isCompressed(table2):
+            trgBlockIndex = "%s/%s_pvt-trg%s" % (workdir, prefix, files.GZIP_INDEX_EXT)
+            progress.log("making block index: %s\n" % trgBlockIndex)
+            if not files.isGzipped(table2) or not files.makeGzipIndex(table2, trgBlockIndex):
+                # having too large gzip members to seek (or other codecs), recompressing into small blocks
+                trgWorkTable = "%s/%s_pvt-trg.gz" % (workdir, prefix)
+                progress.log("table recompressing into: %s\n" % trgWorkTable)
+                files.makeBlockedGzip(table2, trgWorkTable, trgBlockIndex)
+        if join == 'search':
+            # making index1
+            if files.isCompressed(srcWorkTable):
+                srcIndex = "%s/%s_src-pvt.index" % (workdir, prefix)
+            else:
+                srcIndex = srcWorkTable + '.index'
+            progress.log("making index: %s\n" % srcIndex)
+            findutil.saveIndices(srcWorkTable, srcIndex)
+            # making phrase index2
+            if trgBlockIndex:
+                trgIndex = "%s/%s_pvt-trg.phrases" % (workdir, prefix)
+            else:
+                trgIndex = trgWorkTable + '.phrases'
+            progress.log("making phrase index: %s\n" % trgIndex)
+            findutil.savePhraseIndex(trgWorkTable, trgIndex)
         # making workset
         workOptions = {}
         workOptions['RecordClass'] = RecordClass
         workOptions['prefix'] = prefix
         workOptions['multiTarget'] = multiTarget
+        workOptions['jobs'] = jobs
+        workOptions['codec'] = codec
 #        workset = WorkSet(savefile, workdir, method, RecordClass = RecordClass, prefix = prefix)
         workset = WorkSet(savefile, workdir, method, **workOptions)
         workset.threshold = threshold
@@ -635,22 +1268,34 @@ def pivot(table1, table2, savefile="phrase-table.gz", workdir=".", **options):
         # starting workset
         workset.start()
         # find all the candidates of record pairs
-        finder = PivotFinder(srcWorkTable, trgWorkTable, srcIndex, trgIndex, RecordClass = RecordClass)
+        if join == 'merge':
+            finder = MergeJoinFinder(srcWorkTable, trgWorkTable, workdir, prefix, RecordClass = RecordClass, codec = codec)
+        else:
+            finder = PivotFinder(srcWorkTable, trgWorkTable, srcIndex, trgIndex, RecordClass = RecordClass, blockIndex2 = trgBlockIndex)
         currPhrase = ''
         rows = []
         rowCount = 0
+        # batch of groups of line pairs having the common source phrase
+        groups = []
+        batchSize = 0
+        seq = 0
         progress.log("beginning pivot\n")
         while True:
-            if workset.pivotQueue.qsize() > PIVOT_QUEUE_SIZE:
-                time.sleep(1)
             row = finder.getRow()
             if not row:
                 break
             rowCount += 1
-            srcPhrase = row[0].src
+            srcPhrase = getPhraseKey(row[0])[:-4]
             if currPhrase != srcPhrase and rows:
                 # get new target phrase, put the data up to previous phrase
-                workset.pivotQueue.put(rows)
+                groups.append(rows)
+                batchSize += len(rows)
+                if batchSize >= PIVOT_BATCH_SIZE:
+                    # blocking while the queue is full
+                    workset.put( (seq, groups) )
+                    seq += 1
+                    groups = []
+                    batchSize = 0
                 rows = []
                 currPhrase = srcPhrase
                 #debug.log(workset.record_queue.qsize())
@@ -658,15 +1303,19 @@ def pivot(table1, table2, savefile="phrase-table.gz", workdir=".", **options):
             if finder.srcCount.shouldPrint():
                 finder.srcCount.update()
                 numSrcRecords = finder.srcCount.count
-                ratio = 100.0 * numSrcRecords / len(finder.srcIndices)
+                ratio = 100.0 * numSrcRecords / finder.total
                 progress.log("source: %d (%3.2f%%), processed: %d, last %s: %s" %
                              (numSrcRecords, ratio, rowCount, prefix, srcPhrase) )
         # exitting from while loop
         # processing the last data
-        workset.pivotQueue.put(rows)
-        workset.pivotQueue.put(None)
+        groups.append(rows)
+        workset.put( (seq, groups) )
+        workset.stop()
         # waiting for the writing process to finish
         workset.join()
+        if method != 'prodprob':
+            # merging the word pair counts of the workers
+            workset.reduceLexCounts()
         progress.log("source: %d (100%%), processed: %d, pivot %d  \n" %
                      (finder.srcCount.count, rowCount, workset.pivotCount.count) )
         # closing the workset
@@ -680,15 +1329,15 @@ def pivot(table1, table2, savefile="phrase-table.gz", workdir=".", **options):
                     progress.log("combining lex counts into: %s\n" % (workset.combinedLexPath))
                     combine_lex.combine_lex(alignLexPath, workset.tableLexPath, workset.combinedLexPath)
                     progress.log("loading combined word trans probabilities\n")
-                    lexCounts = lex.loadWordPairCounts(workset.combinedLexPath)
+                    lexCounts = lex.loadWordPairCounts(workset.combinedLexPath, Vocabulary())
                 else:
                     progress.log("loading table lex: %s\n", workset.tableLexPath)
-                    lexCounts = lex.loadWordPairCounts(workset.tableLexPath)
-                    lexCounts.srcCounts["NULL"] = numNulls
-                    lexCounts.trgCounts["NULL"] = numNulls
+                    lexCounts = lex.loadWordPairCounts(workset.tableLexPath, Vocabulary())
+                    lexCounts.srcCounts[lexCounts.null] = numNulls
+                    lexCounts.trgCounts[lexCounts.null] = numNulls
             else:
                 progress.log("loading aligned lex: %s\n" % alignLexPath)
-                lexCounts = lex.loadWordPairCounts(alignLexPath)
+                lexCounts = lex.loadWordPairCounts(alignLexPath, Vocabulary())
 #        if workset.method == 'countmin':
         if method in ['countmin', 'bidirmin', 'bidirgmean', 'bidirmax', 'bidiravr']:
 #            # 単語単位の翻訳確率をロードする
@@ -698,20 +1347,30 @@ def pivot(table1, table2, savefile="phrase-table.gz", workdir=".", **options):
 #            combine_lex.combine_lex(lexPath, workset.tableLexPath, workset.combinedLexPath)
 #            progress.log("loading combined word trans probabilities\n")
 #            lexCounts = lex.loadWordPairCounts(workset.combinedLexPath)
-            # reversing the table
-            progress.log("reversing %s table into: %s\n" % (prefix, workset.revPath) )
-            reverseTable(workset.pivotPath, workset.revPath, RecordClass)
-            progress.log("reversed %s table\n" % (prefix))
-            # calculating backward phrase trans probs for reversed table
-            progress.log("calculating reversed phrase trans probs into: %s\n" % (workset.trgCountPath))
-            calcPhraseTransProbsOnTable(workset.revPath, workset.trgCountPath, nbest = workset.nbest, RecordClass = RecordClass)
-            progress.log("calculated reversed phrase trans probs\n")
-            # reverseing the reversed table
-#            progress.log("reversing %s table into: %s\n" % (prefix,workset.revTrgCountPath))
-            progress.log("reversing %s table into: %s\n" % (prefix,workset.countPath))
-#            reverseTable(workset.trgCountPath, workset.revTrgCountPath, RecordClass)
-            reverseTable(workset.trgCountPath, workset.countPath, RecordClass)
-            progress.log("reversed %s table\n" % (prefix))
+            streamed = False
+            if backward == 'stream':
+                # calculating backward phrase trans probs without sorting
+                progress.log("calculating backward phrase trans probs into: %s\n" % (workset.countPath))
+                streamed = calcBackwardProbsOnTable(workset.pivotPath, workset.revPath, workset.countPath, RecordClass = RecordClass, tmpdir = workdir)
+                if streamed:
+                    progress.log("calculated backward phrase trans probs\n")
+                else:
+                    progress.log("%s table is not sorted, falling back to sorting\n" % (prefix))
+            if not streamed:
+                # reversing the table
+                progress.log("reversing %s table into: %s\n" % (prefix, workset.revPath) )
+                reverseTable(workset.pivotPath, workset.revPath, RecordClass, jobs = jobs, tmpdir = workdir, codec = codec)
+                progress.log("reversed %s table\n" % (prefix))
+                # calculating backward phrase trans probs for reversed table
+                progress.log("calculating reversed phrase trans probs into: %s\n" % (workset.trgCountPath))
+                calcPhraseTransProbsOnTable(workset.revPath, workset.trgCountPath, nbest = workset.nbest, RecordClass = RecordClass)
+                progress.log("calculated reversed phrase trans probs\n")
+                # reverseing the reversed table
+#                progress.log("reversing %s table into: %s\n" % (prefix,workset.revTrgCountPath))
+                progress.log("reversing %s table into: %s\n" % (prefix,workset.countPath))
+#                reverseTable(workset.trgCountPath, workset.revTrgCountPath, RecordClass)
+                reverseTable(workset.trgCountPath, workset.countPath, RecordClass, jobs = jobs, tmpdir = workdir, codec = codec)
+                progress.log("reversed %s table\n" % (prefix))
             # calculating the forward trans probs
 #            progress.log("calculating phrase trans probs into: %s\n" % (workset.countPath))
 #            calcPhraseTransProbsOnTable(workset.revTrgCountPath, workset.countPath, nbest = 0, RecordClass = RecordClass)
@@ -719,7 +1378,7 @@ def pivot(table1, table2, savefile="phrase-table.gz", workdir=".", **options):
             if lexMethod != 'prodweight':
                 # calculating lexical weights
                 progress.log("calculating lex weights into: %s\n" % workset.savePath)
-                calcLexWeights(workset.countPath, lexCounts, workset.savePath, RecordClass)
+                calcLexWeights(workset.countPath, lexCounts, workset.savePath, RecordClass, jobs)
                 progress.log("calculated lex weights\n")
             else:
                 progress.log("gzipping into: %s\n" % workset.savePath)
@@ -729,7 +1388,7 @@ def pivot(table1, table2, savefile="phrase-table.gz", workdir=".", **options):
             if lexMethod != 'prodweight':
                 # calculating lexical weights
                 progress.log("calculating lex weights into: %s\n" % workset.savePath)
-                calcLexWeights(workset.pivotPath, lexCounts, workset.savePath, RecordClass)
+                calcLexWeights(workset.pivotPath, lexCounts, workset.savePath, RecordClass, jobs)
                 progress.log("calculated lex weights\n")
             else:
                 progress.log("gzipping into: %s\n" % workset.savePath)
@@ -759,6 +1418,10 @@ def main():
     parser.add_argument('--alignlex', help = 'word pair counts file', default=None)
     parser.add_argument('--nulls', help = 'number of NULLs (lines) for table lex', type = int, default=NULLS)
     parser.add_argument('--noprefilter', help = 'No pre-filtering', type = bool, default=False)
+    parser.add_argument('--join', help = 'strategy to join the tables (search: random access, merge: sort-merge join)', choices=joins, default=JOIN)
+    parser.add_argument('--jobs', help = 'number of worker processes to pivot the records and calculate lex weights (default = 1)', type=int, default=JOBS)
+    parser.add_argument('--backward', help = 'strategy to calculate backward trans probs for count based methods (stream: without sorting, sort: reversing and sorting twice)', choices=backwards, default=BACKWARD)
+    parser.add_argument('--intermediate-codec', help = 'codec[:level] compressing the intermediate files in workdir (%s, default: plain)' % str.join('/', files.CODECS.keys()), default=None)
     args = vars(parser.parse_args())
 
     if args['noprefilter']:
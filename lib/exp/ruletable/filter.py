@@ -7,21 +7,32 @@ import argparse
 import sys
 
 from exp.ruletable import record
-from exp.phrasetable.filter import filterTable
+from exp.phrasetable.filter import checkArgs, filterTables, getOutputs, pruneTable
 
-def filterTravatarTable(srcFile, saveFile, rules, progress = True):
-    filterTable(srcFile, saveFile, rules, progress, record.TravatarRecord)
+def filterTravatarTable(srcFile, saveFile, rules, progress = True, jobs = 1, output = None, nbest = 0, by = 'egfp'):
+    if nbest > 0:
+        pruneTable(srcFile, saveFile, nbest, by, rules, progress, record.TravatarRecord)
+    else:
+        filterTables(srcFile, getOutputs(saveFile, rules, output), progress, record.TravatarRecord, jobs)
 
 def main():
     epilog = '''
-each rule should be as '{varname} {<,<=,==,>=,>} {value}'
+each rule should be as '{varname} {<,<=,==,!=,>=,>} {value}',
+combined with and/or/not, parentheses and arithmetic operators (+,-,*,/)
 varnames:
     c.s : source count
     c.t : target count
     c.c : co-occurrence count
+    l.s : source rule length (symbols)
+    l.t : target rule length (symbols)
+    egfp, fgep, egfl, fgel, p, w, ... : features (0 if missing)
+all the rules should be matched to save the record
+with --nbest, the n-best records of each source by the score expression of --by are saved among them
 example:
     %s model/rule-table.gz model/filtered-table.gz 'c.c > 1'
-    ''' % sys.argv[0]
+    %s model/rule-table.gz model/c1-table.gz 'c.c > 1' -o model/c2-table.gz 'c.c > 2'
+    %s model/rule-table.gz model/best-table.gz --nbest 20 --by egfp
+    ''' % (sys.argv[0], sys.argv[0], sys.argv[0])
     parser = argparse.ArgumentParser(
         formatter_class=argparse.RawDescriptionHelpFormatter,
         description='filter travatar rule-table by supplied rules',
@@ -29,10 +40,19 @@ example:
     )
     parser.add_argument('srcFile',  help='file path to load rule-table')
     parser.add_argument('saveFile', help='file path to save rule-table')
-    parser.add_argument('rules', metavar='rule', nargs='+', help='filtering rule to save record')
+    parser.add_argument('rules', metavar='rule', nargs='*', help='filtering rule to save record')
     parser.add_argument('--progress', '-p', action='store_true',
                         help='show progress bar (pv command should be installed')
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+                        help='number of worker processes filtering the ranges of plain or blocked gzip table (default = 1)')
+    parser.add_argument('--output', '-o', nargs='+', action='append', metavar=('SAVEFILE', 'RULE'),
+                        help='additional file path to save the records matching its own rules, in the same pass')
+    parser.add_argument('--nbest', '-n', type=int, default=0,
+                        help='number of records to save for each source, the table should be sorted by the sources')
+    parser.add_argument('--by', default='egfp',
+                        help='score expression of the variables to choose the n-best records (default = egfp)')
     args = vars(parser.parse_args())
+    checkArgs(parser, args)
     #print(args)
     filterTravatarTable(**args)
 
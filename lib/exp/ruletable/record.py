@@ -8,7 +8,12 @@ import math
 from exp.common import cache
 from exp.phrasetable import record
 
+if str is not bytes:
+  from exp.phrasetable.record import intern
+
 class TravatarRecord(record.Record):
+  __slots__ = ()
+
   def __init__(self, line = "", split = '|||'):
     record.Record.__init__(self)
     self.split = split
@@ -16,37 +21,59 @@ class TravatarRecord(record.Record):
 
   def loadLine(self, line, split = '|||'):
     if line:
-      fields = line.strip().split(split)
+      try:
+        fields = line.strip().split(split)
+      except TypeError:
+        # given the bytes line with the text separator or vice versa
+        fields = line.strip().split( record.matchType(split, line) )
       self.src = intern( fields[0].strip() )
       self.trg = intern( fields[1].strip() )
-      self.features = getTravatarFeatures(fields[2])
-      listCounts = record.getCounts(fields[3])
-      self.counts.setCounts(co = listCounts[0], src = listCounts[1], trg = listCounts[2])
+      # raw fields decoded on demand
+      self._features = fields[2]
+      self._counts = fields[3]
 #      self.aligns = fields[4].strip().split()
-      self.aligns = record.getAlignSet( fields[4] )
+      self._aligns = fields[4]
+
+  def decodeFeatures(self, field):
+    return getTravatarFeatures(field)
+
+  def decodeCounts(self, field):
+    listCounts = record.getCounts(field)
+    counts = record.CoOccurrence()
+    counts.setCounts(co = listCounts[0], src = listCounts[1], trg = listCounts[2])
+    return counts
 
   def getSrcSymbols(self):
-    return getTravatarSymbols(self.src)
+    return getTravatarSymbols( record.toText(self.src) )
   srcSymbols = property(getSrcSymbols)
 
   def getSrcTerms(self):
-    return getTravatarTerms(self.src)
+    return getTravatarTerms( record.toText(self.src) )
   srcTerms = property(getSrcTerms)
 
   def getTrgSymbols(self):
-    return getTravatarSymbols(self.trg)
+    return getTravatarSymbols( record.toText(self.trg) )
   trgSymbols = property(getTrgSymbols)
 
   def getTrgTerms(self):
-    return getTravatarTerms(self.trg)
+    return getTravatarTerms( record.toText(self.trg) )
   trgTerms = property(getTrgTerms)
 
   def toStr(self, s = ' ||| '):
-    strFeatures = getStrTravatarFeatures(self.features)
-    strCounts   = "%s %s %s" % (self.counts.co, self.counts.src, self.counts.trg)
+    if isinstance(self._features, record.RAW_TYPES):
+      strFeatures = self._features.strip()
+    else:
+      strFeatures = getStrTravatarFeatures(self.features)
+    if isinstance(self._counts, record.RAW_TYPES):
+      strCounts = self._counts.strip()
+    else:
+      strCounts   = "%s %s %s" % (self.counts.co, self.counts.src, self.counts.trg)
 #    strAligns = str.join(' ', self.aligns)
-    strAligns = str.join(' ', sorted(self.aligns))
-    buf = str.join(s, [self.src, self.trg, strFeatures, strCounts, strAligns]) + "\n"
+    if isinstance(self._aligns, record.RAW_TYPES):
+      strAligns = self._aligns.strip()
+    else:
+      strAligns = str.join(' ', sorted(self.aligns))
+    buf = record.joinFields([self.src, self.trg, strFeatures, strCounts, strAligns], s)
     return buf
 
   def getReversed(self):
@@ -5,21 +5,24 @@
 
 import argparse
 
+from exp.common import extsort
 from exp.ruletable import record
 from exp.phrasetable.reverse import reverseTable
 
-def reverseTravatarTable(srcFile, saveFile):
-    reverseTable(srcFile, saveFile, record.TravatarRecord)
+def reverseTravatarTable(srcFile, saveFile, **options):
+    reverseTable(srcFile, saveFile, record.TravatarRecord, **options)
 
 def main():
 #    parser = argparse.ArgumentParser(description = 'load 2 phrase tables and pivot into one moses phrase table')
     parser = argparse.ArgumentParser()
     parser.add_argument('src_table', help = 'source rule table')
     parser.add_argument('save_table', help = 'save path')
+    parser.add_argument('--jobs', help = 'number of worker processes to reverse and sort the records (default = %d)' % extsort.JOBS, type = int, default = extsort.JOBS)
+    parser.add_argument('--memory', help = 'memory budget for sorting in MB (default = %d)' % (extsort.MEMORY_SIZE // 1024 // 1024), type = int, default = extsort.MEMORY_SIZE // 1024 // 1024)
+    parser.add_argument('--tmpdir', help = 'directory for temporary sorted runs (default = system temporary directory)', default = None)
     args = vars(parser.parse_args())
 
-    reverseTravatarTable(args['src_table'], args['save_table'])
+    reverseTravatarTable(args['src_table'], args['save_table'], jobs = args['jobs'], memory = args['memory'] * 1024 * 1024, tmpdir = args['tmpdir'])
 
 if __name__ == '__main__':
     main()
-
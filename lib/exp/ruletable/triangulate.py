@@ -8,6 +8,7 @@ import argparse
 
 # my exp libs
 import exp.phrasetable.triangulate as base
+from exp.common import files
 from exp.ruletable.record import TravatarRecord
 
 # lower threshold of trans probs to abort
@@ -28,6 +29,14 @@ METHOD = base.METHOD
 lexMethods = base.lexMethods
 LEX_METHOD = base.LEX_METHOD
 
+# strategies to join the tables
+joins = base.joins
+JOIN = base.JOIN
+
+# strategies to calculate backward trans probs
+backwards = base.backwards
+BACKWARD = base.BACKWARD
+
 def main():
     parser = argparse.ArgumentParser(description = 'load 2 rule tables and pivot into one travatar rule table')
     parser.add_argument('table1', help = 'rule table 1')
@@ -42,6 +51,10 @@ def main():
     parser.add_argument('--nulls', help = 'number of NULLs (lines) for table lex', type = int, default=NULLS)
     parser.add_argument('--noprefilter', help = 'No pre-filtering', type = bool, default=False)
     parser.add_argument('--multitarget', help = 'enabling multi target model', action='store_true')
+    parser.add_argument('--join', help = 'strategy to join the tables (search: random access, merge: sort-merge join)', choices=joins, default=JOIN)
+    parser.add_argument('--jobs', help = 'number of worker processes to pivot the records (default = 1)', type=int, default=base.JOBS)
+    parser.add_argument('--backward', help = 'strategy to calculate backward trans probs for count based methods (stream: without sorting, sort: reversing and sorting twice)', choices=backwards, default=BACKWARD)
+    parser.add_argument('--intermediate-codec', help = 'codec[:level] compressing the intermediate files in workdir (%s, default: plain)' % str.join('/', files.CODECS.keys()), default=None)
     args = vars(parser.parse_args())
 
     args['RecordClass'] = TravatarRecord
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''tests of the parallel sorting in exp.common.extsort'''
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+LIB_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib')
+sys.path.insert(0, LIB_DIR)
+
+from exp.common import extsort
+
+# seconds to wait for the process exiting after a worker has been killed
+EXIT_TIMEOUT = 30
+
+# the worker of the first byte range killed before putting its runs
+KILLED_WORKER_SCRIPT = '''
+import os, sys
+from exp.common import extsort
+def convert(lines):
+    for line in lines:
+        if line.startswith(b'line 0000'):
+            os._exit(1)
+        yield line
+try:
+    extsort.sortLines(sys.argv[1] + '/input.txt', sys.argv[1] + '/output.txt', jobs = 2, convert = convert)
+except RuntimeError as e:
+    sys.stdout.write('RuntimeError: %s' % e)
+'''
+
+class ParallelSortTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.inputPath = os.path.join(self.workdir, 'input.txt')
+        self.lines = [('line %04d\n' % ((i * 7919) % 5000)).encode('ascii') for i in range(5000)]
+        with open(self.inputPath, 'wb') as f:
+            f.write(b''.join(self.lines))
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def testSortParallel(self):
+        outputPath = os.path.join(self.workdir, 'output.txt')
+        extsort.sortLines(self.inputPath, outputPath, jobs = 2, memory = 10000)
+        with open(outputPath, 'rb') as f:
+            self.assertEqual(f.read(), b''.join(sorted(self.lines)))
+
+    def testKilledWorker(self):
+        env = dict(os.environ, PYTHONPATH = LIB_DIR)
+        proc = subprocess.Popen([sys.executable, '-c', KILLED_WORKER_SCRIPT, self.workdir], env = env, stdout = subprocess.PIPE)
+        deadline = time.time() + EXIT_TIMEOUT
+        while proc.poll() == None and time.time() < deadline:
+            time.sleep(0.1)
+        if proc.poll() == None:
+            proc.kill()
+            proc.wait()
+            self.fail('process hung after the worker had been killed')
+        self.assertEqual(proc.returncode, 0)
+        self.assertTrue(proc.stdout.read().startswith(b'RuntimeError: failed to sort'))
+        proc.stdout.close()
+
+if __name__ == '__main__':
+    unittest.main()
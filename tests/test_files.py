@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''tests of the gzip reading in exp.common.files'''
+
+import gzip
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+
+from exp.common import files
+
+def compressMember(lines):
+    buf = io.BytesIO()
+    f = gzip.GzipFile(fileobj = buf, mode = 'wb')
+    f.write(b''.join(lines))
+    f.close()
+    return buf.getvalue()
+
+def makeLines(start, num):
+    return [('line %d\n' % i).encode('ascii') for i in range(start, start + num)]
+
+class GzipReadTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.lines = makeLines(0, 2000)
+        self.member1 = compressMember(self.lines[:1000])
+        self.member2 = compressMember(self.lines[1000:])
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def save(self, data):
+        path = os.path.join(self.workdir, 'test.gz')
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def readLines(self, path, bufferSize):
+        with files.ReadAheadReader(path, bufferSize = bufferSize) as reader:
+            return list(reader)
+
+    def testMemberBoundary(self):
+        path = self.save(self.member1 + self.member2)
+        # the magic number of the second member split over the reads, or starting the read
+        for bufferSize in [len(self.member1) - 1, len(self.member1), len(self.member1) + 1, 1, 2, 3, 7]:
+            self.assertEqual(self.readLines(path, bufferSize), self.lines, 'bufferSize = %d' % bufferSize)
+
+    def testTrailingGarbage(self):
+        path = self.save(self.member1 + b'\x00\x00\x00')
+        for bufferSize in [len(self.member1), len(self.member1) + 1, 1024]:
+            self.assertEqual(self.readLines(path, bufferSize), self.lines[:1000])
+
+    def testTruncated(self):
+        data = self.member1 + self.member2
+        for size in [len(data) - 1, len(data) - 8, len(self.member1) + 20]:
+            path = self.save(data[:size])
+            for bufferSize in [size, 1024]:
+                self.assertRaises(IOError, self.readLines, path, bufferSize)
+
+if __name__ == '__main__':
+    unittest.main()
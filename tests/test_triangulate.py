@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''tests of the worker processes in exp.phrasetable.triangulate'''
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+LIB_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib')
+
+# seconds to wait for the process exiting after a worker has died
+EXIT_TIMEOUT = 30
+
+# workers dying at once while the parent fills the queue with the items larger than the pipe buffer
+FAILING_WORKER_SCRIPT = '''
+import sys
+from exp.phrasetable import triangulate
+def die(*args):
+    sys.exit(1)
+triangulate.pivotRecPairs = die
+triangulate.writeRecordQueue = die
+workset = triangulate.WorkSet(sys.argv[1] + '/out.gz', sys.argv[1], 'countmin', jobs = 2)
+workset.start()
+try:
+    for i in range(10):
+        workset.put(['x' * 1000000])
+    workset.join()
+except RuntimeError as e:
+    sys.stdout.write('RuntimeError: %s' % e)
+'''
+
+class FailingWorkerTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def testExitAfterFailure(self):
+        env = dict(os.environ, PYTHONPATH = LIB_DIR)
+        proc = subprocess.Popen([sys.executable, '-c', FAILING_WORKER_SCRIPT, self.workdir], env = env, stdout = subprocess.PIPE)
+        deadline = time.time() + EXIT_TIMEOUT
+        while proc.poll() == None and time.time() < deadline:
+            time.sleep(0.1)
+        if proc.poll() == None:
+            proc.kill()
+            proc.wait()
+            self.fail('process hung after the worker had died')
+        self.assertEqual(proc.returncode, 0)
+        self.assertTrue(proc.stdout.read().startswith(b'RuntimeError: worker process'))
+        proc.stdout.close()
+
+if __name__ == '__main__':
+    unittest.main()